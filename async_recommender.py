@@ -0,0 +1,497 @@
+"""
+This module contains an asynchronous version of the recommendation pipeline
+of recommender.py.
+
+Independent sparql queries are sent at the same time with asyncio: the
+album and performer of a song are looked up together, and the random songs
+of all similar albums or performers are fetched concurrently. The queries
+go through sparql_client (pooled session and cache), each in a worker
+thread of a pool owned by this module.
+
+A request can have a deadline. When the deadline passes, the queries that
+are still running are cancelled and the recommendations found so far are
+returned, so a slow endpoint gives fewer results instead of no answer.
+
+Recommendations can also be streamed: resolve_query_stream yields every
+recommendation as soon as it is known. Local names and songs come first,
+the others as their sparql queries complete, so not always in the order of
+similarity. When the caller stops iterating (or the deadline passes), the
+queries that are still running are cancelled.
+
+Usage:
+results = await get_recommendations_async(query, timeout=5)
+results = get_recommendations(query, timeout=5)  # from synchronous code
+async for result in resolve_query_stream(parsed_query, deadline):
+for result in iter_recommendations(parsed_query, timeout=5):  # synchronous
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import metadata_store
+import recommender
+import sparql_client
+import tracing
+
+# Threads for blocking work. Not the default executor of the event loop,
+# which asyncio.run waits for, so a request returns at its deadline even
+# when cancelled queries are still waiting for the endpoint.
+_executor = ThreadPoolExecutor(max_workers=2 * sparql_client.POOL_SIZE)
+
+
+async def run_in_thread(function, *args):
+    """Runs a blocking function in a worker thread, within the current
+    trace."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor,
+                                      partial(tracing.wrap(function), *args))
+
+
+def _deadline(timeout):
+    """Returns the loop time at which a timeout expires, or None."""
+    if timeout is not None:
+        return asyncio.get_running_loop().time() + timeout
+
+
+async def gather_until(awaitables, deadline=None):
+    """Runs awaitables concurrently until they are done or the deadline
+    passes. Awaitables that are still running at the deadline are cancelled.
+
+    Arguments:
+    awaitables (list): Coroutines or futures
+    deadline (float): Loop time of the deadline, None to wait for all
+
+    Returns:
+    list: Result of every awaitable, None for the ones that failed or did
+    not finish before the deadline"""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    if not tasks:
+        return []
+    timeout = None
+    if deadline is not None:
+        timeout = max(0, deadline - asyncio.get_running_loop().time())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    results = []
+    for task in tasks:
+        if task in done and task.exception() is None:
+            results.append(task.result())
+        else:
+            results.append(None)
+    return results
+
+
+async def as_completed_until(awaitables, deadline=None):
+    """Runs awaitables concurrently and yields their results as they
+    complete, until they are all done or the deadline passes. Awaitables
+    that fail are skipped. The awaitables that are still running when the
+    deadline passes or the caller stops iterating are cancelled.
+
+    Arguments:
+    awaitables (list): Coroutines or futures
+    deadline (float): Loop time of the deadline, None to wait for all
+
+    Yields:
+    The result of every awaitable that completed in time"""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    loop = asyncio.get_running_loop()
+    try:
+        pending = set(tasks)
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - loop.time())
+            done, pending = await asyncio.wait(
+                pending, timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return
+            for task in tasks:
+                if (task in done and not task.cancelled() and
+                        task.exception() is None):
+                    yield task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def query_async(sparql_query):
+    """Sends a sparql query without blocking the event loop."""
+    return await run_in_thread(sparql_client.query, sparql_query)
+
+
+async def _first_binding(sparql_query, variable, deadline):
+    """Returns the value of a variable in the first result of a query.
+    Returns None if there is no result or the deadline passed."""
+    results, = await gather_until([query_async(sparql_query)], deadline)
+    if results:
+        return results[0][variable]['value']
+
+
+async def similar_uris_async(entity_type, entity, number, weights=None,
+                             deadline=None):
+    """Asynchronous version of recommender.similar_uris, the seeds are
+    looked up at the same time. Seeds that are not found before the
+    deadline are left out."""
+    seeds = recommender.as_seeds(entity_type, entity)
+    rows_per_seed = await gather_until(
+        [run_in_thread(recommender.seed_rows, entity_type, seed_type, name)
+         for seed_type, name in seeds], deadline)
+    # The search can load the artifacts, keep it off the event loop
+    return await run_in_thread(
+        recommender.nearest_to_seeds, entity_type,
+        [rows or [] for rows in rows_per_seed], number, weights)
+
+
+async def find_similar_artist_async(artist, number=1, return_uri=False,
+                                    weights=None, deadline=None):
+    """Asynchronous version of recommender.find_similar_artist.
+
+    Arguments:
+    artist (string, list or tuple): Name of artist that similar artists
+    should be based on, or several seeds (see recommender.as_seeds).
+    number (int): Number of similar artist that should be returned.
+    return_uri (bool): If set to True, a list of URIs is returned.
+    weights (list): Weight of every seed, None for the mean.
+    deadline (float): Loop time after which the artists found so far are
+    returned.
+
+    Returns:
+    list: List of artist names, or artist URIs if return_uri=True."""
+    sim_uris = await similar_uris_async('artist', artist, number, weights,
+                                        deadline)
+    if return_uri:
+        return sim_uris
+    labels = await run_in_thread(metadata_store.artist_labels, sim_uris)
+    missing = [uri for uri in sim_uris if uri not in labels]
+    if missing:
+        fetched, = await gather_until(
+            [run_in_thread(sparql_client.fetch_labels, missing)],
+            deadline)
+        labels.update(fetched or {})
+    return [labels[uri] for uri in sim_uris if uri in labels]
+
+
+async def find_similar_album_async(album, number=1, return_uri=False,
+                                   weights=None, deadline=None):
+    """Asynchronous version of recommender.find_similar_album.
+
+    Arguments:
+    album (string, list or tuple): Title of album that similar albums
+    should be based on, or several seeds (see recommender.as_seeds).
+    number (int): Number of similar albums that should be returned.
+    return_uri (bool): If set to True, a list of URIs is returned.
+    weights (list): Weight of every seed, None for the mean.
+    deadline (float): Loop time after which the albums found so far are
+    returned.
+
+    Returns:
+    list: List of items in the form of: artist name - album title, or album
+    URIs if return_uri=True."""
+    sim_uris = await similar_uris_async('album', album, number, weights,
+                                        deadline)
+    if return_uri:
+        return sim_uris
+    descriptions = await run_in_thread(metadata_store.album_descriptions,
+                                       sim_uris)
+    missing = [uri for uri in sim_uris if uri not in descriptions]
+    if missing:
+        fetched, = await gather_until(
+            [run_in_thread(sparql_client.fetch_album_descriptions,
+                           missing)],
+            deadline)
+        descriptions.update(fetched or {})
+    return [descriptions[uri] for uri in sim_uris if uri in descriptions]
+
+
+def _local_songs(uris, by, seed):
+    """Returns a song from the metadata store for every URI, None for the
+    URIs without songs."""
+    return {uri: metadata_store.random_song(uri, by=by, seed=seed)
+            for uri in uris}
+
+
+async def _album_and_performer(song, deadline):
+    """Returns the album title and the performer name of a song, both None
+    if not found. Without a local album, the album and the performer are
+    looked up at the same time."""
+    album = await run_in_thread(metadata_store.song_album_title, song)
+    if album:
+        return album, None
+    performer = await run_in_thread(metadata_store.song_performer, song)
+    lookups = [_first_binding(recommender.song_album_query(song), 'album',
+                              deadline)]
+    if not performer:
+        lookups.append(_first_binding(
+            recommender.song_performer_query(song), 'performer', deadline))
+    found = await gather_until(lookups, deadline)
+    if not performer and len(found) > 1:
+        performer = found[1]
+    return found[0], performer
+
+
+async def find_similar_song_async(song, number=1, seed=None,
+                                  deadline=None):
+    """Asynchronous version of recommender.find_similar_song. The albums
+    and performers of the songs are looked up at the same time, and the
+    random songs of all similar albums or performers are fetched
+    concurrently.
+
+    Arguments:
+    song (string, list or tuple): Title of song that similar songs should
+    be based on, or titles of several songs.
+    number (int): Number of similar songs that should be returned.
+    seed (int): Seed of the song sampling, the same seed gives the same
+    songs.
+    deadline (float): Loop time after which the songs found so far are
+    returned.
+
+    Returns:
+    list: List of items in the form of: artist name - song title."""
+    songs = [song] if isinstance(song, str) else list(song)
+    found = [pair or (None, None) for pair in await gather_until(
+        [_album_and_performer(title, deadline) for title in songs],
+        deadline)]
+    albums = [album for album, _ in found if album]
+    performers = [performer for _, performer in found if performer]
+
+    if albums:
+        by = 'album'
+        uris = await find_similar_album_async(albums, number,
+                                              return_uri=True,
+                                              deadline=deadline)
+    elif performers:
+        by = 'performer'
+        uris = await find_similar_artist_async(performers, number,
+                                               return_uri=True,
+                                               deadline=deadline)
+    else:
+        return []
+
+    indexed = await run_in_thread(recommender.indexed_songs, uris, by, seed)
+    if indexed is not None:
+        songs = dict(zip(uris, indexed))
+    else:
+        songs = await run_in_thread(_local_songs, uris, by, seed)
+    missing = [uri for uri in uris if not songs[uri]]
+    results = await gather_until(
+        [query_async(recommender.random_song_query(uri, by=by))
+         for uri in missing], deadline)
+    for uri, song_results in zip(missing, results):
+        songs[uri] = recommender.song_from_results(song_results)
+    return [songs[uri] for uri in uris if songs[uri]]
+
+
+async def resolve_query_async(parsed_query, deadline=None):
+    """Asynchronous version of recommender.resolve_query.
+
+    Arguments:
+    parsed_query (list): Query components as returned by parse_query
+    deadline (float): Loop time after which the recommendations found so
+    far are returned
+
+    Returns:
+    list: List of recommendations"""
+    intent, number, q_type, entity, _, _ = parsed_query
+    if q_type == 'sim':
+        if intent == 'artist':
+            return await find_similar_artist_async(entity, number,
+                                                   deadline=deadline)
+        if intent == 'album':
+            return await find_similar_album_async(entity, number,
+                                                  deadline=deadline)
+        return await find_similar_song_async(entity, number,
+                                             deadline=deadline)
+    if q_type == 'fil':
+        local_results = await run_in_thread(
+            recommender.indexed_filter_results, parsed_query)
+        if local_results is not None:
+            return local_results
+        results, = await gather_until(
+            [query_async(recommender.filter_query(parsed_query))], deadline)
+        return recommender.filter_results(intent, number, results)
+    return []
+
+
+async def get_recommendations_async(query, timeout=None, intent=None):
+    """Asynchronous version of recommender.get_recommendations.
+
+    Arguments:
+    query (string): User query
+    timeout (float): Seconds after which the recommendations found so far
+    are returned, None to wait for all
+    intent (string): Intent of the query, if it was already classified
+
+    Returns:
+    list: [intent, number, type, entity, genre, location, results], see
+    recommender.get_recommendations"""
+    deadline = _deadline(timeout)
+    with tracing.trace('recommendation', query=query):
+        # Parsing runs spaCy, keep it off the event loop
+        parsed_query = await run_in_thread(recommender.parse_query, query,
+                                           intent)
+        return parsed_query + [await resolve_query_async(parsed_query,
+                                                         deadline)]
+
+
+async def _labels_stream(uris, local_labels, fetch, deadline):
+    """Yields the labels of URIs, the ones in the local store first and the
+    others when the batched sparql query for them returns."""
+    labels = await run_in_thread(local_labels, uris)
+    for uri in uris:
+        if uri in labels:
+            yield labels[uri]
+    missing = [uri for uri in uris if uri not in labels]
+    if missing:
+        async for fetched in as_completed_until(
+                [run_in_thread(fetch, missing)], deadline):
+            for uri in missing:
+                if uri in fetched:
+                    yield fetched[uri]
+
+
+async def _uri_and_results(uri, sparql_query):
+    """Returns a URI with the results of a sparql query about it."""
+    return uri, await query_async(sparql_query)
+
+
+async def _songs_stream(song, number, seed, deadline):
+    """Yields songs similar to a song (or several songs), see
+    find_similar_song_async."""
+    songs = [song] if isinstance(song, str) else list(song)
+    found = [pair or (None, None) for pair in await gather_until(
+        [_album_and_performer(title, deadline) for title in songs],
+        deadline)]
+    albums = [album for album, _ in found if album]
+    performers = [performer for _, performer in found if performer]
+    if albums:
+        by = 'album'
+        uris = await similar_uris_async('album', albums, number,
+                                        deadline=deadline)
+    elif performers:
+        by = 'performer'
+        uris = await similar_uris_async('artist', performers, number,
+                                        deadline=deadline)
+    else:
+        return
+
+    indexed = await run_in_thread(recommender.indexed_songs, uris, by, seed)
+    if indexed is not None:
+        local_songs = dict(zip(uris, indexed))
+    else:
+        local_songs = await run_in_thread(_local_songs, uris, by, seed)
+    missing = []
+    for uri in uris:
+        local_song = local_songs[uri]
+        if local_song:
+            yield local_song
+        else:
+            missing.append(uri)
+    async for _, results in as_completed_until(
+            [_uri_and_results(uri, recommender.random_song_query(uri, by=by))
+             for uri in missing], deadline):
+        found_song = recommender.song_from_results(results)
+        if found_song:
+            yield found_song
+
+
+async def resolve_query_stream(parsed_query, deadline=None, seed=None):
+    """Streaming version of resolve_query_async: yields every
+    recommendation as soon as it is known. Close the generator (e.g. by
+    leaving an async for loop) to stop early, the sparql queries that are
+    still running are then cancelled.
+
+    Arguments:
+    parsed_query (list): Query components as returned by parse_query
+    deadline (float): Loop time after which no more recommendations are
+    yielded
+    seed (int): Seed of the song sampling
+
+    Yields:
+    string: A recommendation"""
+    intent, number, q_type, entity, _, _ = parsed_query
+    if q_type == 'sim':
+        if intent == 'artist':
+            uris = await similar_uris_async('artist', entity, number,
+                                            deadline=deadline)
+            stream = _labels_stream(uris, metadata_store.artist_labels,
+                                    sparql_client.fetch_labels, deadline)
+        elif intent == 'album':
+            uris = await similar_uris_async('album', entity, number,
+                                            deadline=deadline)
+            stream = _labels_stream(
+                uris, metadata_store.album_descriptions,
+                sparql_client.fetch_album_descriptions, deadline)
+        else:
+            stream = _songs_stream(entity, number, seed, deadline)
+        try:
+            async for recommendation in stream:
+                yield recommendation
+        finally:
+            await stream.aclose()
+    elif q_type == 'fil':
+        results = await run_in_thread(recommender.indexed_filter_results,
+                                      parsed_query)
+        if results is None:
+            fetched, = await gather_until(
+                [query_async(recommender.filter_query(parsed_query))],
+                deadline)
+            results = recommender.filter_results(intent, number, fetched)
+        for recommendation in results:
+            yield recommendation
+
+
+async def _cancel_pending():
+    """Cancels the other tasks of the running loop and waits until they
+    have finished."""
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def iter_recommendations(parsed_query, timeout=None, seed=None):
+    """Runs resolve_query_stream from synchronous code, e.g. the command
+    line. Closing the generator (e.g. by leaving a for loop) cancels the
+    sparql queries that are still running.
+
+    Arguments:
+    parsed_query (list): Query components as returned by parse_query
+    timeout (float): Seconds after which no more recommendations are
+    yielded, None to wait for all
+    seed (int): Seed of the song sampling
+
+    Yields:
+    string: A recommendation"""
+    loop = asyncio.new_event_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    stream = resolve_query_stream(parsed_query, deadline, seed)
+    try:
+        while True:
+            try:
+                recommendation = loop.run_until_complete(stream.__anext__())
+            except StopAsyncIteration:
+                return
+            yield recommendation
+    finally:
+        try:
+            loop.run_until_complete(stream.aclose())
+            # Let the cancelled lookups finish before the loop is closed,
+            # so no task is destroyed while it is still pending
+            loop.run_until_complete(_cancel_pending())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+def get_recommendations(query, timeout=None):
+    """Runs the asynchronous pipeline from synchronous code, e.g. the
+    command line. The intent is classified first, so the user can still be
+    asked to rephrase the request."""
+    with tracing.trace('recommendation', query=query):
+        intent = recommender.classify_intent(query)
+        if intent is None:
+            return [None, None, 'unk', None, None, None, []]
+        return asyncio.run(get_recommendations_async(query, timeout,
+                                                     intent))
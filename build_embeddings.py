@@ -0,0 +1,551 @@
+"""
+This script builds every artifact recommender.py loads for an entity type
+from a local turtle dump and entity CSV. It replaces the Colab notebooks
+create_artist_embeddings_and_knn.ipynb and
+create_album_embeddings_and_knn.ipynb, with the same RDF2Vec settings.
+
+Stages, for every entity type:
+embeddings   random walks and Word2Vec (pyrdf2vec is needed for this):
+             <type>_embeddings.npy, <type>_entities.npy, <type>_literals.npy
+             and the trained model, <type>_transformer.pkl
+uri_index    URI to row index: <type>_uri_index.pkl (see model_registry)
+normalized   normalized float32 embeddings (see similarity_index)
+index        nearest neighbour index of every backend given with -backends,
+             e.g. <type>_knn_model.pkl for brute
+songs        song index of the new version (see song_index), if the
+             version in use has one, as its rows follow the entities
+
+Every stage records a hash of its inputs (file contents and settings) in
+build_manifest.json in the output directory. A stage whose inputs did not
+change and whose outputs exist is skipped, so changing only the index
+settings does not train Word2Vec again. The time of every stage is
+reported.
+
+Every run writes a new artifact version (see model_registry): the
+artifacts in use are linked into embeddings/versions/<version>/, the
+stages that have to run replace their outputs there, and the version is
+published when it is complete, so a running recommender switches to it
+at once. Only the newest versions are kept (-keep).
+
+With -update, only the entities in the CSV file are embedded: the
+Word2Vec model of the version in use (<type>_transformer.pkl) is trained
+further on their walks, new entities are appended to the arrays, changed
+ones are replaced, and the stored indexes are updated in place instead of
+rebuilt. This takes minutes instead of hours, but the other embeddings
+slowly drift from the updated model; run a full build now and then.
+
+Walks and Word2Vec use fixed seeds. Word2Vec is only fully reproducible
+with a single worker (-w2v_workers 1) and a fixed PYTHONHASHSEED, more
+workers are faster but give slightly different embeddings on every run.
+
+To build the artifacts, use:
+python build_embeddings.py -type artist -ttl artist.ttl
+-csv artist_entities.csv [-out embeddings] [-walk_jobs 4] [-w2v_workers 4]
+[-seed 42] [-backends brute ivf] [-force]
+
+To add new or changed entities to the artifacts in use, use:
+python build_embeddings.py -type artist -ttl artist.ttl
+-csv new_artists.csv -update
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import model_registry
+import similarity_index
+import song_index
+
+MANIFEST = 'build_manifest.json'
+
+# Predicates left out of the walks, as in the notebooks
+SKIP_PREDICATES = {
+    'artist': {
+        'http://xmlns.com/foaf/0.1/name',
+        'http://ns.inria.fr/wasabi/ontology/iTunes_page',
+        'http://purl.org/ontology/mo/musicbrainz_guid',
+        'http://purl.org/ontology/mo/discogs',
+        'http://ns.inria.fr/wasabi/ontology/secondHandSongs_page',
+        'http://ns.inria.fr/wasabi/ontology/amazon_page',
+        'http://ns.inria.fr/wasabi/ontology/name_without_accent',
+        'http://schema.org/disambiguatingDescription',
+        'http://ns.inria.fr/wasabi/ontology/wikidata_page',
+        'http://purl.org/ontology/mo/musicbrainz',
+        'http://ns.inria.fr/wasabi/ontology/musicbrainz_id',
+        'http://ns.inria.fr/wasabi/ontology/BBC_page',
+        'http://ns.inria.fr/wasabi/ontology/instagram_page',
+        'http://ns.inria.fr/wasabi/ontology/discogs_id',
+        'http://purl.org/ontology/mo/myspace',
+        'http://ns.inria.fr/wasabi/ontology/twitter_page',
+        'http://ns.inria.fr/wasabi/ontology/allMusic_page',
+        'http://ns.inria.fr/wasabi/ontology/deezer_page',
+        'http://ns.inria.fr/wasabi/ontology/deezer_artist_id',
+        'http://ns.inria.fr/wasabi/ontology/soundCloud_page',
+        'http://ns.inria.fr/wasabi/ontology/pureVolume_page',
+        'http://purl.org/ontology/mo/homepage',
+        'http://ns.inria.fr/wasabi/ontology/lastFm_page',
+        'http://ns.inria.fr/wasabi/ontology/googlePlus_page',
+        'http://ns.inria.fr/wasabi/ontology/youTube_page',
+        'http://purl.org/ontology/mo/uuid',
+        'http://ns.inria.fr/wasabi/ontology/rateYourMusic_page',
+        'http://purl.org/ontology/mo/wikipedia',
+        'http://ns.inria.fr/wasabi/ontology/wikia_page',
+        'http://ns.inria.fr/wasabi/ontology/spotify_page',
+        'http://ns.inria.fr/wasabi/ontology/facebook_page',
+    },
+    'album': {
+        'http://ns.inria.fr/wasabi/ontology/iTunes_page',
+        'http://purl.org/ontology/mo/musicbrainz_guid',
+        'http://purl.org/ontology/mo/discogs',
+        'http://ns.inria.fr/wasabi/ontology/amazon_page',
+        'http://purl.org/ontology/mo/musicbrainz',
+        'http://schema.org/barcode',
+        'http://ns.inria.fr/wasabi/ontology/discogs_id',
+        'http://ns.inria.fr/wasabi/ontology/allMusic_page',
+        'http://ns.inria.fr/wasabi/ontology/deezer_page',
+        'http://ns.inria.fr/wasabi/ontology/deezer_album_id',
+        'http://purl.org/ontology/mo/upc',
+        'http://purl.org/ontology/mo/homepage',
+        'http://purl.org/ontology/mo/uuid',
+        'http://purl.org/ontology/mo/wikipedia',
+        'http://ns.inria.fr/wasabi/ontology/spotify_page',
+    },
+}
+
+# Literals extracted for every entity, as in the notebooks
+LITERALS = {
+    'artist': [
+        ['http://www.w3.org/2000/01/rdf-schema#label'],
+        ['http://dbpedia.org/ontology/abstract'],
+        ['http://dbpedia.org/ontology/genre'],
+        ['http://ns.inria.fr/wasabi/ontology/location'],
+        ['http://ns.inria.fr/wasabi/ontology/record_label'],
+        ['http://purl.org/dc/terms/subject'],
+        ['http://xmlns.com/foaf/0.1/gender'],
+        ['http://ns.inria.fr/wasabi/ontology/city'],
+        ['http://dbpedia.org/ontology/associatedMusicalArtist'],
+        ['http://ns.inria.fr/wasabi/ontology/country'],
+    ],
+    'album': [
+        ['http://purl.org/dc/terms/title'],
+        ['http://purl.org/ontology/mo/genre'],
+        ['http://purl.org/ontology/mo/performer'],
+        ['http://purl.org/dc/terms/language'],
+        ['http://schema.org/location'],
+        ['http://ns.inria.fr/wasabi/ontology/has_explicit_lyrics'],
+    ],
+}
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-type", "--entity_type", type=str, required=True,
+                        choices=sorted(SKIP_PREDICATES),
+                        help="Entity type to build the artifacts for")
+    parser.add_argument("-ttl", "--ttl_file", type=str, required=True,
+                        help="Turtle dump with the entities")
+    parser.add_argument("-csv", "--csv_file", type=str, required=True,
+                        help="CSV file with the entity URIs in the first "
+                             "column")
+    parser.add_argument("-out", "--output_dir", type=str,
+                        default=model_registry.EMBEDDINGS_DIR,
+                        help="Directory to store the artifacts in")
+    parser.add_argument("-depth", "--depth", type=int, default=4,
+                        help="Maximum depth of the random walks")
+    parser.add_argument("-walks", "--walks", type=int, default=10,
+                        help="Maximum number of walks per entity")
+    parser.add_argument("-epochs", "--epochs", type=int, default=10,
+                        help="Number of Word2Vec epochs")
+    parser.add_argument("-walk_jobs", "--walk_jobs", type=int,
+                        default=os.cpu_count(),
+                        help="Number of processes extracting walks")
+    parser.add_argument("-w2v_workers", "--w2v_workers", type=int,
+                        default=os.cpu_count(),
+                        help="Number of Word2Vec worker threads")
+    parser.add_argument("-seed", "--seed", type=int, default=42,
+                        help="Seed of the walks and of Word2Vec")
+    parser.add_argument("-backends", "--backends", nargs='+',
+                        default=['brute'],
+                        choices=sorted(similarity_index.BACKENDS),
+                        help="Nearest neighbour indexes to build")
+    parser.add_argument("-force", "--force", action="store_true",
+                        help="Run every stage, even if its inputs did not "
+                             "change")
+    parser.add_argument("-update", "--update", action="store_true",
+                        help="Only embed the entities in the CSV file "
+                             "(new or changed ones) and add them to the "
+                             "artifacts in use")
+    parser.add_argument("-keep", "--keep", type=int, default=3,
+                        help="Number of artifact versions to keep")
+
+    args = parser.parse_args()
+    return args
+
+
+def file_hash(path):
+    """Returns the sha256 hash of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def inputs_hash(files, settings):
+    """Returns a hash of the contents of the input files and the settings of
+    a stage."""
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(file_hash(path).encode('ascii'))
+    digest.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir):
+    """Returns the input hashes of the stages that were built before."""
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(output_dir, manifest):
+    """Stores the input hashes of the built stages."""
+    path = os.path.join(output_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def run_stage(manifest, name, files, settings, outputs, build, force=False):
+    """Runs a stage unless its inputs did not change since the last build.
+
+    Arguments:
+    manifest (dict): Input hashes of the stages, updated in place
+    name (string): Name of the stage
+    files (list): Input files of the stage
+    settings (dict): Settings that change the outputs of the stage
+    outputs (list): Files created by the stage
+    build (function): Function that runs the stage
+    force (bool): If set to True, the stage is always run
+
+    Returns:
+    float: Seconds the stage took, 0 if it was skipped"""
+    key = inputs_hash(files, settings)
+    if (not force and manifest.get(name) == key and
+            all(os.path.exists(path) for path in outputs)):
+        print(f'{name:<28} skipped, inputs unchanged')
+        return 0.0
+    start = time.perf_counter()
+    build()
+    seconds = time.perf_counter() - start
+    manifest[name] = key
+    print(f'{name:<28} {seconds:9.1f} s')
+    return seconds
+
+
+def read_entities(csv_file):
+    """Returns the entity URIs in the first column of a CSV file."""
+    import pandas as pd
+    data = pd.read_csv(csv_file)
+    return data[data.columns[0]].values.tolist()
+
+
+def create_transformer(depth=4, walks=10, epochs=10, walk_jobs=1,
+                       w2v_workers=1, seed=42):
+    """Returns a pyrdf2vec transformer with the settings of the notebooks.
+
+    Arguments:
+    depth (int): Maximum depth of the random walks
+    walks (int): Maximum number of walks per entity
+    epochs (int): Number of Word2Vec epochs
+    walk_jobs (int): Number of processes extracting walks
+    w2v_workers (int): Number of Word2Vec worker threads
+    seed (int): Seed of the walks and of Word2Vec"""
+    from pyrdf2vec import RDF2VecTransformer
+    from pyrdf2vec.embedders import Word2Vec
+    from pyrdf2vec.walkers import RandomWalker
+    return RDF2VecTransformer(
+        Word2Vec(epochs=epochs, workers=w2v_workers, seed=seed),
+        walkers=[RandomWalker(depth, walks, with_reverse=False,
+                              n_jobs=walk_jobs, random_state=seed)],
+        verbose=1)
+
+
+def load_kg(entity_type, ttl_file):
+    """Loads a turtle dump as a pyrdf2vec knowledge graph."""
+    from pyrdf2vec.graphs import KG
+    return KG(ttl_file, fmt='turtle',
+              skip_predicates=SKIP_PREDICATES[entity_type],
+              literals=LITERALS[entity_type])
+
+
+def _temporary_path(path):
+    """Returns a temporary path next to a file with the same extension,
+    as some libraries add the extension when it is missing."""
+    root, extension = os.path.splitext(path)
+    return root + '.tmp' + extension
+
+
+def _save_array(path, array):
+    """Saves an array, writing to a temporary file first so readers never
+    see a partial file. Files linked from a previous version are replaced,
+    not overwritten."""
+    with open(path + '.tmp', 'wb') as array_file:
+        np.save(array_file, array)
+    os.replace(path + '.tmp', path)
+
+
+def _save_index(index, path):
+    """Saves a nearest neighbour index like _save_array."""
+    index.save(_temporary_path(path))
+    os.replace(_temporary_path(path), path)
+
+
+def _save_transformer(transformer, path):
+    """Saves a pyrdf2vec transformer like _save_array."""
+    transformer.save(_temporary_path(path))
+    os.replace(_temporary_path(path), path)
+
+
+def new_version():
+    """Creates the directory of a new artifact version. The artifacts of
+    the version in use are hard-linked into it (copied where links are not
+    possible), so stages that do not run keep their outputs.
+
+    Returns:
+    tuple: Name and directory of the new version"""
+    versions = os.path.join(model_registry.EMBEDDINGS_DIR,
+                            model_registry.VERSIONS_DIR)
+    os.makedirs(versions, exist_ok=True)
+    numbers = [int(name[1:]) for name in os.listdir(versions)
+               if name[:1] == 'v' and name[1:].isdigit()]
+    version = 'v{:04d}'.format(max(numbers, default=0) + 1)
+    directory = os.path.join(versions, version)
+    os.makedirs(directory)
+    source = model_registry.artifact_dir()
+    prefixes = tuple(f'{entity_type}_' for entity_type in SKIP_PREDICATES)
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if ((name.startswith(prefixes) or name == MANIFEST) and
+                os.path.isfile(path) and not name.endswith('.tmp')):
+            try:
+                os.link(path, os.path.join(directory, name))
+            except OSError:
+                shutil.copy2(path, os.path.join(directory, name))
+    return version, directory
+
+
+def prune_versions(keep):
+    """Removes the oldest artifact versions, keeping the version in use and
+    the given number of newest versions."""
+    versions = os.path.join(model_registry.EMBEDDINGS_DIR,
+                            model_registry.VERSIONS_DIR)
+    current = model_registry.current_version()
+    names = sorted(name for name in os.listdir(versions)
+                   if name[:1] == 'v' and name[1:].isdigit())
+    for name in names[:max(0, len(names) - keep)]:
+        if name != current:
+            shutil.rmtree(os.path.join(versions, name))
+
+
+def rebuild_song_index(directory):
+    """Rebuilds the song index in the directory of a new artifact version,
+    so its rows match the entities of that version. Skipped when the
+    version in use has no song index.
+
+    Returns:
+    float: Seconds, or None if skipped"""
+    if not any(os.path.exists(song_index.index_paths(entity_type)['rows'])
+               for entity_type in SKIP_PREDICATES):
+        return None
+    start = time.perf_counter()
+    song_index.build_song_index(directory)
+    return time.perf_counter() - start
+
+
+def build_backend(entity_type, backend, directory, seed=42):
+    """Builds and stores the nearest neighbour index of a backend."""
+    embeddings = np.load(os.path.join(directory,
+                                      f'{entity_type}_embeddings.npy'))
+    if backend in ('ivf', 'hnsw'):
+        index = similarity_index.BACKENDS[backend].build(embeddings,
+                                                         seed=seed)
+    else:
+        index = similarity_index.BACKENDS[backend].build(embeddings)
+    _save_index(index, similarity_index.index_path(entity_type, backend,
+                                                   directory))
+
+
+def build(args):
+    """Runs all stages for an entity type in a new artifact version, and
+    publishes the version when a stage was run.
+
+    Returns:
+    dict: Stage name as key and seconds as value"""
+    model_registry.EMBEDDINGS_DIR = args.output_dir
+    os.makedirs(args.output_dir, exist_ok=True)
+    entity_type = args.entity_type
+    version, directory = new_version()
+    manifest = load_manifest(directory)
+
+    def path(name):
+        return os.path.join(directory, f'{entity_type}_{name}')
+
+    def embed():
+        entities = read_entities(args.csv_file)
+        transformer = create_transformer(
+            depth=args.depth, walks=args.walks, epochs=args.epochs,
+            walk_jobs=args.walk_jobs, w2v_workers=args.w2v_workers,
+            seed=args.seed)
+        embeddings, literals = transformer.fit_transform(
+            load_kg(entity_type, args.ttl_file), entities)
+        _save_array(path('embeddings.npy'),
+                    np.array(embeddings, dtype=np.float32))
+        _save_array(path('literals.npy'), np.array(literals, dtype=object))
+        _save_array(path('entities.npy'), np.array(entities))
+        # Kept for incremental updates
+        _save_transformer(transformer, path('transformer.pkl'))
+
+    timings = {}
+    stages = [
+        ('embeddings', [args.ttl_file, args.csv_file],
+         {'depth': args.depth, 'walks': args.walks, 'epochs': args.epochs,
+          'seed': args.seed},
+         [path('embeddings.npy'), path('entities.npy'),
+          path('literals.npy'), path('transformer.pkl')],
+         embed),
+        ('uri_index', [path('entities.npy')], {},
+         [model_registry.uri_index_path(entity_type, directory)],
+         lambda: model_registry.build_uri_index(entity_type, directory)),
+        ('normalized', [path('embeddings.npy')], {},
+         [similarity_index.normalized_path(entity_type, directory)],
+         lambda: similarity_index.load_normalized(entity_type, directory)),
+    ]
+    for backend in args.backends:
+        stages.append(
+            ('index ' + backend, [path('embeddings.npy')],
+             {'backend': backend, 'seed': args.seed},
+             [similarity_index.index_path(entity_type, backend, directory)],
+             lambda backend=backend: build_backend(entity_type, backend,
+                                                   directory, args.seed)))
+    for name, files, settings, outputs, function in stages:
+        stage = f'{entity_type} {name}'
+        # Input files are created by the previous stages, so they are
+        # hashed only when the stage is reached
+        timings[stage] = run_stage(manifest, stage, files, settings,
+                                   outputs, function, args.force)
+        save_manifest(directory, manifest)
+
+    if any(timings.values()):
+        seconds = rebuild_song_index(directory)
+        if seconds is not None:
+            timings['song index'] = seconds
+        model_registry.publish_version(version)
+        print(f'Published artifact version {version}')
+        prune_versions(args.keep)
+    else:
+        shutil.rmtree(directory)
+    return timings
+
+
+def update(args):
+    """Embeds only the entities in the CSV file (new or changed ones) with
+    the Word2Vec model of the version in use, trained further on their
+    walks. New entities are appended to the entities and embeddings arrays,
+    changed ones replaced, and the stored indexes are updated in place in a
+    new artifact version, which is then published.
+
+    Returns:
+    dict: Stage name as key and seconds as value"""
+    from pyrdf2vec import RDF2VecTransformer
+    model_registry.EMBEDDINGS_DIR = args.output_dir
+    entity_type = args.entity_type
+    version, directory = new_version()
+
+    def path(name):
+        return os.path.join(directory, f'{entity_type}_{name}')
+
+    timings = {}
+    start = time.perf_counter()
+    uris = read_entities(args.csv_file)
+    transformer = RDF2VecTransformer.load(path('transformer.pkl'))
+    kg = load_kg(entity_type, args.ttl_file)
+    transformer.fit(kg, uris, is_update=True)
+    new_embeddings, new_literals = transformer.transform(kg, uris)
+    timings[f'{entity_type} embeddings'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entities = np.load(path('entities.npy')).tolist()
+    embeddings = np.load(path('embeddings.npy'))
+    literals = list(np.load(path('literals.npy'), allow_pickle=True))
+    uri_rows = {uri: row for row, uri in enumerate(entities)}
+    rows = []
+    for uri in uris:
+        if uri not in uri_rows:
+            uri_rows[uri] = len(entities)
+            entities.append(uri)
+            literals.append(None)
+        rows.append(uri_rows[uri])
+    embeddings = np.concatenate([
+        embeddings, np.zeros((len(entities) - len(embeddings),
+                              embeddings.shape[1]), dtype=embeddings.dtype)])
+    embeddings[rows] = np.asarray(new_embeddings, dtype=embeddings.dtype)
+    for row, row_literals in zip(rows, new_literals):
+        literals[row] = row_literals
+    _save_array(path('embeddings.npy'), embeddings)
+    _save_array(path('literals.npy'), np.array(literals, dtype=object))
+    _save_array(path('entities.npy'), np.array(entities))
+    _save_transformer(transformer, path('transformer.pkl'))
+    model_registry.build_uri_index(entity_type, directory)
+    timings[f'{entity_type} arrays'] = time.perf_counter() - start
+
+    for backend in similarity_index.BACKENDS:
+        index_file = similarity_index.index_path(entity_type, backend,
+                                                 directory)
+        if not os.path.exists(index_file):
+            continue
+        start = time.perf_counter()
+        if backend == 'cosine':
+            # The normalized embeddings, stored before the other indexes
+            # load them
+            index = similarity_index.CosineIndex(np.load(index_file))
+        else:
+            index = similarity_index.load_index(entity_type, backend,
+                                                embeddings, directory)
+        index.update(embeddings, rows)
+        _save_index(index, index_file)
+        timings[f'{entity_type} index {backend}'] = (time.perf_counter() -
+                                                     start)
+
+    # The stages of a full build no longer match the updated artifacts
+    manifest = load_manifest(directory)
+    for stage in list(manifest):
+        if stage.startswith(f'{entity_type} '):
+            del manifest[stage]
+    save_manifest(directory, manifest)
+    seconds = rebuild_song_index(directory)
+    if seconds is not None:
+        timings['song index'] = seconds
+    for stage, seconds in timings.items():
+        print(f'{stage:<28} {seconds:9.1f} s')
+
+    model_registry.publish_version(version)
+    print(f'Published artifact version {version} with {len(rows)} new or '
+          f'changed {entity_type}s')
+    prune_versions(args.keep)
+    return timings
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    start = time.perf_counter()
+    if args.update:
+        update(args)
+    else:
+        build(args)
+    print(f'{"total":<28} {time.perf_counter() - start:9.1f} s')
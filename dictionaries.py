@@ -0,0 +1,115 @@
+"""
+This module loads the name dictionaries in embeddings/Name dictionaries/
+(artist names, album titles, song titles, genres and countries).
+
+Every dictionary is loaded once per process. Empty and duplicate entries are
+removed and the names are interned, so the matcher and the rest of the
+recommender share the same string objects.
+
+Parsing the large .json files takes much longer than loading a binary file,
+so the first load stores the names next to the .json file as
+<name>.names.pkl: all names in a single string buffer with the offsets of
+every name. It is rebuilt when the .json file is newer.
+"""
+
+import json
+import os
+import pickle
+import sys
+import threading
+from array import array
+
+DIRECTORY = 'embeddings/Name dictionaries/'
+
+_dictionaries = {}
+_lock = threading.Lock()
+
+
+def dictionary_file(name):
+    """Returns the path of a name dictionary, e.g. 'genres' or
+    'artistnames'. Paths are returned unchanged."""
+    if name.endswith('.json'):
+        return name
+    return os.path.join(DIRECTORY, name + '.json')
+
+
+def binary_path(dictionary_file):
+    """Returns the path of the binary copy of a name dictionary file."""
+    return os.path.splitext(dictionary_file)[0] + '.names.pkl'
+
+
+def deduplicate(name_list):
+    """Returns the names of a list without empty and duplicate entries,
+    keeping the order of first occurrence."""
+    seen = set()
+    names = []
+    for name in name_list:
+        if isinstance(name, str) and name.strip() and name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def _save_binary(path, names):
+    """Stores names as one string buffer with the offset of every name."""
+    offsets = array('L', [0])
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    # Write to a temporary file first so readers never see a partial file
+    with open(path + '.tmp', 'wb') as binary_file:
+        pickle.dump({'buffer': ''.join(names), 'offsets': offsets},
+                    binary_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def _load_binary(path):
+    """Loads names stored by _save_binary."""
+    with open(path, 'rb') as binary_file:
+        stored = pickle.load(binary_file)
+    buffer, offsets = stored['buffer'], stored['offsets']
+    return [buffer[offsets[i]:offsets[i + 1]]
+            for i in range(len(offsets) - 1)]
+
+
+def _load(dictionary_file):
+    """Loads the names of a dictionary file from its binary copy, creating
+    the binary copy from the .json file when it is missing or outdated."""
+    path = binary_path(dictionary_file)
+    if (os.path.exists(path) and
+            os.stat(path).st_mtime_ns >=
+            os.stat(dictionary_file).st_mtime_ns):
+        names = _load_binary(path)
+    else:
+        with open(dictionary_file, 'r') as json_file:
+            names = deduplicate(json.load(json_file))
+        _save_binary(path, names)
+    return tuple(sys.intern(name) for name in names)
+
+
+def get_names(name):
+    """Returns the names of a name dictionary. The dictionary is loaded
+    once per process.
+
+    Argument:
+    name (string): Name of the dictionary, e.g. 'genres' or 'artistnames',
+    or the path of a .json file with a list of names
+
+    Returns:
+    tuple: Deduplicated names in the order of the .json file"""
+    path = dictionary_file(name)
+    names = _dictionaries.get(path)
+    if names is None:
+        with _lock:
+            names = _dictionaries.get(path)
+            if names is None:
+                names = _load(path)
+                _dictionaries[path] = names
+    return names
+
+
+if __name__ == '__main__':
+    # Create the binary copies of all name dictionaries
+    for file_name in sorted(os.listdir(DIRECTORY)):
+        if file_name.endswith('.json'):
+            names = get_names(os.path.join(DIRECTORY, file_name))
+            print(f'Loaded {len(names)} names from {file_name}')
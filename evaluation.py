@@ -1,74 +1,270 @@
 """
-This script calculates precision, recall and f1-score for the query components
-based on the results.xlsx file created by recommender.py.
+This module evaluates result files created by recommender.py (-eval), one
+file per model or index variant.
+
+For every file, the precision, recall and f1-score (weighted by the support
+of the true values, like precision_recall_fscore_support with
+average='weighted' and zero_division=1) of the query components are
+computed: intent, number, entity, genre (against the corrected genre) and
+location. All components of all files are scored at once, by counting the
+true positives, predictions and true values of every value with a single
+group by.
+
+The recommendation lists are compared as rankings, on the similarity
+queries only (filter queries are sampled randomly):
+recall@k   share of the first k results of a reference file that are in the
+           first k results of a file. With a reference created with the
+           brute force backend, this is the recall against the exact
+           nearest neighbours.
+overlap    mean Jaccard similarity of the results of every pair of files.
+Files are matched on the row of the query, so they should be created from
+the same test data.
+
+Result files can be .xlsx, .csv or .parquet. Parsing .xlsx files with
+openpyxl is slow, use .csv or .parquet for large runs.
+
+To evaluate result files, use:
+python evaluation.py [-results results.xlsx results_ivf.csv ...]
+[-reference results_brute.csv] [-k 10] [-out scores.csv]
+
+A brute force reference can be created with:
+python recommender.py -eval -backend brute -out results_brute.csv
 """
 
+import argparse
+import ast
+import os
 import pandas as pd
-from sklearn.metrics import precision_recall_fscore_support
+
+# Component name, column with the true values and column with the
+# predictions
+FIELDS = [('intent', 'true_intent', 'pred_intent'),
+          ('number', 'true_number', 'pred_number'),
+          ('entity', 'true_entity', 'pred_entity'),
+          ('genre', 'corrected_genre', 'pred_genre'),
+          ('location', 'true_location', 'pred_location')]
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-results", "--result_files", type=str, nargs='+',
+                        default=['results.xlsx'],
+                        help="Result files (.xlsx, .csv or .parquet)")
+    parser.add_argument("-reference", "--reference_file", type=str,
+                        default=None,
+                        help="Result file with the true rankings, e.g. "
+                             "created with the brute force backend")
+    parser.add_argument("-k", "--k", type=int, default=10,
+                        help="Number of results compared for recall@k")
+    parser.add_argument("-out", "--output_file", type=str, default=None,
+                        help="File to store the scores in (.csv, .parquet "
+                             "or .xlsx)")
+
+    args = parser.parse_args()
+    return args
+
+
+def read_results(path):
+    """Reads a result file, the format is chosen by the file extension.
+
+    Argument:
+    path (string): .xlsx, .csv or .parquet file
+
+    Returns:
+    DataFrame: The results, with the recommendations as lists"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        df = pd.read_csv(path)
+    elif extension == '.parquet':
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_excel(path)
+    if 'pred_results' in df:
+        # Text files store the lists as their repr
+        df['pred_results'] = [
+            ast.literal_eval(results) if isinstance(results, str)
+            else list(results) if results is not None and
+            not isinstance(results, float) else []
+            for results in df['pred_results']]
+    return df
+
+
+def write_results(df, path):
+    """Writes results or scores, the format is chosen by the file
+    extension (.xlsx, .csv or .parquet)."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        df.to_csv(path, index=False)
+    elif extension == '.parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_excel(path)
+
+
+def _prepare(df):
+    """Returns the true and predicted values of every component as
+    strings, with the default number 3 for queries without a number."""
+    columns = {}
+    for field, true_column, pred_column in FIELDS:
+        true, pred = df[true_column], df[pred_column]
+        if field == 'number':
+            # Replace empty number cells with the default value 3, and
+            # compare numbers as numbers (3 and 3.0 are the same)
+            true = pd.to_numeric(true, errors='coerce').fillna(3.0)
+            pred = pd.to_numeric(pred, errors='coerce').fillna(0.0)
+        columns[true_column] = true.astype(object).where(true.notna(), '')
+        columns[pred_column] = pred.astype(object).where(pred.notna(), '')
+    return pd.DataFrame({column: values.astype(str)
+                         for column, values in columns.items()})
+
+
+def field_scores(results):
+    """Computes the weighted precision, recall and f1-score of every query
+    component of every result file.
+
+    Argument:
+    results (dict): Name of the run as key and DataFrame as value
+
+    Returns:
+    DataFrame: One row per run and component, with the columns run, field,
+    precision, recall, f1 and support"""
+    frames = []
+    for run, df in results.items():
+        prepared = _prepare(df)
+        for field, true_column, pred_column in FIELDS:
+            frames.append(pd.DataFrame({'run': run, 'field': field,
+                                        'true': prepared[true_column],
+                                        'pred': prepared[pred_column]}))
+    values = pd.concat(frames, ignore_index=True)
+
+    # Count true values, predictions and true positives per value
+    keys = ['run', 'field', 'value']
+    support = values.groupby(['run', 'field', 'true']).size()
+    predicted = values.groupby(['run', 'field', 'pred']).size()
+    correct = values[values['true'] == values['pred']].groupby(
+        ['run', 'field', 'true']).size()
+    counts = pd.concat([support.rename_axis(keys).rename('support'),
+                        predicted.rename_axis(keys).rename('predicted'),
+                        correct.rename_axis(keys).rename('correct')],
+                       axis=1).fillna(0)
+    # Values that are never true have no weight
+    counts = counts[counts['support'] > 0]
+
+    # A value that is never predicted has a precision of 1
+    precision = (counts['correct'] / counts['predicted']).fillna(1.0)
+    recall = counts['correct'] / counts['support']
+    f1 = 2 * counts['correct'] / (counts['predicted'] + counts['support'])
+    weighted = pd.DataFrame({'precision': precision * counts['support'],
+                             'recall': recall * counts['support'],
+                             'f1': f1 * counts['support'],
+                             'support': counts['support']})
+    scores = weighted.groupby(level=['run', 'field'], sort=False).sum()
+    for metric in ['precision', 'recall', 'f1']:
+        scores[metric] /= scores['support']
+    scores['support'] = scores['support'].astype(int)
+    return scores.reset_index()
+
+
+def ranked_results(df, k=None):
+    """Returns the recommendations of the similarity queries of a result
+    file, one row per recommendation.
+
+    Arguments:
+    df (DataFrame): Results, see read_results
+    k (int): Number of recommendations kept per query, None for all
+
+    Returns:
+    DataFrame: The columns row (row of the query), rank and item"""
+    similar = df.loc[df['pred_type'] == 'sim', 'pred_results']
+    items = similar.explode().dropna()
+    ranked = pd.DataFrame({'row': items.index, 'item': items.values})
+    ranked['rank'] = ranked.groupby('row').cumcount()
+    if k is not None:
+        ranked = ranked[ranked['rank'] < k]
+    return ranked[['row', 'rank', 'item']].drop_duplicates(['row', 'item'])
+
+
+def recall_at_k(ranked, reference, k):
+    """Computes the mean recall@k of the similarity queries.
+
+    Arguments:
+    ranked (DataFrame): Recommendations, see ranked_results
+    reference (DataFrame): True recommendations, see ranked_results
+    k (int): Number of recommendations compared
+
+    Returns:
+    float: Mean over the queries with true recommendations of the share of
+    the first k true recommendations found in the first k recommendations
+    """
+    ranked = ranked[ranked['rank'] < k]
+    reference = reference[reference['rank'] < k]
+    hits = ranked.merge(reference, on=['row', 'item']).groupby('row').size()
+    relevant = reference.groupby('row').size()
+    return float((hits.reindex(relevant.index, fill_value=0) /
+                  relevant).mean())
+
+
+def overlap(ranked, other):
+    """Computes the mean Jaccard similarity of the recommendations of two
+    runs, over the similarity queries of either run."""
+    common = ranked.merge(other, on=['row', 'item']).groupby('row').size()
+    sizes = pd.concat([ranked.groupby('row').size(),
+                       other.groupby('row').size()], axis=1).fillna(0)
+    union = sizes.sum(axis=1) - common.reindex(sizes.index, fill_value=0)
+    return float((common.reindex(sizes.index, fill_value=0) /
+                  union).mean())
+
+
+def ranking_scores(results, reference=None, k=10):
+    """Compares the recommendations of the result files.
+
+    Arguments:
+    results (dict): Name of the run as key and DataFrame as value
+    reference (DataFrame): Results with the true recommendations, or None
+    k (int): Number of recommendations compared for recall@k
+
+    Returns:
+    tuple: DataFrame with the recall@k of every run (None without a
+    reference), and DataFrame with the overlap of every pair of runs"""
+    ranked = {run: ranked_results(df) for run, df in results.items()}
+    recall = None
+    if reference is not None:
+        true_ranked = ranked_results(reference)
+        recall = pd.DataFrame({
+            'run': list(ranked),
+            f'recall_at_{k}': [recall_at_k(ranked[run], true_ranked, k)
+                               for run in ranked]})
+    overlaps = pd.DataFrame(1.0, index=list(ranked), columns=list(ranked))
+    runs = list(ranked)
+    for i, run in enumerate(runs):
+        for other in runs[i + 1:]:
+            overlaps.loc[run, other] = overlaps.loc[other, run] = overlap(
+                ranked[run], ranked[other])
+    return recall, overlaps
+
 
 if __name__ == '__main__':
-    df = pd.read_excel('results.xlsx')
-    # Replace empty number cells with the default value 3
-    df['true_number'].fillna(3.0, inplace=True)
-    # Fill empty cells
-    df['pred_number'].fillna(0.0, inplace=True)
-    df.fillna('', inplace=True)
-
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        df['true_intent'],
-        df['pred_intent'],
-        average='weighted',
-        zero_division=1)
-    print('Scores for intent:')
-    print(f"Precision: {round(precision, 2)}")
-    print(f"Recall: {round(recall, 2)}")
-    print(f"F1 Score: {round(fscore, 2)}")
-
-    print('\n---------------------------\n')
-
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        df['true_number'],
-        df['pred_number'],
-        average='weighted',
-        zero_division=1)
-    print('Scores for number:')
-    print(f"Precision: {round(precision, 2)}")
-    print(f"Recall: {round(recall, 2)}")
-    print(f"F1 Score: {round(fscore, 2)}")
-
-    print('\n---------------------------\n')
-
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        df['true_entity'],
-        df['pred_entity'],
-        average='weighted',
-        zero_division=1)
-    print('Scores for entity:')
-    print(f"Precision: {round(precision, 2)}")
-    print(f"Recall: {round(recall, 2)}")
-    print(f"F1 Score: {round(fscore, 2)}")
-
-    print('\n---------------------------\n')
-
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        df['corrected_genre'],
-        df['pred_genre'],
-        average='weighted',
-        zero_division=1)
-    print('Scores for genre:')
-    print(f"Precision: {round(precision, 2)}")
-    print(f"Recall: {round(recall, 2)}")
-    print(f"F1 Score: {round(fscore, 2)}")
-
-    print('\n---------------------------\n')
-    
-    precision, recall, fscore, _ = precision_recall_fscore_support(
-        df['true_location'],
-        df['pred_location'],
-        average='weighted',
-        zero_division=1)
-    print('Scores for location:')
-    print(f"Precision: {round(precision, 2)}")
-    print(f"Recall: {round(recall, 2)}")
-    print(f"F1 Score: {round(fscore, 2)}")
-    
\ No newline at end of file
+    args = create_arg_parser()
+    results = {path: read_results(path) for path in args.result_files}
+    reference = None
+    if args.reference_file:
+        reference = read_results(args.reference_file)
+
+    scores = field_scores(results)
+    for run, run_scores in scores.groupby('run', sort=False):
+        print(f'Scores for {run}:')
+        print(run_scores.drop(columns='run').round(2).to_string(
+            index=False))
+        print('\n---------------------------\n')
+
+    recall, overlaps = ranking_scores(results, reference, args.k)
+    if recall is not None:
+        print(f'Recall@{args.k} against {args.reference_file}:')
+        print(recall.round(3).to_string(index=False))
+        scores = scores.merge(recall, on='run')
+    if len(results) > 1:
+        print('\nOverlap of the recommendations (Jaccard):')
+        print(overlaps.round(3).to_string())
+
+    if args.output_file:
+        write_results(scores, args.output_file)
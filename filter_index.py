@@ -0,0 +1,252 @@
+"""
+This module contains a local inverted index for filter queries, such as
+"rock artists from France" or "pop albums", so they are answered without a
+sparql query.
+
+For every entity type, the index maps every genre and every country to the
+sorted rows (numpy int32 arrays) of the entities that have it:
+{'genre': {'rock': array([3, 17, ...]), ...},
+ 'country': {'france': array([...]), ...},
+ 'texts': ['Daft Punk', ...]}
+Keys are lowercase. Several filters are combined by intersecting the rows,
+smallest array first, and the results are sampled locally from the
+intersection. Songs are filtered on the genres of their album, like in the
+sparql query of recommender.SPARQL_builder.
+
+The index is built offline from the same turtle dumps that were used to
+create the embeddings (rdflib is needed for this), and stored as
+<entity_type>_filter_index.pkl next to the embeddings:
+python filter_index.py -artist artist.ttl -album album.ttl [-song song.ttl]
+"""
+
+import argparse
+import os
+import pickle
+import threading
+from collections import defaultdict
+import numpy as np
+
+EMBEDDINGS_DIR = 'embeddings'
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+FOAF_NAME = 'http://xmlns.com/foaf/0.1/name'
+DCTERMS_TITLE = 'http://purl.org/dc/terms/title'
+MO_GENRE = 'http://purl.org/ontology/mo/genre'
+MO_PERFORMER = 'http://purl.org/ontology/mo/performer'
+SCHEMA_GENRE = 'http://schema.org/genre'
+SCHEMA_ALBUM = 'http://schema.org/album'
+WSB = 'http://ns.inria.fr/wasabi/ontology/'
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-artist", "--artist_file", type=str, required=True,
+                        help="Turtle file with the artists")
+    parser.add_argument("-album", "--album_file", type=str, required=True,
+                        help="Turtle file with the albums")
+    parser.add_argument("-song", "--song_file", type=str, default=None,
+                        help="Turtle file with the songs")
+
+    args = parser.parse_args()
+    return args
+
+
+def index_path(entity_type):
+    """Returns the path of the filter index of an entity type."""
+    return os.path.join(EMBEDDINGS_DIR, f'{entity_type}_filter_index.pkl')
+
+
+def _subjects(graph, types):
+    """Returns the sorted subjects in a graph with one of the given types."""
+    from rdflib import URIRef
+    subjects = set()
+    for rdf_type in types:
+        subjects.update(str(s) for s in graph.subjects(URIRef(RDF_TYPE),
+                                                       URIRef(rdf_type)))
+    return sorted(subjects)
+
+
+def _objects(graph, predicate):
+    """Returns all objects of a predicate for every subject."""
+    from rdflib import URIRef
+    values = defaultdict(list)
+    for s, o in graph.subject_objects(URIRef(predicate)):
+        values[str(s)].append(str(o))
+    return values
+
+
+def _countries(graph):
+    """Returns the countries of the locations of every subject
+    (wsb:location [ wsb:country "..." ])."""
+    from rdflib import URIRef
+    values = defaultdict(list)
+    for s, location in graph.subject_objects(URIRef(WSB + 'location')):
+        for country in graph.objects(location, URIRef(WSB + 'country')):
+            values[str(s)].append(str(country))
+    return values
+
+
+def _postings(subjects, values):
+    """Returns the sorted rows of the subjects for every lowercase value.
+
+    Arguments:
+    subjects (list): Subjects, their position is their row
+    values (dict): Subject as key and list of values as value"""
+    postings = defaultdict(set)
+    for row, subject in enumerate(subjects):
+        for value in values.get(subject, []):
+            postings[value.lower()].add(row)
+    return {value: np.array(sorted(rows), dtype=np.int32)
+            for value, rows in postings.items()}
+
+
+def _save(entity_type, index):
+    """Stores the index of an entity type, writing to a temporary file
+    first so readers never see a partial index."""
+    path = index_path(entity_type)
+    with open(path + '.tmp', 'wb') as index_file:
+        pickle.dump(index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def build_filter_index(artist_file, album_file, song_file=None):
+    """Builds the filter indexes from turtle dumps of the knowledge graph.
+
+    Arguments:
+    artist_file (string): Turtle file with the artists
+    album_file (string): Turtle file with the albums
+    song_file (string): Turtle file with the songs, optional
+
+    Returns:
+    dict: Entity type as key and number of indexed entities as value"""
+    from rdflib import Graph
+
+    graph = Graph()
+    graph.parse(artist_file, format='turtle')
+    artists = _subjects(graph, [WSB + 'Artist_Person', WSB + 'Artist_Group'])
+    names = _objects(graph, FOAF_NAME)
+    labels = _objects(graph, RDFS_LABEL)
+    artists = [uri for uri in artists if uri in names]
+    _save('artist', {'genre': _postings(artists,
+                                        _objects(graph, SCHEMA_GENRE)),
+                     'country': _postings(artists, _countries(graph)),
+                     'texts': [names[uri][0] for uri in artists]})
+    counts = {'artist': len(artists)}
+
+    graph = Graph()
+    graph.parse(album_file, format='turtle')
+    album_genres = _objects(graph, MO_GENRE)
+    performers = _objects(graph, MO_PERFORMER)
+    titles = _objects(graph, DCTERMS_TITLE)
+    albums = [uri for uri in _subjects(graph, [WSB + 'Album'])
+              if uri in titles and labels.get(performers.get(uri, [''])[0])]
+    _save('album', {'genre': _postings(albums, album_genres),
+                    'country': {},
+                    'texts': [labels[performers[uri][0]][0] + ' - ' +
+                              titles[uri][0] for uri in albums]})
+    counts['album'] = len(albums)
+
+    if song_file:
+        graph = Graph()
+        graph.parse(song_file, format='turtle')
+        titles = _objects(graph, WSB + 'title_without_accent')
+        song_albums = _objects(graph, SCHEMA_ALBUM)
+        performers = _objects(graph, MO_PERFORMER)
+        songs = [uri for uri in _subjects(graph, [WSB + 'Song'])
+                 if uri in titles and
+                 labels.get(performers.get(uri, [''])[0])]
+        song_genres = {uri: [genre for album in song_albums.get(uri, [])
+                             for genre in album_genres.get(album, [])]
+                       for uri in songs}
+        _save('song', {'genre': _postings(songs, song_genres),
+                       'country': {},
+                       'texts': [labels[performers[uri][0]][0] + ' - ' +
+                                 titles[uri][0] for uri in songs]})
+        counts['song'] = len(songs)
+    return counts
+
+
+def get_index(entity_type):
+    """Returns the filter index of an entity type, loading it again when
+    the file on disk has changed.
+    Returns None if the index has not been built."""
+    path = index_path(entity_type)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    index = _indexes.get(entity_type)
+    if index is None or index['mtime'] != mtime:
+        with _lock:
+            with open(path, 'rb') as index_file:
+                index = pickle.load(index_file)
+            index['mtime'] = mtime
+            _indexes[entity_type] = index
+    return index
+
+
+def matching_rows(index, genre=None, location=None):
+    """Returns the sorted rows of the entities that match all filters.
+
+    Arguments:
+    index (dict): Filter index, see get_index
+    genre (string): Genre to filter on, or None
+    location (string): Country to filter on, or None
+
+    Returns:
+    array: Sorted rows"""
+    postings = []
+    if genre:
+        postings.append(index['genre'].get(genre.lower()))
+    if location:
+        postings.append(index['country'].get(location.lower()))
+    if not postings or any(rows is None for rows in postings):
+        return np.array([], dtype=np.int32)
+    postings.sort(key=len)
+    rows = postings[0]
+    for other in postings[1:]:
+        rows = np.intersect1d(rows, other, assume_unique=True)
+    return rows
+
+
+def sample(entity_type, genre=None, location=None, number=3, seed=None):
+    """Finds entities that match a genre and/or a location, and picks a
+    random sample of them.
+
+    Arguments:
+    entity_type (string): 'artist', 'album' or 'song'
+    genre (string): Genre to filter on, or None
+    location (string): Country to filter on, or None
+    number (int): Number of entities that should be returned
+    seed (int): Seed of the sampling, None for a different sample every
+    time
+
+    Returns:
+    list: Artist names, or 'artist name - title' for albums and songs
+    Returns None if the index of the entity type has not been built"""
+    index = get_index(entity_type)
+    if index is None:
+        return None
+    rows = matching_rows(index, genre, location)
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(rows, size=min(number, len(rows)), replace=False)
+    return [index['texts'][row] for row in chosen]
+
+
+def clear():
+    """Forgets the loaded filter indexes."""
+    with _lock:
+        _indexes.clear()
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    counts = build_filter_index(args.artist_file, args.album_file,
+                                args.song_file)
+    for entity_type, count in counts.items():
+        print(f'Indexed {count} {entity_type}s in '
+              f'{index_path(entity_type)}')
@@ -0,0 +1,447 @@
+"""
+This script measures the latency of the recommendation pipeline, per stage,
+without depending on the WASABI sparql endpoint.
+
+Sparql queries are answered by a local stand-in: a small HTTP server that
+replays recorded responses. The responses are recorded once from the real
+endpoint (or any endpoint given with -endpoint) with -record, and stored as
+JSON with the normalized query text as key. Queries that were not recorded
+get an empty result and are counted as misses. The sparql cache is disabled
+during the benchmark, so every query reaches the stand-in like it would
+reach the endpoint. -delay adds a fixed delay to every response to simulate
+the network.
+
+The queries are the queries of the test data (.xlsx, column true_query)
+and/or a synthetic mix of similarity and filter queries built from the name
+dictionaries with -synthetic. Every query is run once to warm up (loading
+spaCy, the matchers and the embeddings), and then -runs times. The time of
+every stage is measured:
+intent         classify_intent
+parse          intent, number and genre with query_parser
+name match     entity matching with the name matchers
+location       get_location (spaCy)
+entity lookup  finding the URIs and embedding rows of the seeds
+knn            nearest neighbour search
+labels         names and titles of the similar artists and albums
+songs          picking a song of every similar album or artist
+filter         answering a filter query
+total          the whole query
+A stage that is called from within another stage (e.g. a sparql query made
+by the label lookup) counts for the outer stage only.
+
+The p50, p95 and p99 latency of every stage and the throughput, both with
+one query at a time and with -workers queries at the same time, are stored
+as JSON. A previous result file can be given with -baseline to compare the
+two.
+
+To record responses and run the benchmark, use:
+python latency_benchmark.py -record responses.json [-test test_data.xlsx]
+[-synthetic 100] [-endpoint http://wasabi.inria.fr/sparql]
+python latency_benchmark.py -responses responses.json [-test test_data.xlsx]
+[-synthetic 100] [-runs 3] [-workers 4] [-delay 0] [-out benchmark.json]
+[-baseline previous.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import metadata_store
+import name_matcher
+import query_parser
+import recommender
+import sparql_cache
+import sparql_client
+
+# Functions that are timed for every stage, as (module, function name)
+STAGES = {
+    'intent': [(recommender, 'classify_intent')],
+    'parse': [(query_parser, 'parse')],
+    'name match': [(recommender, 'match_to_list'),
+                   (name_matcher, 'joined_matches')],
+    'location': [(recommender, 'get_location')],
+    'entity lookup': [(recommender, 'seed_rows'),
+                      (recommender, 'song_album'),
+                      (recommender, 'song_performer_name')],
+    'knn': [(recommender, 'nearest_to_seeds')],
+    'labels': [(metadata_store, 'artist_labels'),
+               (metadata_store, 'album_descriptions'),
+               (sparql_client, 'fetch_labels'),
+               (sparql_client, 'fetch_album_descriptions')],
+    'songs': [(recommender, 'indexed_songs'),
+              (metadata_store, 'random_song'),
+              (sparql_client, 'query_many')],
+    'filter': [(recommender, 'indexed_filter_results'),
+               (recommender, 'query_sparql_endpoint')],
+}
+# Queries of the synthetic mix, as (template, weight)
+SYNTHETIC_TEMPLATES = [
+    ('Can you recommend {number} artists like {artist}?', 3),
+    ('Give me {number} albums similar to {album}', 2),
+    ('Suggest {number} songs similar to {song}', 2),
+    ('Recommend {number} artists like {artist} and {other_artist}', 1),
+    ('Find {number} {genre} artists', 1),
+    ('Recommend {number} {genre} albums', 1),
+]
+
+_timings = threading.local()
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-record", "--record_file", type=str, default=None,
+                        help="Record the responses of the endpoint in this "
+                             "JSON file instead of running the benchmark")
+    parser.add_argument("-responses", "--responses_file", type=str,
+                        default='responses.json',
+                        help="JSON file with the recorded responses")
+    parser.add_argument("-endpoint", "--endpoint", type=str, default=None,
+                        help="Sparql endpoint to record the responses of")
+    parser.add_argument("-test", "--test_file", type=str,
+                        default='test_data.xlsx',
+                        help="Test data with the queries, '' for none")
+    parser.add_argument("-synthetic", "--synthetic", type=int, default=0,
+                        help="Number of synthetic queries to add")
+    parser.add_argument("-seed", "--seed", type=int, default=0,
+                        help="Seed of the synthetic queries")
+    parser.add_argument("-runs", "--runs", type=int, default=3,
+                        help="Number of times every query is run")
+    parser.add_argument("-workers", "--workers", type=int, default=4,
+                        help="Number of concurrent queries for the "
+                             "throughput")
+    parser.add_argument("-delay", "--delay", type=float, default=0.0,
+                        help="Milliseconds added to every response of the "
+                             "stand-in")
+    parser.add_argument("-out", "--output_file", type=str,
+                        default='benchmark.json',
+                        help="JSON file to store the results in")
+    parser.add_argument("-baseline", "--baseline_file", type=str,
+                        default=None,
+                        help="Previous result file to compare with")
+
+    args = parser.parse_args()
+    return args
+
+
+def test_queries(test_file):
+    """Returns the queries of a test data set (.xlsx)."""
+    import pandas as pd
+    test_df = pd.read_excel(test_file, header=0)
+    return test_df['true_query'].tolist()
+
+
+def synthetic_queries(number, seed=0):
+    """Builds a mix of similarity and filter queries from the names in the
+    name dictionaries.
+
+    Arguments:
+    number (int): Number of queries
+    seed (int): Seed of the choice of templates and names
+
+    Returns:
+    list: List of queries"""
+    import dictionaries
+    rng = random.Random(seed)
+    names = {
+        'artist': dictionaries.get_names('artistnames'),
+        'album': dictionaries.get_names('albumtitles'),
+        'song': dictionaries.get_names('songtitles'),
+        'genre': dictionaries.get_names('genres'),
+    }
+    templates, weights = zip(*SYNTHETIC_TEMPLATES)
+    queries = []
+    for template in rng.choices(templates, weights, k=number):
+        queries.append(template.format(
+            number=rng.randint(1, 10),
+            artist=rng.choice(names['artist']),
+            other_artist=rng.choice(names['artist']),
+            album=rng.choice(names['album']),
+            song=rng.choice(names['song']),
+            genre=rng.choice(names['genre'])))
+    return queries
+
+
+def _timed(stage, function):
+    """Wraps a function to add its time to a stage of the current query.
+    Calls made while another stage is running are not counted."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        stages = getattr(_timings, 'stages', None)
+        if stages is None or getattr(_timings, 'active', False):
+            return function(*args, **kwargs)
+        _timings.active = True
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stages[stage] = (stages.get(stage, 0.0) +
+                             time.perf_counter() - start)
+            _timings.active = False
+    return wrapper
+
+
+def instrument():
+    """Replaces the functions of every stage with timed versions.
+
+    Returns:
+    list: (module, function name, function) to restore with restore"""
+    originals = []
+    for stage, functions in STAGES.items():
+        for module, name in functions:
+            function = getattr(module, name)
+            originals.append((module, name, function))
+            setattr(module, name, _timed(stage, function))
+    return originals
+
+
+def restore(originals):
+    """Puts back the functions replaced by instrument."""
+    for module, name, function in originals:
+        setattr(module, name, function)
+
+
+def run_query(query):
+    """Gets the recommendations for a query and measures its stages.
+
+    Returns:
+    dict: Stage name as key and seconds as value, with the total time
+    Returns None if the query failed"""
+    _timings.stages = {}
+    start = time.perf_counter()
+    try:
+        # The intent is classified without asking the user to rephrase
+        intent = recommender.classify_intent(query, ask=False)
+        if intent is not None:
+            parsed_query = recommender.parse_query(query, intent)
+            recommender.resolve_query(parsed_query)
+        stages = _timings.stages
+        stages['total'] = time.perf_counter() - start
+        return stages
+    except Exception as error:
+        print('Query {!r} failed: {!r}'.format(query, error))
+    finally:
+        _timings.stages = None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers sparql queries with the recorded responses of the server."""
+
+    def do_GET(self):
+        parameters = parse_qs(urlparse(self.path).query)
+        key = sparql_cache.normalize(parameters.get('query', [''])[0])
+        bindings = self.server.responses.get(key)
+        with self.server.lock:
+            self.server.requests += 1
+            if bindings is None:
+                self.server.misses += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = json.dumps({'results': {'bindings': bindings or []}})
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in(responses, delay=0.0):
+    """Starts the local sparql stand-in on a free port in a background
+    thread, and points sparql_client to it with the cache disabled.
+
+    Arguments:
+    responses (dict): Normalized query as key and bindings as value
+    delay (float): Seconds added to every response
+
+    Returns:
+    ThreadingHTTPServer: The server, call shutdown() to stop it"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.responses = responses
+    server.delay = delay
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.misses = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sparql_client.configure(endpoint_url='http://127.0.0.1:{}/sparql'
+                            .format(server.server_address[1]))
+    sparql_cache.configure(enabled=False)
+    return server
+
+
+def record(queries, record_file, endpoint=None):
+    """Runs the queries against the endpoint and stores every sparql
+    response.
+
+    Arguments:
+    queries (list): List of queries
+    record_file (string): JSON file to store the responses in
+    endpoint (string): Sparql endpoint, the configured one if not given
+
+    Returns:
+    int: Number of recorded responses"""
+    if endpoint:
+        sparql_client.configure(endpoint_url=endpoint)
+    sparql_cache.configure(enabled=False)
+    responses = {}
+    send = sparql_client._send
+
+    def recording_send(sparql_query, timeout=None):
+        results = send(sparql_query, timeout)
+        responses[sparql_cache.normalize(sparql_query)] = results
+        return results
+
+    sparql_client._send = recording_send
+    try:
+        for query in queries:
+            run_query(query)
+    finally:
+        sparql_client._send = send
+    with open(record_file, 'w', encoding='utf-8') as responses_file:
+        json.dump(responses, responses_file)
+    return len(responses)
+
+
+def percentiles(seconds):
+    """Returns the number of measurements, the mean and the p50, p95 and
+    p99 of measurements in seconds, in milliseconds."""
+    milliseconds = 1000 * np.asarray(seconds)
+    p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+    return {'count': len(milliseconds),
+            'mean_ms': float(milliseconds.mean()),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99)}
+
+
+def benchmark(queries, runs=3, workers=4):
+    """Runs every query once to warm up and then runs times, one at a
+    time, and finally all queries with several workers at the same time.
+
+    Arguments:
+    queries (list): List of queries
+    runs (int): Number of measured runs of every query
+    workers (int): Number of concurrent queries for the throughput
+
+    Returns:
+    dict: Latency per stage, number of failed queries and throughput in
+    queries per second"""
+    for query in queries:
+        run_query(query)
+
+    stages = {}
+    failed = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        for query in queries:
+            timings = run_query(query)
+            if timings is None:
+                failed += 1
+                continue
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(run_query, queries * runs))
+    concurrent = time.perf_counter() - start
+
+    return {
+        'stages': {stage: percentiles(stages[stage])
+                   for stage in list(STAGES) + ['total']
+                   if stage in stages},
+        'failed': failed,
+        'throughput': {
+            'sequential_qps': len(queries) * runs / sequential,
+            'concurrent_qps': len(queries) * runs / concurrent,
+        },
+    }
+
+
+def git_commit():
+    """Returns the current git commit, or None outside a git repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    """Prints the latency per stage and the throughput, with the change
+    relative to a baseline report if given."""
+    print('{:<15}{:>7}{:>10}{:>10}{:>10}'.format('stage', 'count', 'p50 ms',
+                                                 'p95 ms', 'p99 ms'))
+    for stage, latency in report['stages'].items():
+        line = '{:<15}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            stage, latency['count'], latency['p50_ms'], latency['p95_ms'],
+            latency['p99_ms'])
+        previous = (baseline or {}).get('stages', {}).get(stage)
+        if previous and previous['p50_ms']:
+            line += '  p50 {:+.0%}'.format(
+                latency['p50_ms'] / previous['p50_ms'] - 1)
+        print(line)
+    for name, qps in report['throughput'].items():
+        line = '{:<15}{:>10.1f} queries/s'.format(name, qps)
+        previous = (baseline or {}).get('throughput', {}).get(name)
+        if previous:
+            line += '  {:+.0%}'.format(qps / previous - 1)
+        print(line)
+    print('failed queries: {}, sparql requests: {}, not recorded: {}'.format(
+        report['failed'], report['sparql']['requests'],
+        report['sparql']['misses']))
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    queries = test_queries(args.test_file) if args.test_file else []
+    if args.synthetic:
+        queries += synthetic_queries(args.synthetic, args.seed)
+
+    originals = instrument()
+    try:
+        if args.record_file:
+            count = record(queries, args.record_file, args.endpoint)
+            print('Recorded {} responses for {} queries in {}'.format(
+                count, len(queries), args.record_file))
+        else:
+            with open(args.responses_file, encoding='utf-8') as file:
+                responses = json.load(file)
+            server = start_stand_in(responses, args.delay / 1000)
+            try:
+                report = benchmark(queries, args.runs, args.workers)
+            finally:
+                server.shutdown()
+            report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                      'git_commit': git_commit(),
+                      'queries': len(queries),
+                      'runs': args.runs,
+                      'workers': args.workers,
+                      'delay_ms': args.delay,
+                      'sparql': {'requests': server.requests,
+                                 'misses': server.misses},
+                      **report}
+            with open(args.output_file, 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=2)
+
+            baseline = None
+            if args.baseline_file:
+                with open(args.baseline_file, encoding='utf-8') as file:
+                    baseline = json.load(file)
+            print_report(report, baseline)
+    finally:
+        restore(originals)
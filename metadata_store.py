@@ -0,0 +1,306 @@
+"""
+This module builds and reads a local SQLite store with the labels, titles,
+performers and a sample of songs of the artists and albums in the WASABI
+knowledge graph. recommender.py uses it to turn names into URIs and URIs
+back into names without a round-trip to the SPARQL endpoint for every result.
+The SPARQL endpoint is only used when the store has no answer.
+
+The store is built offline from the same turtle dumps that were used to
+create the embeddings (rdflib is needed for this):
+python metadata_store.py -artist artist.ttl -album album.ttl [-song song.ttl]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import threading
+from collections import defaultdict
+
+STORE_PATH = os.path.join('embeddings', 'metadata.db')
+# Maximum number of songs stored for each album and each performer
+SONG_SAMPLE_SIZE = 20
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+DCTERMS_TITLE = 'http://purl.org/dc/terms/title'
+MO_PERFORMER = 'http://purl.org/ontology/mo/performer'
+SCHEMA_ALBUM = 'http://schema.org/album'
+WSB = 'http://ns.inria.fr/wasabi/ontology/'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (uri TEXT PRIMARY KEY, label TEXT);
+CREATE TABLE IF NOT EXISTS albums (uri TEXT PRIMARY KEY, title TEXT,
+                                   performer TEXT);
+CREATE TABLE IF NOT EXISTS songs (uri TEXT, title TEXT, album TEXT,
+                                  performer TEXT);
+CREATE INDEX IF NOT EXISTS artists_label ON artists (label);
+CREATE INDEX IF NOT EXISTS albums_title ON albums (title);
+CREATE INDEX IF NOT EXISTS songs_title ON songs (title);
+CREATE INDEX IF NOT EXISTS songs_album ON songs (album);
+CREATE INDEX IF NOT EXISTS songs_performer ON songs (performer);
+"""
+
+_local = threading.local()
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-artist", "--artist_file", type=str, required=True,
+                        help="Turtle file with the artists")
+    parser.add_argument("-album", "--album_file", type=str, required=True,
+                        help="Turtle file with the albums")
+    parser.add_argument("-song", "--song_file", type=str, default=None,
+                        help="Turtle file with the songs")
+    parser.add_argument("-out", "--output_file", type=str,
+                        default=STORE_PATH,
+                        help="SQLite file to store the metadata in")
+
+    args = parser.parse_args()
+    return args
+
+
+def _connection():
+    """Returns a read-only connection to the store for the current thread.
+    Returns None if the store has not been built. The connection is reopened
+    when the store is rebuilt."""
+    try:
+        version = (STORE_PATH, os.stat(STORE_PATH).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    if getattr(_local, 'version', None) != version:
+        if getattr(_local, 'connection', None) is not None:
+            _local.connection.close()
+        _local.connection = sqlite3.connect(
+            'file:{}?mode=ro'.format(STORE_PATH), uri=True)
+        _local.version = version
+    return _local.connection
+
+
+def _fetch(sql, parameters=()):
+    """Runs a query on the store and returns all rows.
+    Returns an empty list if the store has not been built."""
+    connection = _connection()
+    if connection is None:
+        return []
+    return connection.execute(sql, parameters).fetchall()
+
+
+def _in_clause(items):
+    """Returns a '(?, ?, ...)' placeholder string for a list of items."""
+    return '(' + ', '.join('?' * len(items)) + ')'
+
+
+def find_artist_uris(name):
+    """Returns the URIs of the artists with the given name."""
+    return [row[0] for row in
+            _fetch('SELECT uri FROM artists WHERE label = ?', (name,))]
+
+
+def find_album_uris(title):
+    """Returns the URIs of the albums with the given title."""
+    return [row[0] for row in
+            _fetch('SELECT uri FROM albums WHERE title = ?', (title,))]
+
+
+def album_performers(title):
+    """Returns the URIs of the performers of the albums with the given
+    title."""
+    return [row[0] for row in
+            _fetch('SELECT DISTINCT performer FROM albums WHERE title = ? '
+                   'AND performer IS NOT NULL', (title,))]
+
+
+def artist_albums(name):
+    """Returns the URIs of the albums of the artists with the given name."""
+    return [row[0] for row in
+            _fetch('SELECT albums.uri FROM albums '
+                   'JOIN artists ON albums.performer = artists.uri '
+                   'WHERE artists.label = ?', (name,))]
+
+
+def artist_labels(uris):
+    """Returns the names of several artists at once.
+
+    Argument:
+    uris (list): List of artist URIs
+
+    Returns:
+    dict: URI as key and name as value, URIs that are not in the store are
+    left out"""
+    uris = [str(uri) for uri in uris]
+    if not uris:
+        return {}
+    rows = _fetch('SELECT uri, label FROM artists WHERE uri IN '
+                  + _in_clause(uris), uris)
+    return dict(rows)
+
+
+def album_descriptions(uris):
+    """Returns the title and performer name of several albums at once.
+
+    Argument:
+    uris (list): List of album URIs
+
+    Returns:
+    dict: URI as key and 'artist name - album title' as value, URIs that are
+    not in the store are left out"""
+    uris = [str(uri) for uri in uris]
+    if not uris:
+        return {}
+    rows = _fetch('SELECT albums.uri, artists.label, albums.title '
+                  'FROM albums JOIN artists ON albums.performer = artists.uri '
+                  'WHERE albums.uri IN ' + _in_clause(uris), uris)
+    return {uri: artist + ' - ' + title for uri, artist, title in rows}
+
+
+def song_album_title(song):
+    """Returns the title of an album the given song is featured on.
+    Returns None if the song is not in the store."""
+    rows = _fetch('SELECT albums.title FROM songs '
+                  'JOIN albums ON songs.album = albums.uri '
+                  'WHERE songs.title = ? LIMIT 1', (song,))
+    if rows:
+        return rows[0][0]
+
+
+def song_performer(song):
+    """Returns the name of the performer of the given song.
+    Returns None if the song is not in the store."""
+    rows = _fetch('SELECT artists.label FROM songs '
+                  'JOIN artists ON songs.performer = artists.uri '
+                  'WHERE songs.title = ? LIMIT 1', (song,))
+    if rows:
+        return rows[0][0]
+
+
+def random_song(uri, by='album', seed=None):
+    """Returns a random song from the stored sample of an album or performer.
+
+    Arguments:
+    uri (string): URI of the album or performer
+    by (string): 'album' or 'performer'
+    seed (int): Seed of the sampling, the same seed always gives the same
+    song for a URI. None for a different song every time.
+
+    Returns:
+    string: 'artist name - song title'
+    Returns None if there are no songs stored for the URI"""
+    column = 'album' if by == 'album' else 'performer'
+    rows = _fetch('SELECT artists.label, songs.title FROM songs '
+                  'JOIN artists ON songs.performer = artists.uri '
+                  'WHERE songs.{} = ? ORDER BY songs.rowid'
+                  .format(column), (str(uri),))
+    if rows:
+        if seed is None:
+            artist, title = random.choice(rows)
+        else:
+            artist, title = random.Random(
+                '{}:{}'.format(seed, uri)).choice(rows)
+        return artist + ' - ' + title
+
+
+def songs():
+    """Returns all stored songs.
+
+    Returns:
+    list of tuple: (uri, 'artist name - song title', album URI, performer
+    URI) for every song"""
+    return [(uri, artist + ' - ' + title, album, performer)
+            for uri, artist, title, album, performer in
+            _fetch('SELECT songs.uri, artists.label, songs.title, '
+                   'songs.album, songs.performer FROM songs '
+                   'JOIN artists ON songs.performer = artists.uri '
+                   'ORDER BY songs.rowid')]
+
+
+def _subjects_of_types(graph, types):
+    """Returns the set of subjects in a graph with one of the given types."""
+    from rdflib import URIRef
+    subjects = set()
+    for rdf_type in types:
+        subjects.update(str(s) for s in graph.subjects(URIRef(RDF_TYPE),
+                                                       URIRef(rdf_type)))
+    return subjects
+
+
+def _first_objects(graph, subjects, predicate):
+    """Returns the first object of a predicate for every subject."""
+    from rdflib import URIRef
+    values = {}
+    for s, o in graph.subject_objects(URIRef(predicate)):
+        s = str(s)
+        if s in subjects and s not in values:
+            values[s] = str(o)
+    return values
+
+
+def build_store(artist_file, album_file, song_file=None,
+                output_file=STORE_PATH):
+    """Builds the metadata store from turtle dumps of the knowledge graph.
+
+    Arguments:
+    artist_file (string): Turtle file with the artists
+    album_file (string): Turtle file with the albums
+    song_file (string): Turtle file with the songs, optional
+    output_file (string): SQLite file to store the metadata in"""
+    from rdflib import Graph
+
+    graph = Graph()
+    graph.parse(artist_file, format='turtle')
+    artists = _subjects_of_types(graph, [WSB + 'Artist_Person',
+                                         WSB + 'Artist_Group'])
+    labels = _first_objects(graph, artists, RDFS_LABEL)
+
+    graph = Graph()
+    graph.parse(album_file, format='turtle')
+    albums = _subjects_of_types(graph, [WSB + 'Album'])
+    titles = _first_objects(graph, albums, DCTERMS_TITLE)
+    performers = _first_objects(graph, albums, MO_PERFORMER)
+
+    songs = []
+    if song_file:
+        graph = Graph()
+        graph.parse(song_file, format='turtle')
+        song_uris = _subjects_of_types(graph, [WSB + 'Song'])
+        song_titles = _first_objects(graph, song_uris,
+                                     WSB + 'title_without_accent')
+        song_albums = _first_objects(graph, song_uris, SCHEMA_ALBUM)
+        song_performers = _first_objects(graph, song_uris, MO_PERFORMER)
+        # Only keep a sample of songs for every album and performer
+        per_album, per_performer = defaultdict(int), defaultdict(int)
+        for uri in sorted(song_titles):
+            album = song_albums.get(uri)
+            performer = song_performers.get(uri, performers.get(album))
+            if (per_album[album] < SONG_SAMPLE_SIZE or
+                    per_performer[performer] < SONG_SAMPLE_SIZE):
+                per_album[album] += 1
+                per_performer[performer] += 1
+                songs.append((uri, song_titles[uri], album, performer))
+    del graph
+
+    # Write to a temporary file first so readers never see a partial store
+    if os.path.exists(output_file + '.tmp'):
+        os.remove(output_file + '.tmp')
+    connection = sqlite3.connect(output_file + '.tmp')
+    connection.executescript(SCHEMA)
+    connection.executemany('INSERT OR REPLACE INTO artists VALUES (?, ?)',
+                           labels.items())
+    connection.executemany('INSERT OR REPLACE INTO albums VALUES (?, ?, ?)',
+                           [(uri, title, performers.get(uri))
+                            for uri, title in titles.items()])
+    connection.executemany('INSERT INTO songs VALUES (?, ?, ?, ?)', songs)
+    connection.commit()
+    connection.close()
+    os.replace(output_file + '.tmp', output_file)
+    return len(labels), len(titles), len(songs)
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    n_artists, n_albums, n_songs = build_store(args.artist_file,
+                                               args.album_file,
+                                               args.song_file,
+                                               args.output_file)
+    print(f'Stored {n_artists} artists, {n_albums} albums and '
+          f'{n_songs} songs in {args.output_file}')
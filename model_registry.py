@@ -0,0 +1,248 @@
+"""
+This module keeps the artifacts used by recommender.py (nearest neighbour
+index, entities and embeddings) loaded in memory, so they are read from disk
+only once per process instead of on every similarity query.
+
+The artifacts are shared between threads. The .npy arrays are memory-mapped,
+so several processes on the same machine share the same pages. When one of
+the files on disk changes, the artifact set is reloaded on the next lookup.
+
+Next to the entities array, a URI to row index is stored as
+<entity_type>_uri_index.pkl. It is (re)built when it is missing or older than
+the entities file. To build the indexes beforehand, use:
+python model_registry.py
+
+The artifacts can be versioned: every version is a complete artifact set in
+its own directory, embeddings/versions/<version>/, and the file
+embeddings/CURRENT names the version in use. A new version is published by
+replacing CURRENT, so the next lookup loads all files of the new version
+together and never mixes two versions. Without CURRENT, the artifacts are
+read from embeddings/ itself. See build_embeddings.py.
+
+numpy and similarity_index are imported on first use, so importing this
+module (and recommender.py) stays cheap for runs that never search.
+
+Usage:
+artifacts = get_artifacts('artist')
+row = uri_to_row('artist', artist_uri)
+"""
+
+import os
+import pickle
+import threading
+import time
+
+EMBEDDINGS_DIR = 'embeddings'
+# Nearest neighbour backend used for the similarity search, see
+# similarity_index. 'cosine' only needs the embeddings, 'brute' loads the
+# sklearn model trained in the notebooks.
+INDEX_BACKEND = 'cosine'
+# Minimum number of seconds between two checks of the files on disk
+CHECK_INTERVAL = 2.0
+# File with the name of the artifact version in use
+VERSION_FILE = 'CURRENT'
+VERSIONS_DIR = 'versions'
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def current_version():
+    """Returns the name of the artifact version in use, or None if the
+    artifacts are not versioned."""
+    try:
+        with open(os.path.join(EMBEDDINGS_DIR, VERSION_FILE), 'r') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def version_dir(version):
+    """Returns the directory of an artifact version, EMBEDDINGS_DIR for
+    None."""
+    if version is None:
+        return EMBEDDINGS_DIR
+    return os.path.join(EMBEDDINGS_DIR, VERSIONS_DIR, version)
+
+
+def artifact_dir():
+    """Returns the directory of the artifact version in use."""
+    return version_dir(current_version())
+
+
+def publish_version(version):
+    """Makes a version the one in use. Its directory must be complete, as
+    readers switch to it on their next check."""
+    path = os.path.join(EMBEDDINGS_DIR, VERSION_FILE)
+    with open(path + '.tmp', 'w') as file:
+        file.write(version + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def artifact_paths(entity_type, directory=None):
+    """Returns the paths of the artifacts of an entity type.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    directory (string): Directory of the artifacts, the version in use if
+    not given
+
+    Returns:
+    dict: Artifact name as key and path as value"""
+    directory = directory or artifact_dir()
+    paths = {
+        'entities': os.path.join(directory, f'{entity_type}_entities.npy'),
+        'embeddings': os.path.join(directory,
+                                   f'{entity_type}_embeddings.npy'),
+    }
+    # The normalized embeddings of the cosine backend are derived from the
+    # embeddings, the other backends are built separately
+    if INDEX_BACKEND != 'cosine':
+        import similarity_index
+        paths['index'] = similarity_index.index_path(entity_type,
+                                                     INDEX_BACKEND,
+                                                     directory)
+    return paths
+
+
+def uri_index_path(entity_type, directory=None):
+    """Returns the path of the persisted URI to row index of an entity type.
+    """
+    return os.path.join(directory or artifact_dir(),
+                        f'{entity_type}_uri_index.pkl')
+
+
+def build_uri_index(entity_type, directory=None):
+    """Builds the URI to row index of an entity type from its entities array
+    and stores it next to the entities file.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    directory (string): Directory of the artifacts, the version in use if
+    not given
+
+    Returns:
+    dict: URI as key and row in the entities/embeddings arrays as value"""
+    import numpy as np
+    entities = np.load(artifact_paths(entity_type, directory)['entities'],
+                       mmap_mode='r')
+    uri_index = {str(uri): row for row, uri in enumerate(entities)}
+    # Write to a temporary file first so readers never see a partial index
+    path = uri_index_path(entity_type, directory)
+    with open(path + '.tmp', 'wb') as index_file:
+        pickle.dump(uri_index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    return uri_index
+
+
+def load_uri_index(entity_type, directory=None):
+    """Loads the persisted URI to row index of an entity type. The index is
+    rebuilt when it is missing or older than the entities file."""
+    path = uri_index_path(entity_type, directory)
+    entities_path = artifact_paths(entity_type, directory)['entities']
+    if (not os.path.exists(path) or
+            os.stat(path).st_mtime_ns < os.stat(entities_path).st_mtime_ns):
+        return build_uri_index(entity_type, directory)
+    with open(path, 'rb') as index_file:
+        return pickle.load(index_file)
+
+
+def _modification_times(paths):
+    """Returns a tuple with every path and its modification time, so a
+    switch to another version is noticed as well."""
+    return tuple((path, os.stat(path).st_mtime_ns)
+                 for path in paths.values())
+
+
+def _load_artifacts(entity_type, paths, mtimes):
+    """Loads the artifacts from disk, memory-mapping the numpy arrays."""
+    import numpy as np
+    import similarity_index
+    # Load every artifact from the directory the paths were resolved in,
+    # even if another version was published in the meantime
+    directory = os.path.dirname(paths['embeddings'])
+    embeddings = np.load(paths['embeddings'], mmap_mode='r')
+    return {
+        'uri_index': load_uri_index(entity_type, directory),
+        'index': similarity_index.load_index(entity_type, INDEX_BACKEND,
+                                             embeddings, directory),
+        'entities': np.load(paths['entities'], mmap_mode='r'),
+        'embeddings': embeddings,
+        'mtimes': mtimes,
+        'checked': time.monotonic(),
+    }
+
+
+def get_artifacts(entity_type):
+    """Returns the loaded artifacts of an entity type. The artifacts are
+    loaded on first use and reloaded when the files on disk have changed.
+
+    Argument:
+    entity_type (string): 'artist' or 'album'
+
+    Returns:
+    dict: Dictionary with the keys 'index', 'entities', 'embeddings' and
+    'uri_index'
+    """
+    artifacts = _registry.get(entity_type)
+    if (artifacts is not None and
+            time.monotonic() - artifacts['checked'] < CHECK_INTERVAL):
+        return artifacts
+
+    paths = artifact_paths(entity_type)
+    mtimes = _modification_times(paths)
+    if artifacts is not None and artifacts['mtimes'] == mtimes:
+        artifacts['checked'] = time.monotonic()
+        return artifacts
+
+    with _lock:
+        # Another thread may have loaded the artifacts in the meantime
+        artifacts = _registry.get(entity_type)
+        if artifacts is None or artifacts['mtimes'] != mtimes:
+            artifacts = _load_artifacts(entity_type, paths, mtimes)
+            _registry[entity_type] = artifacts
+    return artifacts
+
+
+def uri_to_row(entity_type, uri):
+    """Returns the row of a URI in the entities and embeddings arrays.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    uri (string): URI of the entity
+
+    Returns:
+    int: Row of the URI
+    Returns None if the URI is not in the entities array"""
+    return get_artifacts(entity_type)['uri_index'].get(uri)
+
+
+def uris_to_rows(entity_type, uris):
+    """Returns the rows of several URIs at once.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    uris (list): List of URIs
+
+    Returns:
+    list: Row for every URI, None for URIs that are not in the entities array
+    """
+    uri_index = get_artifacts(entity_type)['uri_index']
+    return [uri_index.get(uri) for uri in uris]
+
+
+def row_to_uri(entity_type, row):
+    """Returns the URI stored at a row of the entities array."""
+    return str(get_artifacts(entity_type)['entities'][row])
+
+
+def clear():
+    """Removes all loaded artifacts from the registry."""
+    with _lock:
+        _registry.clear()
+
+
+if __name__ == '__main__':
+    for entity_type in ['artist', 'album']:
+        index = build_uri_index(entity_type)
+        print(f'Built {entity_type} URI index with {len(index)} entries')
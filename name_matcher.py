@@ -0,0 +1,240 @@
+"""
+This module finds names from the name dictionaries (artists, albums, songs,
+genres) in a user query.
+
+A matcher is built once from a name list and indexes every name by its
+lowercase text. To match a query, every part of the query that starts and
+ends on a word boundary (like \\b in a regular expression) and is not longer
+than the longest name is looked up in the index. Queries are short, so this
+takes a few hundred dictionary lookups, no matter how many names there are.
+
+The names of the dictionary files come from dictionaries. Their indexes are
+stored next to the .json file as <name>.matcher.pkl, and rebuilt when the
+.json file is newer or the index was stored in an older format.
+
+Queries with several names joined by 'and', ',' or '&' (e.g. "artists like
+Adele and Ed Sheeran") are handled by joined_matches.
+"""
+
+import bisect
+import os
+import pickle
+import re
+import threading
+import dictionaries
+
+# Text allowed between two names that are asked for together
+SEPARATOR = re.compile(r'(?:\s*(?:,|&|\+|\band\b|\bor\b|\bplus\b)\s*)+')
+_WORD = re.compile(r'\w+')
+# Version of the stored index, increase it when the stored keys change
+FORMAT_VERSION = 2
+STORED_KEYS = ['index', 'max_length', 'first_words', 'first_characters']
+
+_matchers = {}
+_lock = threading.Lock()
+
+
+def build_matcher(name_list):
+    """Builds a matcher from a list of names.
+
+    Argument:
+    name_list (list): List of names to match
+
+    Returns:
+    dict: Matcher with the names as 'names', an index from every lowercase
+    name to the position of the first name with that lowercase form as
+    'index', the length of the longest name as 'max_length' and the start
+    tables (see _start_tables) as 'first_words' and 'first_characters'"""
+    names = tuple(name_list)
+    index = {}
+    for i, name in enumerate(names):
+        index.setdefault(name.lower(), i)
+    max_length = max((len(name) for name in index), default=0)
+    first_words, first_characters = _start_tables(index)
+    return {'names': names, 'index': index, 'max_length': max_length,
+            'first_words': first_words,
+            'first_characters': first_characters}
+
+
+def _start_tables(index):
+    """Returns the first words of the lowercase names that start with a word
+    character, and the first characters of the other names. A part of a
+    query can only be a name if it starts with one of these, so most parts
+    are skipped without a lookup in the index."""
+    first_words = set()
+    first_characters = set()
+    for name in index:
+        word = _WORD.match(name)
+        if word:
+            first_words.add(word.group())
+        else:
+            first_characters.add(name[:1])
+    return first_words, first_characters
+
+
+def matcher_path(dictionary_file):
+    """Returns the path of the stored index of a name dictionary file."""
+    return os.path.splitext(dictionary_file)[0] + '.matcher.pkl'
+
+
+def _load_or_build(dictionary_file):
+    """Loads the stored index of a name dictionary file, building and
+    storing it when it is missing, older than the dictionary file or
+    stored in another format. The names themselves are shared with
+    dictionaries."""
+    names = dictionaries.get_names(dictionary_file)
+    path = matcher_path(dictionary_file)
+    if (os.path.exists(path) and
+            os.stat(path).st_mtime_ns >=
+            os.stat(dictionary_file).st_mtime_ns):
+        with open(path, 'rb') as matcher_file:
+            matcher = pickle.load(matcher_file)
+        if (isinstance(matcher, dict) and
+                matcher.get('version') == FORMAT_VERSION and
+                all(key in matcher for key in STORED_KEYS)):
+            matcher['names'] = names
+            return matcher
+    matcher = build_matcher(names)
+    stored = {key: matcher[key] for key in STORED_KEYS}
+    stored['version'] = FORMAT_VERSION
+    # Write to a temporary file first so readers never see a partial index
+    with open(path + '.tmp', 'wb') as matcher_file:
+        pickle.dump(stored, matcher_file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+    return matcher
+
+
+def get_matcher(dictionary_file):
+    """Returns the matcher of a name dictionary file. The matcher is loaded
+    once per process.
+
+    Argument:
+    dictionary_file (string): Name of a name dictionary, e.g. 'genres', or
+    the path of a .json file with a list of names
+
+    Returns:
+    dict: Matcher, see build_matcher"""
+    dictionary_file = dictionaries.dictionary_file(dictionary_file)
+    matcher = _matchers.get(dictionary_file)
+    if matcher is None:
+        with _lock:
+            matcher = _matchers.get(dictionary_file)
+            if matcher is None:
+                matcher = _load_or_build(dictionary_file)
+                _matchers[dictionary_file] = matcher
+    return matcher
+
+
+def _is_word_character(character):
+    """Returns True for the characters matched by \\w in a regular expression.
+    """
+    return character.isalnum() or character == '_'
+
+
+def _word_boundaries(text):
+    """Returns the positions in a text where \\b would match."""
+    boundaries = []
+    previous = False
+    for i, character in enumerate(text):
+        current = _is_word_character(character)
+        if current != previous:
+            boundaries.append(i)
+        previous = current
+    if previous:
+        boundaries.append(len(text))
+    return boundaries
+
+
+def find_matches(query, matcher, boundaries=None):
+    """Finds all names of a matcher in a query, overlapping matches included.
+
+    Arguments:
+    query (string): User query
+    matcher (dict): Matcher, see build_matcher
+    boundaries (list): Word boundaries of the lowercase query, if they are
+    already known (e.g. from query_parser)
+
+    Returns:
+    list of tuple: (start, end, name) for every match, where
+    query.lower()[start:end] is the matched text and name the name as
+    written in the name list.
+    Sorted by start position and then by length, longest first."""
+    names = matcher['names']
+    index = matcher['index']
+    max_length = matcher['max_length']
+    first_words = matcher.get('first_words')
+    first_characters = matcher.get('first_characters')
+    lowercase_query = query.lower()
+    if boundaries is None:
+        boundaries = _word_boundaries(lowercase_query)
+    matches = []
+    for i, start in enumerate(boundaries):
+        if first_words is not None:
+            # Boundaries alternate between the start and the end of a word
+            if i % 2 == 0:
+                if lowercase_query[start:boundaries[i + 1]] not in (
+                        first_words):
+                    continue
+            elif lowercase_query[start:start + 1] not in first_characters:
+                continue
+        last = bisect.bisect_right(boundaries, start + max_length, i + 1)
+        for end in reversed(boundaries[i + 1:last]):
+            position = index.get(lowercase_query[start:end])
+            if position is not None:
+                matches.append((start, end, names[position]))
+    return matches
+
+
+def longest_match(query, matcher):
+    """Returns the longest name of a matcher found in a query.
+
+    Arguments:
+    query (string): User query
+    matcher (dict): Matcher, see build_matcher
+
+    Returns:
+    string: Matched name as written in the name list
+    Returns None if there is no match"""
+    matches = find_matches(query, matcher)
+    if matches:
+        # Longest name first, earliest position on a tie
+        return max(matches, key=lambda match: (len(match[2]),
+                                               -match[0]))[2]
+
+
+def joined_matches(query, matcher):
+    """Returns the longest name of a matcher found in a query together with
+    the names joined to it by 'and', ',', '&', '+', 'or' or 'plus', such as
+    ['Adele', 'Ed Sheeran'] for "artists like Adele and Ed Sheeran".
+
+    Overlapping matches are resolved longest first, so a name that contains
+    'and' itself (e.g. 'Simon and Garfunkel') is kept whole.
+
+    Arguments:
+    query (string): User query
+    matcher (dict): Matcher, see build_matcher
+
+    Returns:
+    list: Matched names in the order of the query, [longest_match] if no
+    other names are joined to it
+    Returns an empty list if there is no match"""
+    selected = []
+    for match in sorted(find_matches(query, matcher),
+                        key=lambda match: (-len(match[2]), match[0])):
+        if all(match[1] <= start or match[0] >= end
+               for start, end, _ in selected):
+            selected.append(match)
+    if not selected:
+        return []
+    longest = selected[0]
+    selected.sort()
+    lowercase_query = query.lower()
+    first = last = selected.index(longest)
+    while first > 0 and SEPARATOR.fullmatch(
+            lowercase_query[selected[first - 1][1]:selected[first][0]]):
+        first -= 1
+    while last < len(selected) - 1 and SEPARATOR.fullmatch(
+            lowercase_query[selected[last][1]:selected[last + 1][0]]):
+        last += 1
+    return [name for _, _, name in selected[first:last + 1]]
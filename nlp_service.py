@@ -0,0 +1,115 @@
+"""
+This module finds locations in user queries with spaCy.
+
+The spaCy model is loaded once per process, on first use, with only the
+components needed for named entity recognition. Several queries can be
+processed at once with find_locations, which uses nlp.pipe.
+
+Optionally, the query is first matched against a gazetteer of country
+names (embeddings/Name dictionaries/countries.json), and the model is
+skipped when a country is found. Only names written with the same case and
+made of whole tokens match, so 'Georgia's' or 'chad' do not. The gazetteer
+still finds countries in names of people ('Chad Brock', 'Georgia Gibbs')
+that the model would not tag, so it is off unless USE_GAZETTEER is set, e.g.
+with the -gazetteer flag of recommender.py.
+"""
+
+import re
+import threading
+import name_matcher
+
+MODEL = 'en_core_web_sm'
+# Components that are not needed to find GPE entities
+DISABLED_COMPONENTS = ['tagger', 'parser', 'attribute_ruler', 'lemmatizer',
+                       'senter']
+GAZETTEER = 'countries'
+# Try the gazetteer before the spaCy model
+USE_GAZETTEER = False
+
+# Text between whitespace, without the punctuation around it
+_TOKEN = re.compile(r'[^\s.,!?;:()"]+(?:\.[^\s.,!?;:()"]+)*')
+
+_nlp = None
+_lock = threading.Lock()
+
+
+def get_nlp():
+    """Returns the spaCy pipeline, loading it on first use."""
+    global _nlp
+    if _nlp is None:
+        with _lock:
+            if _nlp is None:
+                import spacy
+                _nlp = spacy.load(MODEL, disable=DISABLED_COMPONENTS)
+    return _nlp
+
+
+def _gazetteer_location(query):
+    """Returns the longest country from the gazetteer found in a query, as
+    a case-sensitive match of whole tokens, or None."""
+    tokens = list(_TOKEN.finditer(query))
+    starts = {token.start() for token in tokens}
+    ends = {token.end() for token in tokens}
+    matches = [(start, end, name) for start, end, name in
+               name_matcher.find_matches(query,
+                                         name_matcher.get_matcher(GAZETTEER))
+               if start in starts and end in ends and
+               query[start:end] == name]
+    if matches:
+        return max(matches, key=lambda match: (len(match[2]),
+                                               -match[0]))[2]
+
+
+def _first_location(doc):
+    """Returns the text of the first GPE entity in a spaCy doc, or None."""
+    for ent in doc.ents:
+        if ent.label_ == 'GPE':
+            return ent.text
+
+
+def find_location(query, use_gazetteer=None):
+    """Takes in a query string and returns the first location (such as a
+    country) found in it.
+
+    Arguments:
+    query (string): User query
+    use_gazetteer (bool): If set to True, the gazetteer is tried before the
+    spaCy model, USE_GAZETTEER if not given
+
+    Returns:
+    string: Location found in string
+    Returns None if no location is found"""
+    if USE_GAZETTEER if use_gazetteer is None else use_gazetteer:
+        location = _gazetteer_location(query)
+        if location:
+            return location
+    return _first_location(get_nlp()(query))
+
+
+def find_locations(queries, use_gazetteer=None, batch_size=64):
+    """Returns the first location of every query, running the spaCy model
+    in batches over the queries the gazetteer has no answer for.
+
+    Arguments:
+    queries (list): List of user queries
+    use_gazetteer (bool): If set to True, the gazetteer is tried before the
+    spaCy model, USE_GAZETTEER if not given
+    batch_size (int): Number of queries per nlp.pipe batch
+
+    Returns:
+    list: Location of every query, None where no location is found"""
+    if use_gazetteer is None:
+        use_gazetteer = USE_GAZETTEER
+    locations = [None] * len(queries)
+    remaining = []
+    for i, query in enumerate(queries):
+        if use_gazetteer:
+            locations[i] = _gazetteer_location(query)
+        if not locations[i]:
+            remaining.append(i)
+    if remaining:
+        docs = get_nlp().pipe((queries[i] for i in remaining),
+                              batch_size=batch_size)
+        for i, doc in zip(remaining, docs):
+            locations[i] = _first_location(doc)
+    return locations
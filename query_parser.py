@@ -0,0 +1,248 @@
+"""
+This module finds the intent, the number and the genre of a user query at
+once, with patterns and tables that are compiled when the module is
+imported:
+- intent keywords, e.g. 'song' or 'artist', are found by one regular
+  expression. Like classify_intent in recommender.py, a keyword may be part
+  of a word ('songs') and song keywords win over artist keywords, which win
+  over album keywords;
+- digits and groups of number words are found by one regular expression,
+  the words are combined like text_to_num.alpha2digit does ('twenty five',
+  'two hundred and three', 'forty-two'). A single 'one' or 'zero' on its
+  own is not a number, as in 'one of the best';
+- the word boundaries of the query are found once and the genres are
+  looked up in the genre matcher (see name_matcher.py) from these
+  boundaries only.
+
+The result is a ParsedQuery with the (start, end) span in the query of
+every component found.
+
+To compare the parser with classify_intent, get_number and match_to_list of
+recommender.py on the queries of the test data, use:
+python query_parser.py [-test test_data.xlsx] [-repeat 100]
+"""
+
+import argparse
+import re
+import time
+from collections import namedtuple
+import name_matcher
+
+# Keywords of every intent, in order of priority
+INTENT_KEYWORDS = [
+    ('song', ['song', 'tune', 'track', 'ballad', 'composition']),
+    ('artist', ['artist', 'performer', 'musician', 'singer', 'anyone',
+                'anybody', 'someone', 'somebody']),
+    ('album', ['album', 'record', 'music']),
+]
+UNITS = {'zero': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+         'six': 6, 'seven': 7, 'eight': 8, 'nine': 9}
+TEENS = {'ten': 10, 'eleven': 11, 'twelve': 12, 'thirteen': 13,
+         'fourteen': 14, 'fifteen': 15, 'sixteen': 16, 'seventeen': 17,
+         'eighteen': 18, 'nineteen': 19}
+TENS = {'twenty': 20, 'thirty': 30, 'forty': 40, 'fifty': 50, 'sixty': 60,
+        'seventy': 70, 'eighty': 80, 'ninety': 90}
+MULTIPLIERS = {'hundred': 100, 'thousand': 1000, 'million': 1000000}
+# Ordinals that alpha2digit turns into numbers ('third' -> '3rd'), they
+# end a number
+ORDINALS = {'third': 3, 'fourth': 4, 'fifth': 5, 'sixth': 6, 'seventh': 7,
+            'eighth': 8, 'ninth': 9, 'tenth': 10, 'eleventh': 11,
+            'twelfth': 12}
+
+
+def _trie_pattern(words):
+    """Returns a regular expression matching any of the words, with the
+    alternatives nested by common prefix ('t(?:wo|h(?:ree|irty)...)'), so
+    the regular expression engine does not try every word at every
+    position."""
+    tree = {}
+    for word in words:
+        node = tree
+        for character in word:
+            node = node.setdefault(character, {})
+        node[''] = None
+
+    def render(node):
+        alternatives = [re.escape(character) + render(child)
+                        for character, child in sorted(node.items())
+                        if character]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        pattern = '(?:{})'.format('|'.join(alternatives))
+        return pattern + '?' if '' in node else pattern
+    return render(tree)
+
+
+_WORD = re.compile(r'\w+')
+_INTENT = re.compile(_trie_pattern(
+    [keyword for _, keywords in INTENT_KEYWORDS for keyword in keywords]))
+_KEYWORD_INTENTS = {keyword: (priority, intent)
+                    for priority, (intent, keywords)
+                    in enumerate(INTENT_KEYWORDS) for keyword in keywords}
+# Kind and value of every number word
+_NUMBER_WORDS = {}
+for _kind, _table in [('unit', UNITS), ('teen', TEENS), ('tens', TENS),
+                      ('multiplier', MULTIPLIERS), ('ordinal', ORDINALS)]:
+    for _word, _value in _table.items():
+        _NUMBER_WORDS[_word] = (_kind, _value)
+_NUMBER_WORD = _trie_pattern(_NUMBER_WORDS) + r'\b'
+# Digits, or number words separated by spaces or hyphens
+_NUMBER = re.compile(r'(\d+)|\b{0}(?:[ -]+(?:{0}|and\b))*'.format(
+    _NUMBER_WORD), re.IGNORECASE)
+# Kinds of number words that can follow a kind in the same number
+_FOLLOWERS = {
+    'unit': {'multiplier'},
+    'teen': {'multiplier'},
+    'tens': {'unit', 'multiplier', 'ordinal'},
+    'multiplier': {'unit', 'teen', 'tens', 'multiplier', 'ordinal'},
+    'and': {'unit', 'teen', 'tens', 'ordinal'},
+}
+
+ParsedQuery = namedtuple('ParsedQuery', [
+    'intent', 'intent_span', 'number', 'number_span', 'genre',
+    'genre_span'])
+ParsedQuery.__doc__ = """Components of a query found by parse.
+
+intent (string): 'song', 'artist', 'album' or None
+intent_span (tuple): (start, end) of the intent keyword, or None
+number (int): First number in the query, or None
+number_span (tuple): (start, end) of the number, or None
+genre (string): Longest genre as written in the genre list, or None
+genre_span (tuple): (start, end) of the genre, or None"""
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-test", "--test_file", type=str,
+                        default='test_data.xlsx',
+                        help="Test file with queries, should be .xlsx")
+    parser.add_argument("-repeat", "--repeat", type=int, default=100,
+                        help="Number of times every query is parsed")
+
+    args = parser.parse_args()
+    return args
+
+
+def _first_number(words):
+    """Combines consecutive number words into the first number they form.
+
+    Argument:
+    words (list): (word, start, end) of consecutive number words and 'and'
+
+    Returns:
+    tuple: The number and its (start, end), (None, None) if the words are
+    a single 'one' or 'zero'"""
+    number_words = [word for word, _, _ in words if word != 'and']
+    if len(number_words) == 1 and number_words[0] in ('one', 'zero'):
+        return None, None
+    total = current = 0
+    previous = None
+    end = None
+    for i, (word, _, word_end) in enumerate(words):
+        if word == 'and':
+            # 'and' only joins parts of a number, as in 'hundred and three'
+            if (previous not in ('tens', 'multiplier') or
+                    i + 1 == len(words)):
+                break
+            previous = 'and'
+            continue
+        kind, value = _NUMBER_WORDS[word]
+        if previous is not None and kind not in _FOLLOWERS.get(previous,
+                                                               ()):
+            break
+        if kind == 'multiplier':
+            if value == 100:
+                current = max(current, 1) * value
+            else:
+                total += max(current, 1) * value
+                current = 0
+        else:
+            current += value
+        previous = kind
+        end = word_end
+    return total + current, (words[0][1], end)
+
+
+def parse(query, genre_matcher=None):
+    """Finds the intent, the first number and the longest genre of a query.
+
+    Arguments:
+    query (string): User query
+    genre_matcher (dict): Matcher of the genres (see name_matcher), None to
+    skip the genres
+
+    Returns:
+    ParsedQuery: The components and their spans"""
+    intent = intent_span = None
+    priority = len(INTENT_KEYWORDS)
+    for keyword in _INTENT.finditer(query):
+        keyword_priority, keyword_intent = _KEYWORD_INTENTS[keyword.group()]
+        if keyword_priority < priority:
+            priority, intent = keyword_priority, keyword_intent
+            intent_span = keyword.span()
+            if not priority:
+                break
+
+    number = number_span = None
+    for match in _NUMBER.finditer(query):
+        if match.group(1):
+            number, number_span = int(match.group(1)), match.span()
+            break
+        words = [(word.group().lower(), word.start(), word.end())
+                 for word in _WORD.finditer(query, *match.span())]
+        number, number_span = _first_number(words)
+        if number is not None:
+            break
+
+    genre = genre_span = None
+    if genre_matcher is not None:
+        lowercase_query = query.lower()
+        boundaries = [position for word in _WORD.finditer(lowercase_query)
+                      for position in word.span()]
+        matches = name_matcher.find_matches(query, genre_matcher,
+                                            boundaries)
+        if matches:
+            start, end, genre = max(matches, key=lambda match: (
+                len(match[2]), -match[0]))
+            genre_span = (start, end)
+    return ParsedQuery(intent, intent_span, number, number_span, genre,
+                       genre_span)
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    import recommender
+
+    args = create_arg_parser()
+    queries = pd.read_excel(args.test_file, header=0)['true_query'].tolist()
+    genres = name_matcher.get_matcher('genres')
+
+    def current_functions(query):
+        return (recommender.classify_intent(query, ask=False),
+                recommender.get_number(query),
+                recommender.match_to_list(query, genres))
+
+    def single_pass(query):
+        parsed = parse(query, genres)
+        return parsed.intent, parsed.number, parsed.genre
+
+    results = {}
+    for name, function in [('current functions', current_functions),
+                           ('single pass parser', single_pass)]:
+        results[name] = [function(query) for query in queries]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for query in queries:
+                function(query)
+        seconds = time.perf_counter() - start
+        print('{:<20}{:10.1f} us per query'.format(
+            name, 1e6 * seconds / (args.repeat * len(queries))))
+
+    differences = [(query, current, parsed) for query, current, parsed
+                   in zip(queries, *results.values()) if current != parsed]
+    print('{} of {} queries parsed the same'.format(
+        len(queries) - len(differences), len(queries)))
+    for query, current, parsed in differences:
+        print('- {!r}: {} != {}'.format(query, current, parsed))
@@ -18,22 +18,45 @@ test data set (.xlsx) with the following columns: true_query, true_intent,
 true_number, true_type, true_entity, true_genre, true_location.
 
 To run the recommender as a chatbot, use:
-python recommender.py
+python recommender.py [-timeout 5]
+The chatbot prints every recommendation as soon as it is found (see
+async_recommender.iter_recommendations).
 
-To create an evaluation file, use:
+To create an evaluation file (.xlsx, .csv or .parquet, see evaluation.py),
+use:
 python recommender.py -eval [-out 'outfile.xlsx] [-test 'testfile.xlsx']
+[-workers 4] [-backend brute]
+
+To run the recommender as an HTTP/JSON service (see server.py), use:
+python recommender.py -serve [-host 127.0.0.1] [-port 8000] [-workers 4]
+[-cache_file embeddings/sparql_cache.db]
+
+The stages of every query (intent, parse, name match, location, entity
+lookup, knn, labels, songs, filter and the sparql requests) can be traced
+with -trace log, -trace prometheus or -trace otel, see tracing.py.
+
+Heavy dependencies (pandas, numpy, requests, spaCy) are imported on first
+use, so the chatbot prompt appears without waiting for them. Use
+startup_benchmark.py to measure the start-up time.
 """
 
-import click
-import requests
-import joblib
-import numpy as np
-import json
+import contextvars
 import re
-import spacy
-from text_to_num import alpha2digit
-import pandas as pd
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
 import argparse
+import metadata_store
+import model_registry
+import name_matcher
+import nlp_service
+import query_parser
+import sparql_client
+import tracing
+
+# Lookups shared by the queries of one evaluate_queries run, see memoized
+_run_memo = contextvars.ContextVar('run_memo', default=None)
+_run_lock = threading.Lock()
 
 
 def create_arg_parser():
@@ -43,20 +66,115 @@ def create_arg_parser():
                         help="Store results in excel file for evaluation.")
     parser.add_argument("-out", "--output_file", type=str,
                         default='results.xlsx',
-                        help=".xlsx output file to store results in")
+                        help="Output file to store results in (.xlsx, "
+                             ".csv or .parquet)")
     parser.add_argument("-test", "--test_file", type=str,
                         default='test_data.xlsx',
                         help="Test file with queries, should be .xlsx")
+    parser.add_argument("-workers", "--workers", type=int, default=4,
+                        help="Number of queries resolved at the same time "
+                             "during evaluation or by the service")
+    parser.add_argument("-serve", "--serve",
+                        action="store_true",
+                        help="Run the recommender as an HTTP/JSON service.")
+    parser.add_argument("-host", "--host", type=str, default='127.0.0.1',
+                        help="Address the service listens on")
+    parser.add_argument("-port", "--port", type=int, default=8000,
+                        help="Port the service listens on")
+    parser.add_argument("-timeout", "--timeout", type=float, default=None,
+                        help="Seconds after which the chatbot stops "
+                             "printing recommendations")
+    parser.add_argument("-backend", "--backend", type=str, default=None,
+                        choices=['cosine', 'brute', 'ivf', 'hnsw', 'int8'],
+                        help="Nearest neighbour backend, e.g. brute for "
+                             "the exact neighbours of an evaluation "
+                             "reference")
+    parser.add_argument("-cache_file", "--cache_file", type=str,
+                        default=None,
+                        help="SQLite file that keeps the cached sparql "
+                             "results over restarts")
+    parser.add_argument("-gazetteer", "--gazetteer",
+                        action="store_true",
+                        help="Look up countries in the gazetteer before "
+                             "running spaCy. Faster, but countries in names "
+                             "of people (e.g. Chad Brock) are taken as "
+                             "locations.")
+    parser.add_argument("-trace", "--trace", type=str, default=None,
+                        choices=['log', 'prometheus', 'otel'],
+                        help="Trace the stages of every query and export "
+                             "them as log lines, Prometheus metrics or "
+                             "OpenTelemetry spans")
 
     args = parser.parse_args()
     return args
 
 
-def classify_intent(query):
+def memoized(function):
+    """Decorator sharing the results of a function between the queries of
+    one evaluate_queries run, keyed on its arguments. Outside a run, the
+    function is called every time. Concurrent calls with the same
+    arguments wait for the first one."""
+    @wraps(function)
+    def wrapper(*args):
+        memo = _run_memo.get()
+        if memo is None:
+            return function(*args)
+        key = (function.__name__,) + args
+        with _run_lock:
+            future = memo.get(key)
+            first = future is None
+            if first:
+                future = memo[key] = Future()
+        if first:
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+        return future.result()
+    return wrapper
+
+
+def _labels(kind, uris, local_lookup, fetch):
+    """Returns the labels of URIs from the local store, with one batched
+    sparql query for the URIs that are not in it. Within an
+    evaluate_queries run, every URI is looked up once.
+
+    Arguments:
+    kind (string): Kind of label, e.g. 'artist'
+    uris (list): URIs to find the labels of
+    local_lookup (function): Lookup in the local store
+    fetch (function): Lookup at the sparql endpoint
+
+    Returns:
+    dict: URI as key and label as value, for the URIs that were found"""
+    memo = _run_memo.get()
+    known = {}
+    if memo is not None:
+        with _run_lock:
+            known = {uri: memo[('labels', kind, uri)] for uri in uris
+                     if ('labels', kind, uri) in memo}
+    todo = [uri for uri in uris if uri not in known]
+    labels = local_lookup(todo) if todo else {}
+    missing = [uri for uri in todo if uri not in labels]
+    if missing:
+        # One batched query for all missing labels
+        labels.update(fetch(missing))
+    if memo is not None:
+        with _run_lock:
+            for uri in todo:
+                memo[('labels', kind, uri)] = labels.get(uri)
+    labels.update(known)
+    return {uri: label for uri, label in labels.items()
+            if label is not None}
+
+
+@tracing.traced('intent')
+def classify_intent(query, ask=True):
     """Returns the intent of a given user query.
 
-    Argument:
+    Arguments:
     query (string): User query
+    ask (bool): If set to False, None is returned when no intent is found
 
     Returns:
     string: 'album', 'artist' or 'song'
@@ -73,58 +191,38 @@ def classify_intent(query):
         return 'artist'
     elif any(keyword in query for keyword in ['album', 'record', 'music']):
         return 'album'
-    else:
+    elif ask:
+        import click
         follow_up = click.prompt(
             "Sorry, I didn't understand. Please rephrase your request.\n",
             type=str,
             prompt_suffix='>')
-        classify_intent(follow_up)
+        return classify_intent(follow_up)
 
 
+@tracing.traced('name match')
 def match_to_list(query, name_list):
     """Checks if an item from the list is found in the query and
     returns this item if so.
 
     Argument:
     query (string): User query
-    name_list (list): List of items to match
+    name_list (list or dict): List of items to match, or a matcher built
+    from it by name_matcher
 
     Returns:
-    string: Matched item from given list
+    string: Matched item from given list, the longest one if there are
+    several matches
     Returns None if there is no match
     """
-
-    # Convert name_list to lowercase for case-insensitive matching
-    lowercase_name_list = [name.lower() for name in name_list]
-    # Regular expression to match names
-    pattern = r'\b(?:' + '|'.join(re.escape(name) for name in
-                                  lowercase_name_list) + r')\b'
-
-    # convert query to lowercase
-    lowercase_query = query.lower()
-
-    # Initialize list of matches
-    matches = []
-    # find matches
-    matches_lower = re.findall(pattern, lowercase_query)
-    if matches_lower:
-        # convert lowercase matches back to proper name via list indexes
-        for i in range(len(matches_lower)):
-            matched_index = lowercase_name_list.index(matches_lower[i])
-            matches.append(name_list[matched_index])
-
-    # make matches consist of only unique items
-    matches = list(set(matches))
-    if len(matches) == 1:
-        return matches[0]
-    elif len(matches) > 1:
-        # assume the longest matching string is the target
-        match = max(matches, key=len)
-        return match
+    if isinstance(name_list, dict):
+        matcher = name_list
     else:
-        return None
+        matcher = name_matcher.build_matcher(name_list)
+    return name_matcher.longest_match(query, matcher)
 
 
+@tracing.traced('number')
 def get_number(query):
     """Takes in a query string and returns any numbers found in the query
     (both as digits or text) as an integer.
@@ -136,6 +234,7 @@ def get_number(query):
     integer: The first number found in the given query
     Returns None if no number is found
     """
+    from text_to_num import alpha2digit
     # Convert textual representations of numbers into digits
     digitsquery = alpha2digit(query, lang="en")
     # Use regular expression to find all integer-like patterns in the query
@@ -145,6 +244,7 @@ def get_number(query):
         return numbers[0]  # Return the first found number
 
 
+@tracing.traced('location')
 def get_location(query):
     """Takes in a query string and returns any locations such as country
     found in the string
@@ -155,29 +255,14 @@ def get_location(query):
     Returns:
     string: Location found in string
     Returns None if no location is found"""
-    # Returns the first location found in a query
-    nlp = spacy.load('en_core_web_sm')
-    doc = nlp(query)
-    locations = [ent.text for ent in doc.ents if ent.label_ == 'GPE']
-    if locations:
-        return locations[0]
-
-
-def find_similar_artist(artist, number=1, return_uri=False):
-    """Finds similar artists based on given artist using embeddings.
+    # Returns the first location found in a query, the spaCy model is
+    # loaded once by the nlp service
+    return nlp_service.find_location(query)
 
-    Arguments:
-    artist (string): Name of artist that similar artists should be based on.
-    number (int): Number of similar artist that should be returned.
-    return_uri (bool): If set to True, a list of URIs is returned.
 
-    Returns:
-    if return_uri=False:
-        list: List of artist names.
-    if return_uri=True:
-        list: List of artist URIs."""
-    # Find artist URI to find embedding
-    sparql_query = """
+def artist_uri_query(artist):
+    """Returns the sparql query for the URIs of the artists with a name."""
+    return """
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
 
@@ -194,56 +279,11 @@ def find_similar_artist(artist, number=1, return_uri=False):
             }}
         }}
         """.format(artist=artist)
-    results = query_sparql_endpoint(sparql_query)
-    if results:
-        artistURI = results[0]["artistURI"]["value"]
-        # Load in trained knn model, entities and embeddings
-        knn_model = joblib.load('embeddings/artist_knn_model.pkl')
-        entities = np.load('embeddings/artist_entities.npy')
-        embeddings = np.load('embeddings/artist_embeddings.npy')
-        # Find embedding of given artist and use this to find similar
-        # artist uris with knn model
-        query_embedding = (
-            embeddings[np.argmax(entities == artistURI)]
-            .reshape(1, -1)
-        )
-        _, indices = knn_model.kneighbors(query_embedding,
-                                          n_neighbors=number+1)
-        sim_uris = [entities[i] for i in indices][0][1:]
-        if not return_uri:
-            # Turn uris back into artist names through sparql query
-            sim_artists = []
-            for uri in sim_uris:
-                sparql_query = """
-                    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-                    SELECT ?name
-                    WHERE {{
-                    <{artistURI}> rdfs:label ?name .
-                        }}
-                    """.format(artistURI=uri)
-                artist = query_sparql_endpoint(sparql_query)
-                sim_artists.append(artist[0]['name']['value'])
-            return sim_artists
-        else:
-            return sim_uris
 
 
-def find_similar_album(album, number=1, return_uri=False):
-    """Finds similar albums based on given album using embeddings.
-
-    Arguments:
-    album (string): Title of album that similar albums should be based on.
-    number (int): Number of similar albums that should be returned.
-    return_uri (bool): If set to True, a list of URIs is returned.
-
-    Returns:
-    if return_uri=False:
-        list: List of items in the form of: artist name - album title.
-    if return_uri=True:
-        list: List of album URIs."""
-    # Find album URI to find embedding
-    sparql_query = """
+def album_uri_query(album):
+    """Returns the sparql query for the URIs of the albums with a title."""
+    return """
         PREFIX dcterms: <http://purl.org/dc/terms/>
         PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
 
@@ -254,60 +294,12 @@ def find_similar_album(album, number=1, return_uri=False):
         }}
 
         """.format(album=album)
-    results = query_sparql_endpoint(sparql_query)
-    if results:
-        albumURI = results[0]["albumURI"]["value"]
-        # Load in trained knn model, entities and embeddings
-        knn_model = joblib.load('embeddings/album_knn_model.pkl')
-        entities = np.load('embeddings/album_entities.npy')
-        embeddings = np.load('embeddings/album_embeddings.npy')
-        # Find embedding of given artist and use this to find similar
-        # artist uris with knn model
-        query_embedding = (
-            embeddings[np.argmax(entities == albumURI)]
-            .reshape(1, -1)
-        )
-        _, indices = knn_model.kneighbors(query_embedding,
-                                          n_neighbors=number+1)
-        sim_uris = [entities[i] for i in indices][0][1:]
-        # Turn uris back into artist names through sparql query
-        sim_albums = []
-        if not return_uri:
-            for uri in sim_uris:
-                sparql_query = """
-                PREFIX dcterms:  <http://purl.org/dc/terms/>
-                PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
-                PREFIX mo: <http://purl.org/ontology/mo/>
-                PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-                SELECT ?title ?artist
-                WHERE {{
-                <{albumURI}> a wsb:Album;
-                    dcterms:title ?title ;
-                    mo:performer ?performer .
-                ?performer rdfs:label ?artist .
-                }}""".format(albumURI=uri)
-                album = query_sparql_endpoint(sparql_query)
-                sim_albums.append(album[0]['artist']['value'] +
-                                  ' - ' + album[0]['title']['value'])
-            return sim_albums
-        else:
-            return sim_uris
 
 
-def find_similar_song(song, number=1):
-    """Finds similar songs based on the album the song is featured on.
-    If song is not featured on an album, recommendation will be based on
-    the artist that performed the song.
-
-    Arguments:
-    song (string): Title of song that similar songs should be based on.
-    number (int): Number of similar songs that should be returned.
-
-    Returns:
-    list: List of items in the form of: artist name - song title."""
-    # Find title of the album the songs is featured on.
-    sparql_query = """
+def song_album_query(song):
+    """Returns the sparql query for the title of the album a song is
+    featured on."""
+    return """
     PREFIX dcterms:  <http://purl.org/dc/terms/>
     PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
     PREFIX mo: <http://purl.org/ontology/mo/>
@@ -321,79 +313,364 @@ def find_similar_song(song, number=1):
         ?albumURI dcterms:title ?album .
     }}
     LIMIT 1""".format(song=song)
-    album = query_sparql_endpoint(sparql_query)[0]['album']['value']
-    # If an album is found, find a song from each similar album
-    if album:
-        album_uris = find_similar_album(album=album,
-                                        number=number,
-                                        return_uri=True)
-        similar_songs = []
-        for uri in album_uris:
-            sparql_query = """
-                PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
-                PREFIX schema: <http://schema.org/>
-                PREFIX mo: <http://purl.org/ontology/mo/>
-                PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-                PREFIX dcterms: <http://purl.org/dc/terms/>
-
-                SELECT DISTINCT ?song ?artist
-                WHERE {{
-                    ?songURI a wsb:Song;
-                        schema:album <{uri}> ;
-                        wsb:title_without_accent ?song .
-                    <{uri}> mo:performer ?performerURI .
-                    ?performerURI rdfs:label ?artist .
-                }}
-                ORDER BY RAND()
-                LIMIT 1""".format(uri=uri)
-            results = query_sparql_endpoint(sparql_query)
-            if results:
-                similar_songs.append(results[0]['artist']['value'] +
-                                     ' - ' + results[0]['song']['value'])
-        return similar_songs
-    else:
-        # If no album was found, try to find performer of the song
-        sparql_query = """
-        PREFIX dcterms:  <http://purl.org/dc/terms/>
+
+
+def song_performer_query(song):
+    """Returns the sparql query for the name of the performer of a song."""
+    return """
+    PREFIX dcterms:  <http://purl.org/dc/terms/>
+    PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
+    PREFIX mo: <http://purl.org/ontology/mo/>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+    SELECT DISTINCT ?performer
+    WHERE {{
+        ?songURI a wsb:Song;
+            wsb:title_without_accent "{song}";
+            mo:performer ?performerURI.
+        ?performerURI rdfs:label ?performer .
+    }}
+    LIMIT 1""".format(song=song)
+
+
+def random_song_query(uri, by='album'):
+    """Returns the sparql query for a random song of an album or performer.
+
+    Arguments:
+    uri (string): URI of the album or performer
+    by (string): 'album' or 'performer'"""
+    if by == 'album':
+        return """
+            PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
+            PREFIX schema: <http://schema.org/>
+            PREFIX mo: <http://purl.org/ontology/mo/>
+            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+            PREFIX dcterms: <http://purl.org/dc/terms/>
+
+            SELECT DISTINCT ?song ?artist
+            WHERE {{
+                ?songURI a wsb:Song;
+                    schema:album <{uri}> ;
+                    wsb:title_without_accent ?song .
+                <{uri}> mo:performer ?performerURI .
+                ?performerURI rdfs:label ?artist .
+            }}
+            ORDER BY RAND()
+            LIMIT 1""".format(uri=uri)
+    return """
         PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
         PREFIX mo: <http://purl.org/ontology/mo/>
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
-        SELECT DISTINCT ?performer
+        SELECT DISTINCT ?song ?artist
         WHERE {{
             ?songURI a wsb:Song;
-                wsb:title_without_accent "{song}";
-                mo:performer ?performerURI.
-            ?performerURI rdfs:label ?performer .
+                mo:performer <{uri}> ;
+                wsb:title_without_accent ?song .
+            <{uri}> rdfs:label ?artist .
         }}
-        LIMIT 1""".format(song=song)
-        performer = query_sparql_endpoint(sparql_query)[0]['performer']['value']
-        # If a performer is found find a song from each similar performer
-        if performer:
-            performer_uris = find_similar_artist(artist=performer,
-                                                 number=number,
-                                                 return_uri=True)
-            similar_songs = []
-            for uri in performer_uris:
-                sparql_query = """
-                    PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
-                    PREFIX mo: <http://purl.org/ontology/mo/>
-                    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-                    SELECT DISTINCT ?song ?artist
-                    WHERE {{
-                        ?songURI a wsb:Song;
-                            mo:performer <{uri}> ;
-                            wsb:title_without_accent ?song .
-                        <{uri}> rdfs:label ?artist .
-                    }}
-                    ORDER BY RAND()
-                    LIMIT 1""".format(uri=uri)
-                results = query_sparql_endpoint(sparql_query)
-                if results:
-                    similar_songs.append(results[0]['artist']['value'] +
-                                         ' - ' + results[0]['song']['value'])
-            return similar_songs
+        ORDER BY RAND()
+        LIMIT 1""".format(uri=uri)
+
+
+def song_from_results(results):
+    """Turns the results of a random song query into 'artist - song'.
+    Returns None if there are no results."""
+    if results:
+        return (results[0]['artist']['value'] +
+                ' - ' + results[0]['song']['value'])
+
+
+def _first_value(results, variable):
+    """Returns the value of a variable in the first result of a sparql
+    query, or None if there are no results."""
+    if results:
+        return results[0][variable]['value']
+
+
+def entity_uris(entity_type, name):
+    """Finds the URIs of an artist or album by name, in the local store if
+    possible and otherwise through the sparql endpoint.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    name (string): Name of the artist or title of the album
+
+    Returns:
+    list: List of URIs"""
+    if entity_type == 'artist':
+        uris = metadata_store.find_artist_uris(name)
+        if not uris:
+            results = query_sparql_endpoint(artist_uri_query(name))
+            uris = [result['artistURI']['value'] for result in results]
+    else:
+        uris = metadata_store.find_album_uris(name)
+        if not uris:
+            results = query_sparql_endpoint(album_uri_query(name))
+            uris = [result['albumURI']['value'] for result in results]
+    return uris
+
+
+@tracing.traced('entity lookup')
+def song_album(song):
+    """Returns the title of an album the song is featured on, or None."""
+    album = metadata_store.song_album_title(song)
+    if not album:
+        album = _first_value(query_sparql_endpoint(song_album_query(song)),
+                             'album')
+    return album
+
+
+@tracing.traced('entity lookup')
+def song_performer_name(song):
+    """Returns the name of the performer of the song, or None."""
+    performer = metadata_store.song_performer(song)
+    if not performer:
+        performer = _first_value(
+            query_sparql_endpoint(song_performer_query(song)), 'performer')
+    return performer
+
+
+def as_seeds(entity_type, entity):
+    """Returns the seeds of a similarity query as (type, name) pairs.
+
+    Arguments:
+    entity_type (string): Type of the recommendations
+    entity (string, list or tuple): A name, or several names and
+    (type, name) pairs, where a name is of the same type as the
+    recommendations
+
+    Returns:
+    list: List of (type, name) pairs"""
+    if isinstance(entity, str):
+        entity = [entity]
+    return [seed if isinstance(seed, tuple) else (entity_type, seed)
+            for seed in entity]
+
+
+@memoized
+@tracing.traced('entity lookup')
+def seed_rows(entity_type, seed_type, name):
+    """Finds the rows in the embeddings of an entity type that represent a
+    seed of a similarity query.
+
+    A seed of the same type is represented by the first of its URIs that
+    has an embedding. The artist and album embeddings are separate spaces,
+    so a seed of the other type is represented by the entities it is linked
+    to in the local store: an album by its performers and an artist by its
+    albums. A song is represented by its album or performer.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    seed_type (string): 'artist', 'album' or 'song'
+    name (string): Name or title of the seed
+
+    Returns:
+    list: Rows in the embeddings, empty if the seed is not found"""
+    if seed_type == 'song':
+        if entity_type == 'album':
+            name = song_album(name)
+        else:
+            name = song_performer_name(name)
+        seed_type = entity_type
+        if not name:
+            return []
+    if seed_type == entity_type:
+        uris = entity_uris(entity_type, name)
+    elif entity_type == 'artist':
+        uris = metadata_store.album_performers(name)
+    else:
+        uris = metadata_store.artist_albums(name)
+    rows = [row for row in model_registry.uris_to_rows(entity_type, uris)
+            if row is not None]
+    return rows[:1] if seed_type == entity_type else rows
+
+
+@tracing.traced('knn')
+def nearest_to_seeds(entity_type, rows_per_seed, number, weights=None):
+    """Finds the URIs of the entities closest to the centroid of one or more
+    seeds with a single nearest neighbour search, leaving out the seeds.
+
+    Every seed is the mean of the normalized embeddings of its rows, so
+    all seeds count the same no matter the length of their embeddings.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    rows_per_seed (list): Rows in the embeddings of every seed, see
+    seed_rows
+    number (int): Number of URIs that should be returned
+    weights (list): Weight of every seed, None for the mean
+
+    Returns:
+    list: List of URIs
+    Returns an empty list if none of the seeds has an embedding"""
+    import numpy as np
+    import similarity_index
+    if weights is None:
+        weights = [1] * len(rows_per_seed)
+    seeds = [(rows, weight) for rows, weight in zip(rows_per_seed, weights)
+             if rows]
+    if not seeds:
+        return []
+    # Get nearest neighbour index, entities and embeddings from the
+    # registry
+    artifacts = model_registry.get_artifacts(entity_type)
+    embeddings = artifacts['embeddings']
+    vectors = [similarity_index.normalize(embeddings[sorted(rows)])
+               .mean(axis=0) for rows, _ in seeds]
+    centroid = np.average(vectors, axis=0,
+                          weights=[weight for _, weight in seeds])
+    exclude = sorted({row for rows, _ in seeds for row in rows})
+    _, indices = artifacts['index'].search(centroid.reshape(1, -1), number,
+                                           exclude=exclude)
+    return [artifacts['entities'][i] for i in indices[0]]
+
+
+def similar_uris(entity_type, entity, number, weights=None):
+    """Finds the URIs of the artists or albums most similar to all seeds of
+    a similarity query together.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    entity (string, list or tuple): Seeds, see as_seeds
+    number (int): Number of URIs that should be returned
+    weights (list): Weight of every seed, None for the mean
+
+    Returns:
+    list: List of URIs"""
+    rows_per_seed = [seed_rows(entity_type, seed_type, name)
+                     for seed_type, name in as_seeds(entity_type, entity)]
+    return nearest_to_seeds(entity_type, rows_per_seed, number, weights)
+
+
+def find_similar_artist(artist, number=1, return_uri=False, weights=None):
+    """Finds similar artists based on given artist using embeddings.
+
+    Arguments:
+    artist (string, list or tuple): Name of artist that similar artists
+    should be based on, or several seeds (see as_seeds).
+    number (int): Number of similar artist that should be returned.
+    return_uri (bool): If set to True, a list of URIs is returned.
+    weights (list): Weight of every seed, None for the mean.
+
+    Returns:
+    if return_uri=False:
+        list: List of artist names.
+    if return_uri=True:
+        list: List of artist URIs."""
+    sim_uris = similar_uris('artist', artist, number, weights)
+    if return_uri:
+        return sim_uris
+    # Turn uris back into artist names, through a sparql query for the
+    # names that are not in the local store
+    with tracing.span('labels'):
+        labels = _labels('artist', sim_uris, metadata_store.artist_labels,
+                         sparql_client.fetch_labels)
+    return [labels[uri] for uri in sim_uris if uri in labels]
+
+
+def find_similar_album(album, number=1, return_uri=False, weights=None):
+    """Finds similar albums based on given album using embeddings.
+
+    Arguments:
+    album (string, list or tuple): Title of album that similar albums
+    should be based on, or several seeds (see as_seeds).
+    number (int): Number of similar albums that should be returned.
+    return_uri (bool): If set to True, a list of URIs is returned.
+    weights (list): Weight of every seed, None for the mean.
+
+    Returns:
+    if return_uri=False:
+        list: List of items in the form of: artist name - album title.
+    if return_uri=True:
+        list: List of album URIs."""
+    sim_uris = similar_uris('album', album, number, weights)
+    if return_uri:
+        return sim_uris
+    # Turn uris back into artist names and album titles, through a sparql
+    # query for the albums that are not in the local store
+    with tracing.span('labels'):
+        descriptions = _labels('album', sim_uris,
+                               metadata_store.album_descriptions,
+                               sparql_client.fetch_album_descriptions)
+    return [descriptions[uri] for uri in sim_uris if uri in descriptions]
+
+
+@tracing.traced('songs')
+def indexed_songs(uris, by='album', seed=None):
+    """Picks a song for every album or performer from the local song index
+    (see song_index.py).
+
+    Arguments:
+    uris (list): URIs of the albums or performers
+    by (string): 'album' or 'performer'
+    seed (int): Seed of the sampling, song_index.SEED if not given
+
+    Returns:
+    list: 'artist name - song title' for every URI, None for the URIs that
+    have no songs in the index
+    Returns None if the song index has not been built"""
+    import song_index
+    entity_type = 'album' if by == 'album' else 'artist'
+    if song_index.get_index(entity_type) is None:
+        return None
+    rows = model_registry.uris_to_rows(entity_type, uris)
+    return song_index.sample_songs(entity_type, rows, seed)
+
+
+def find_similar_song(song, number=1, seed=None):
+    """Finds similar songs based on the album the song is featured on.
+    If song is not featured on an album, recommendation will be based on
+    the artist that performed the song.
+
+    A song is picked for every similar album or performer from the local
+    song index, or from the metadata store if the index has not been
+    built. Albums and performers without a local song get one through the
+    sparql endpoint.
+
+    Arguments:
+    song (string, list or tuple): Title of song that similar songs should
+    be based on, or titles of several songs.
+    number (int): Number of similar songs that should be returned.
+    seed (int): Seed of the song sampling, the same seed gives the same
+    songs.
+
+    Returns:
+    list: List of items in the form of: artist name - song title."""
+    songs = [song] if isinstance(song, str) else list(song)
+    # If albums are found, find a song from each album similar to all of
+    # them. If no album was found, find a song from each performer similar
+    # to the performers of the songs
+    albums = [album for album in map(song_album, songs) if album]
+    if albums:
+        by = 'album'
+        uris = find_similar_album(albums, number=number, return_uri=True)
+    else:
+        by = 'performer'
+        performers = [performer for performer
+                      in map(song_performer_name, songs) if performer]
+        if not performers:
+            return []
+        uris = find_similar_artist(performers, number=number,
+                                   return_uri=True)
+    if not uris:
+        return []
+    indexed = indexed_songs(uris, by=by, seed=seed)
+    with tracing.span('songs'):
+        if indexed is not None:
+            songs = dict(zip(uris, indexed))
+        else:
+            songs = {uri: metadata_store.random_song(uri, by=by, seed=seed)
+                     for uri in uris}
+        # Query the endpoint concurrently for the uris without a local
+        # song
+        missing = [uri for uri in uris if not songs[uri]]
+        sparql_queries = [random_song_query(uri, by=by) for uri in missing]
+        for uri, results in zip(missing,
+                                sparql_client.query_many(sparql_queries)):
+            songs[uri] = song_from_results(results)
+    similar_songs = [songs[uri] for uri in uris if songs[uri]]
+    return similar_songs
 
 
 def list_to_sparql(input_list):
@@ -474,146 +751,244 @@ def SPARQL_builder(query_type, filters, number):
         return query
 
 
-def get_recommendations(query):
-    """Prints out song, artist or album recommendations based on a given query
+def parse_query(query, intent=None, location=None):
+    """Finds the components of a query: intent, number, type (similarity or
+    filter query), entity, genre and location.
 
     Arguments:
-    user_query (string): User query
-    eval (bool): If set to True, function will return a list containing:
-        for similarity queries: [intent, number, sim, entity]
-        for filter queries: [intent, number, fil, genre, location]
+    query (string): User query
+    intent (string): Intent of the query, if it was already classified.
+    If not given, it is classified with classify_intent.
+    location (string): Location found in the query, if it was already
+    found (e.g. for a batch of queries with nlp_service.find_locations),
+    or '' if the query is known to have no location. If not given, it is
+    found with get_location when needed.
 
-    Returns: results if eval=False
-    Returns: eval list including results if eval=True
+    Returns:
+    list: [intent, number, type, entity, genre, location], where type is
+    'sim' for similarity queries, 'fil' for filter queries and 'unk' if
+    the query could not be understood. The entity of a similarity query
+    based on several names (e.g. "artists like Adele and Ed Sheeran") is a
+    tuple of these names.
     """
-
-    intent = classify_intent(query)
-    number = get_number(query)
-    genre, location, q_type = None, None, None
-
+    # Find the intent, number and genre in one pass over the query
+    with tracing.span('parse'):
+        parsed = query_parser.parse(query,
+                                    name_matcher.get_matcher('genres'))
+    if intent is None:
+        # Ask the user to rephrase the request if there is no intent
+        intent = parsed.intent or classify_intent(query)
+
+    number = parsed.number
     if not number:
         number = 3
 
+    # Check if there are genres in the query
+    genre = None
+    if intent in ['artist', 'album', 'song']:
+        genre = parsed.genre
+
+    # Only artist queries can be filtered on location
+    if intent == 'artist':
+        if location is None:
+            location = get_location(query)
+        location = location or None
+    else:
+        location = None
+
+    if genre or location:
+        return [intent, number, 'fil', None, genre, location]
+
+    # Without filters, check for an entity to base the recommendations on
+    dictionary = {'artist': 'artistnames',
+                  'album': 'albumtitles',
+                  'song': 'songtitles'}.get(intent)
+    if dictionary:
+        with tracing.span('name match'):
+            names = name_matcher.joined_matches(
+                query, name_matcher.get_matcher(dictionary))
+        if names:
+            entity = names[0] if len(names) == 1 else tuple(names)
+            return [intent, number, 'sim', entity, None, None]
+    return [None, None, 'unk', None, None, None]
+
+
+def resolve_query(parsed_query):
+    """Finds the recommendations for a parsed query.
+
+    Argument:
+    parsed_query (list): Query components as returned by parse_query
+
+    Returns:
+    list: List of recommendations
+    """
+    intent, number, q_type, entity, genre, location = parsed_query
     recommendations = []
 
-    if intent == "artist":
-        filters = []
-        # Check if there are genres in the query and if so add them
-        # to filters dict
-        with open('embeddings/Name dictionaries/genres.json',
-                  'r') as json_file:
-            genre_list = json.load(json_file)
-        genre = match_to_list(query, genre_list)
+    if q_type == 'sim':
+        if intent == 'artist':
+            similar = find_similar_artist(entity, number)
+        elif intent == 'album':
+            similar = find_similar_album(entity, number)
+        else:
+            similar = find_similar_song(entity, number)
+        recommendations.extend(similar)
+
+    elif q_type == 'fil':
+        # Use the local filter index if it has been built, otherwise
+        # build sparql query and get results
+        with tracing.span('filter'):
+            results = indexed_filter_results(parsed_query)
+            if results is None:
+                results = filter_results(
+                    intent, number, query_sparql_endpoint(filter_query(
+                        parsed_query)))
+        recommendations.extend(results)
+
+    return recommendations
+
+
+def indexed_filter_results(parsed_query, seed=None):
+    """Answers a filter query from the local filter index (see
+    filter_index.py), without a sparql query.
+
+    Arguments:
+    parsed_query (list): Query components as returned by parse_query
+    seed (int): Seed of the sampling, None for different results every time
+
+    Returns:
+    list: List of recommendations
+    Returns None if the filter index has not been built"""
+    import filter_index
+    intent, number, _, _, genre, location = parsed_query
+    return filter_index.sample(intent, genre, location, number, seed)
 
+
+def filter_query(parsed_query):
+    """Builds the sparql query for a parsed filter query.
+
+    Argument:
+    parsed_query (list): Query components as returned by parse_query
+
+    Returns:
+    string: Sparql query"""
+    intent, number, _, _, genre, location = parsed_query
+    filters = []
+    if intent == 'artist':
         if genre:
             filters.append("schema:genre '{}'".format(genre))
-
-        # Check for location
-        location = get_location(query)
         if location:
             filters.append('wsb:location [ wsb:country "{}" ]'.format(
                             location))
+    elif intent == 'album':
+        filters.append("mo:genre '{}'".format(genre))
+    else:
+        # Make sure genre is added last in the filters for songs
+        filters.append("schema:album ?album. ?album mo:genre '{}'"
+                       .format(genre))
+    return SPARQL_builder(intent, filters, number)
 
-        # Build sparql query and get results
-        if filters:
-            q_type = 'fil'
-            results = query_sparql_endpoint(SPARQL_builder('artist',
-                                            filters, number))
-            if results:
-                for i, name_obj in enumerate(results):
-                    if i <= number:
-                        name = name_obj['Name']['value']
-                        entity = name
-                        recommendations.append(name)
-        else:
-            with open('embeddings/Name dictionaries/artistnames.json',
-                      'r') as json_file:
-                artist_list = json.load(json_file)
-            artist = match_to_list(query, artist_list)
-            if artist:
-                q_type = 'sim'
-                entity = artist
-                similar = find_similar_artist(artist, number)
-                for artist in similar:
-                    recommendations.append(artist)
-
-    elif intent == "album":
-        filters = []
-        # Check if there are genres in the query and if so add them
-        # to filters dict
-        with open('embeddings/Name dictionaries/genres.json',
-                  'r') as json_file:
-            genre_list = json.load(json_file)
-        genre = match_to_list(query, genre_list)
 
-        if genre:
-            filters.append("mo:genre '{}'".format(genre))
-
-        # Build sparql query and get results
-        if filters:
-            q_type = 'fil'
-            results = query_sparql_endpoint(SPARQL_builder('album',
-                                            filters, number))
-            if results:
-                for i, name_obj in enumerate(results):
-                    if i <= number:
-                        artist = name_obj['artist']['value']
-                        title = name_obj['title']['value']
-                        recommendations.append(artist + ' - ' + title)
-        else:
-            with open('embeddings/Name dictionaries/albumtitles.json',
-                      'r') as json_file:
-                album_list = json.load(json_file)
-            album = match_to_list(query, album_list)
-            if album:
-                q_type = 'sim'
-                entity = album
-                similar = find_similar_album(album, number)
-                for album in similar:
-                    recommendations.append(album)
-    elif intent == "song":
-        filters = []
-        # Check if there are genres in the query and if so add them
-        # to filters dict
-        # Make sure genre is added last in the dict for songs
-        with open('embeddings/Name dictionaries/genres.json',
-                  'r') as json_file:
-            genre_list = json.load(json_file)
-        genre = match_to_list(query, genre_list)
+def filter_results(intent, number, results):
+    """Turns the results of a filter query into recommendations.
 
-        if genre:
-            filters.append("schema:album ?album. ?album mo:genre '{}'"
-                           .format(genre))
-
-        # Build sparql query and get results
-        if filters:
-            q_type = 'fil'
-            results = query_sparql_endpoint(SPARQL_builder('song',
-                                            filters, number))
-            if results:
-                for i, name_obj in enumerate(results):
-                    if i <= number:
-                        artist = name_obj['artist']['value']
-                        title = name_obj['title']['value']
-                        recommendations.append(artist + ' - ' + title)
-        else:
-            with open('embeddings/Name dictionaries/songtitles.json',
-                      'r') as json_file:
-                song_list = json.load(json_file)
-            song = match_to_list(query, song_list)
-            if song:
-                q_type = 'sim'
-                entity = song
-                similar = find_similar_song(song, number)
-                for song in similar:
-                    recommendations.append(song)
+    Arguments:
+    intent (string): 'artist', 'album' or 'song'
+    number (int): Number of recommendations
+    results (list): Results returned by the sparql endpoint
+
+    Returns:
+    list: List of recommendations"""
+    recommendations = []
+    if results:
+        for i, name_obj in enumerate(results):
+            if i <= number:
+                if intent == 'artist':
+                    recommendations.append(name_obj['Name']['value'])
+                else:
+                    artist = name_obj['artist']['value']
+                    title = name_obj['title']['value']
+                    recommendations.append(artist + ' - ' + title)
+    return recommendations
 
-    if q_type == 'sim':
-        return [intent, number, q_type, entity, None, None, recommendations]
-    if q_type == 'fil':
-        return [intent, number, q_type, None, genre, location, recommendations]
-    else:
-        return [None, None, 'unk', None, None, None, []]
+
+def get_recommendations(query):
+    """Finds song, artist or album recommendations based on a given query
+
+    Argument:
+    query (string): User query
+
+    Returns:
+    list: [intent, number, type, entity, genre, location, results]
+        for similarity queries: [intent, number, 'sim', entity, None, None,
+        results]
+        for filter queries: [intent, number, 'fil', None, genre, location,
+        results]
+        if the query is not understood: [None, None, 'unk', None, None, None,
+        []]
+    """
+    with tracing.trace('recommendation', query=query):
+        parsed_query = parse_query(query)
+        return parsed_query + [resolve_query(parsed_query)]
+
+
+def evaluate_queries(queries, workers=4):
+    """Gets the recommendations for a batch of queries.
+
+    All queries are parsed up front, with the locations of the batch found
+    in one pass of the spaCy pipeline. Identical similarity queries are
+    resolved once, the seeds and labels shared by several queries are
+    looked up once (see memoized), and the resolving (sparql queries and
+    nearest neighbour search) runs on a thread pool.
+
+    The user is never asked to rephrase a query, queries without an intent
+    get the type 'unk' and no recommendations.
+
+    Arguments:
+    queries (list): List of user queries
+    workers (int): Maximum number of queries resolved at the same time
+
+    Returns:
+    list: Result of get_recommendations for every query, in the same order
+    """
+    # Parse all queries, finding the locations of all artist queries in
+    # the batch at once
+    intents = [classify_intent(query, ask=False) for query in queries]
+    artist_queries = [query for query, intent in zip(queries, intents)
+                      if intent == 'artist']
+    found = iter(nlp_service.find_locations(artist_queries))
+    parsed_queries = []
+    for query, intent in zip(queries, intents):
+        if intent is None:
+            parsed_queries.append([None, None, 'unk', None, None, None])
+            continue
+        location = (next(found) or '') if intent == 'artist' else None
+        parsed_queries.append(parse_query(query, intent, location))
+
+    # Similarity queries with the same components have the same results,
+    # filter queries are sampled randomly and are resolved every time
+    tasks = {}
+    keys = []
+    for i, parsed_query in enumerate(parsed_queries):
+        if parsed_query[2] == 'sim':
+            key = tuple(parsed_query)
+        else:
+            key = i
+        tasks.setdefault(key, parsed_query)
+        keys.append(key)
+
+    token = _run_memo.set({})
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # Every worker runs in a copy of the context, they all share
+            # the lookups of this run
+            futures = {key: executor.submit(contextvars.copy_context().run,
+                                            resolve_query, parsed_query)
+                       for key, parsed_query in tasks.items()}
+            return [parsed_query + [list(futures[key].result())]
+                    for parsed_query, key in zip(parsed_queries, keys)]
+    finally:
+        _run_memo.reset(token)
 
 
 def query_sparql_endpoint(query):
@@ -627,47 +1002,72 @@ def query_sparql_endpoint(query):
     A dictionary contains variables returned by the sparql endbpoint as keys
     and the results as values.
     """
-    url = 'http://wasabi.inria.fr/sparql'
-    results = requests.get(url,
-                           params={'query': query, 'format': 'json'}).json()
-    return results['results']['bindings']
+    return sparql_client.query(query)
 
 
 if __name__ == '__main__':
     args = create_arg_parser()
-
-    if not args.eval:
+    if args.trace:
+        if args.trace == 'log':
+            import logging
+            logging.basicConfig(level=logging.INFO, format='%(message)s')
+        try:
+            sink = tracing.create_sink(args.trace)
+        except ImportError:
+            raise SystemExit('recommender.py: error: -trace otel needs the '
+                             'OpenTelemetry API (pip install '
+                             'opentelemetry-api)')
+        tracing.configure([sink])
+    if args.backend:
+        model_registry.INDEX_BACKEND = args.backend
+    if args.gazetteer:
+        nlp_service.USE_GAZETTEER = True
+    if args.cache_file:
+        import sparql_cache
+        sparql_cache.configure(disk_path=args.cache_file)
+
+    if args.serve:
+        import server
+        server.run(args.host, args.port, args.workers)
+    elif not args.eval:
+        import click
         query = click.prompt('Hi! How can I help?\n',
                              type=str,
                              prompt_suffix='>')
-        results = get_recommendations(query)
-
-        if results:
-            if results[2] == 'sim':
-                print('Here are {} {}s similar to {}:'.format(results[1],
-                                                              results[0],
-                                                              results[3]))
-            else:
-                genre, location = '', ''
-                if results[3]:
-                    genre = 'with genre {}'.format(results[3])
-                if results[4]:
-                    location = 'from {}'.format(results[4])
-                print('Here are {} {}s'.format(results[1],
-                      results[0]), genre, location, ':')
-            for result in results[-1]:
-                print('-', result)
-        else:
+        import async_recommender
+        with tracing.trace('recommendation', query=query):
+            parsed_query = parse_query(query)
+            intent, number, q_type, entity, genre, location = parsed_query
+            if q_type == 'sim':
+                if not isinstance(entity, str):
+                    entity = ' and '.join(entity)
+                print('Here are {} {}s similar to {}:'.format(number,
+                                                              intent,
+                                                              entity))
+            elif q_type == 'fil':
+                genre = 'with genre {}'.format(genre) if genre else ''
+                location = 'from {}'.format(location) if location else ''
+                print('Here are {} {}s'.format(number, intent), genre,
+                      location, ':')
+            # Print every recommendation as soon as it is found
+            found = 0
+            for result in async_recommender.iter_recommendations(
+                    parsed_query, timeout=args.timeout):
+                print('-', result, flush=True)
+                found += 1
+        if not found:
             print('I could not find anything based on your request.')
+        for sink in tracing.sinks():
+            if isinstance(sink, tracing.PrometheusSink):
+                print(sink.render(), end='')
     else:
+        import pandas as pd
         # Read in test data
         test_df = pd.read_excel(args.test_file, header=0)
 
         # Get eval lists for each recommendation
         queries = test_df['true_query'].tolist()
-        results = []
-        for query in queries:
-            results.append(get_recommendations(query))
+        results = evaluate_queries(queries, workers=args.workers)
 
         result_df = pd.DataFrame(results, columns=['pred_intent',
                                                    'pred_number',
@@ -694,4 +1094,5 @@ if __name__ == '__main__':
                                  result_df['pred_location'],
                                  result_df['pred_results']], axis=1)
 
-        combined_df.to_excel(args.output_file)
+        import evaluation
+        evaluation.write_results(combined_df, args.output_file)
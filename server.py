@@ -0,0 +1,265 @@
+"""
+This module runs the recommender as a long-running HTTP/JSON service, so
+models, dictionaries and caches stay loaded between queries.
+
+Endpoints:
+GET /health                 The process is up.
+GET /ready                  200 once all artifacts are loaded, 503 before.
+GET /recommend?query=...    Recommendations for a query.
+POST /recommend             Same, with a JSON body: {"query": "..."}
+GET /recommend?query=...&stream=1
+POST /recommend             {"query": "...", "stream": true}
+                            Streams the recommendations as newline
+                            delimited JSON: a line with the query
+                            components, then a line {"result": "..."} for
+                            every recommendation as soon as it is found.
+                            Closing the connection early cancels the
+                            lookups that are still running.
+GET /metrics                Sparql cache counters (see sparql_cache.py) in
+                            the Prometheus text format, with the stage
+                            timings and sparql counters when the service
+                            runs with -trace prometheus (see tracing.py).
+
+A recommendation is returned as:
+{"intent": "artist", "number": 3, "type": "sim", "entity": "Ed Sheeran",
+ "genre": null, "location": null, "results": ["...", "...", "..."]}
+
+To start the service, use:
+python recommender.py -serve [-host 127.0.0.1] [-port 8000] [-workers 4]
+"""
+
+import asyncio
+import inspect
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+import async_recommender
+import model_registry
+import name_matcher
+import nlp_service
+import recommender
+import sparql_cache
+import tracing
+
+FIELDS = ['intent', 'number', 'type', 'entity', 'genre', 'location',
+          'results']
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error',
+           503: 'Service Unavailable'}
+# Maximum size of a request body in bytes
+MAX_BODY = 64 * 1024
+
+_status = {'ready': False, 'loaded': [], 'errors': {},
+           'warm_up_seconds': None}
+
+
+def warm_up():
+    """Loads all artifacts the recommender needs, recording progress in
+    the readiness status. Artifacts that fail to load are reported in the
+    status instead of stopping the service."""
+    start = time.perf_counter()
+    steps = [('artist artifacts',
+              partial(model_registry.get_artifacts, 'artist')),
+             ('album artifacts',
+              partial(model_registry.get_artifacts, 'album')),
+             ('spaCy model', nlp_service.get_nlp)]
+    for name in ['genres', 'artistnames', 'albumtitles', 'songtitles',
+                 'countries']:
+        steps.append((name, partial(name_matcher.get_matcher, name)))
+    for name, step in steps:
+        try:
+            step()
+            _status['loaded'].append(name)
+        except Exception as error:
+            _status['errors'][name] = repr(error)
+    _status['warm_up_seconds'] = round(time.perf_counter() - start, 3)
+    _status['ready'] = not _status['errors']
+
+
+def recommend(query):
+    """Returns the recommendations for a query as a dictionary. Unlike the
+    chatbot, the user is never asked to rephrase the query."""
+    with tracing.trace('recommendation', query=query):
+        intent = recommender.classify_intent(query, ask=False)
+        if intent is None:
+            result = [None, None, 'unk', None, None, None, []]
+        else:
+            parsed_query = recommender.parse_query(query, intent)
+            result = parsed_query + [recommender.resolve_query(
+                parsed_query)]
+    return dict(zip(FIELDS, result))
+
+
+async def recommend_stream(query, executor):
+    """Yields the query components of a query as a dictionary, and then
+    every recommendation as {"result": "..."} as soon as it is found.
+
+    Arguments:
+    query (string): User query
+    executor (ThreadPoolExecutor): Executor the query is parsed in"""
+    with tracing.trace('recommendation', query=query):
+        intent = recommender.classify_intent(query, ask=False)
+        parsed_query = [None, None, 'unk', None, None, None]
+        if intent is not None:
+            loop = asyncio.get_running_loop()
+            parsed_query = await loop.run_in_executor(
+                executor, tracing.wrap(recommender.parse_query), query,
+                intent)
+        yield dict(zip(FIELDS[:-1], parsed_query))
+        if intent is None:
+            return
+        stream = async_recommender.resolve_query_stream(parsed_query)
+        try:
+            async for result in stream:
+                yield {'result': result}
+        finally:
+            await stream.aclose()
+
+
+async def _read_request(reader):
+    """Reads an HTTP request and returns the method, path, query
+    parameters and body."""
+    request_line = (await reader.readline()).decode('latin-1').split()
+    if len(request_line) != 3:
+        raise ValueError('Malformed request line')
+    method, target, _ = request_line
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY:
+        raise ValueError('Request body too large')
+    body = await reader.readexactly(length) if length else b''
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query), body
+
+
+def _write_response(writer, status, content):
+    """Writes a JSON response, or a plain text response if the content is
+    a string, and closes the connection afterwards."""
+    if isinstance(content, str):
+        body = content.encode('utf-8')
+        content_type = 'text/plain; version=0.0.4'
+    else:
+        body = json.dumps(content).encode('utf-8')
+        content_type = 'application/json'
+    writer.write(('HTTP/1.1 {} {}\r\n'
+                  'Content-Type: {}\r\n'
+                  'Content-Length: {}\r\n'
+                  'Connection: close\r\n\r\n').format(
+                      status, REASONS[status], content_type,
+                      len(body)).encode('latin-1'))
+    writer.write(body)
+
+
+async def _write_stream(writer, lines):
+    """Writes every item of an async generator as a JSON line as soon as
+    it is available. The response has no length, it ends when the
+    connection is closed. If the client disconnects, the generator is
+    closed, which cancels the lookups that are still running."""
+    writer.write(('HTTP/1.1 200 OK\r\n'
+                  'Content-Type: application/x-ndjson\r\n'
+                  'Connection: close\r\n\r\n').encode('latin-1'))
+    try:
+        async for line in lines:
+            writer.write((json.dumps(line) + '\n').encode('utf-8'))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    except Exception as error:
+        writer.write((json.dumps({'error': repr(error)}) +
+                      '\n').encode('utf-8'))
+        await writer.drain()
+    finally:
+        await lines.aclose()
+
+
+async def handle_request(method, path, parameters, body, executor):
+    """Returns the status code and JSON content of the response to a
+    request. The content of a streamed response is an async generator of
+    JSON lines."""
+    if path == '/health':
+        return 200, {'status': 'ok'}
+    if path == '/ready':
+        content = dict(_status)
+        return (200 if _status['ready'] else 503), content
+    if path == '/metrics':
+        metrics = [sink.render() for sink in tracing.sinks()
+                   if isinstance(sink, tracing.PrometheusSink)]
+        return 200, ''.join(metrics) + sparql_cache.render_metrics()
+    if path != '/recommend':
+        return 404, {'error': 'Unknown path {}'.format(path)}
+
+    if method == 'GET':
+        query = parameters.get('query', [None])[0]
+        stream = parameters.get('stream', ['0'])[0].lower() in ('1',
+                                                                'true')
+    elif method == 'POST':
+        try:
+            content = json.loads(body or b'{}')
+            query = content.get('query')
+            stream = bool(content.get('stream'))
+        except (ValueError, AttributeError):
+            return 400, {'error': 'Body should be a JSON object'}
+    else:
+        return 405, {'error': 'Use GET or POST'}
+    if not isinstance(query, str) or not query.strip():
+        return 400, {'error': 'Missing query'}
+
+    if stream:
+        return 200, recommend_stream(query, executor)
+    loop = asyncio.get_running_loop()
+    return 200, await loop.run_in_executor(executor, recommend, query)
+
+
+async def _serve_connection(reader, writer, executor):
+    """Handles one connection with one request."""
+    try:
+        try:
+            request = await _read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            _write_response(writer, 400, {'error': str(error)})
+        else:
+            try:
+                status, content = await handle_request(*request, executor)
+            except Exception as error:
+                status, content = 500, {'error': repr(error)}
+            if inspect.isasyncgen(content):
+                await _write_stream(writer, content)
+                return
+            _write_response(writer, status, content)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=8000, workers=4):
+    """Starts the service and warms it up in the background.
+
+    Arguments:
+    host (string): Address to listen on
+    port (int): Port to listen on
+    workers (int): Maximum number of queries resolved at the same time"""
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    threading.Thread(target=warm_up, daemon=True).start()
+    server = await asyncio.start_server(
+        lambda reader, writer: _serve_connection(reader, writer, executor),
+        host, port)
+    print('Serving recommendations on http://{}:{}'.format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def run(host='127.0.0.1', port=8000, workers=4):
+    """Runs the service until it is interrupted."""
+    try:
+        asyncio.run(serve(host, port, workers))
+    except KeyboardInterrupt:
+        pass
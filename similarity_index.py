@@ -0,0 +1,606 @@
+"""
+This module contains the nearest neighbour indexes used to find similar
+artists and albums. Every index has the same interface:
+
+index = CosineIndex.build(embeddings)
+index.save(path)
+index = load_index(entity_type, 'cosine')
+distances, indices = index.search(query_embeddings, k, exclude=[row])
+index.update(embeddings, rows)  # after rows were changed or appended
+
+search returns cosine distances and rows in the same format as
+NearestNeighbors.kneighbors, so the indexes can be swapped without changing
+the output of the recommender. Rows given in exclude (e.g. the query entity
+itself) are left out of the results.
+
+The NumPy backends use a copy of the embeddings that is L2-normalized and
+stored as float32 in <entity_type>_embeddings_normalized.npy. It is created
+when it is missing or older than the embeddings.
+
+Backends:
+cosine: exact search in pure NumPy, a single matrix-vector product over the
+    normalized embeddings followed by np.argpartition.
+brute: exact search with the sklearn NearestNeighbors model from the
+    notebooks, this is the reference for the other backends.
+ivf: inverted file index in pure NumPy. The embeddings are clustered with
+    spherical k-means and only the n_probe clusters closest to the query are
+    searched. More clusters probed means a higher recall and a slower search.
+hnsw: hierarchical navigable small world graph, needs hnswlib. A higher ef
+    means a higher recall and a slower search.
+int8: scalar quantization in pure NumPy. Every dimension is stored as an
+    int8 code, a quarter of the memory of float32. The codes are scanned to
+    find rerank * k candidates, which are re-ranked with the full precision
+    normalized embeddings. Those stay memory-mapped on disk, so only the
+    rows of the candidates are read. Several server workers then keep a
+    quarter of the matrix in memory instead of all of it.
+
+To build an index and compare it to brute force search (recall@k, latency
+and memory footprint), use:
+python similarity_index.py -type artist -backend ivf [-n_lists 256]
+[-n_probe 8] [-k 10] [-dir embeddings/versions/v0002]
+The index is stored with the artifact version in use (see model_registry),
+unless another directory is given with -dir.
+python similarity_index.py -type artist -backend int8 [-rerank 10]
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+
+EMBEDDINGS_DIR = 'embeddings'
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-type", "--entity_type", type=str, default='artist',
+                        choices=['artist', 'album'],
+                        help="Entity type to build the index for")
+    parser.add_argument("-backend", "--backend", type=str, default='ivf',
+                        choices=sorted(BACKENDS),
+                        help="Index backend to build")
+    parser.add_argument("-n_lists", "--n_lists", type=int, default=None,
+                        help="ivf: number of clusters")
+    parser.add_argument("-n_probe", "--n_probe", type=int, default=8,
+                        help="ivf: number of clusters searched per query")
+    parser.add_argument("-M", "--M", type=int, default=16,
+                        help="hnsw: number of links per node")
+    parser.add_argument("-ef", "--ef", type=int, default=64,
+                        help="hnsw: size of the candidate list at search time")
+    parser.add_argument("-rerank", "--rerank", type=int, default=10,
+                        help="int8: candidates re-ranked per neighbour")
+    parser.add_argument("-k", "--k", type=int, default=10,
+                        help="Number of neighbours for the recall report")
+    parser.add_argument("-queries", "--queries", type=int, default=500,
+                        help="Number of queries for the recall report")
+    parser.add_argument("-dir", "--directory", type=str, default=None,
+                        help="Directory of the embeddings and the index, "
+                             "the artifact version in use if not given")
+
+    args = parser.parse_args()
+    return args
+
+
+def normalize(embeddings):
+    """Returns L2-normalized float32 copies of the embeddings, so the cosine
+    similarity of two rows is their dot product."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def normalized_path(entity_type, directory=None):
+    """Returns the path of the normalized embeddings of an entity type."""
+    return os.path.join(directory or EMBEDDINGS_DIR,
+                        f'{entity_type}_embeddings_normalized.npy')
+
+
+def load_normalized(entity_type, directory=None):
+    """Loads the normalized embeddings of an entity type memory-mapped,
+    creating them when they are missing or older than the embeddings."""
+    path = normalized_path(entity_type, directory)
+    embeddings_path = os.path.join(directory or EMBEDDINGS_DIR,
+                                   f'{entity_type}_embeddings.npy')
+    if (not os.path.exists(path) or
+            os.stat(path).st_mtime_ns < os.stat(embeddings_path).st_mtime_ns):
+        vectors = normalize(np.load(embeddings_path, mmap_mode='r'))
+        # Write to a temporary file first so readers never see a partial file
+        with open(path + '.tmp', 'wb') as vectors_file:
+            np.save(vectors_file, vectors)
+        os.replace(path + '.tmp', path)
+    return np.load(path, mmap_mode='r')
+
+
+def _remove_excluded(distances, indices, exclude, k):
+    """Removes the excluded rows from search results that were asked for
+    k + len(exclude) neighbours, keeping the first k of every query."""
+    if exclude is None or len(exclude) == 0:
+        return distances[:, :k], indices[:, :k]
+    keep = ~np.isin(indices, exclude)
+    kept_distances, kept_indices = [], []
+    for row_distances, row_indices, row_keep in zip(distances, indices, keep):
+        kept_distances.append(row_distances[row_keep][:k])
+        kept_indices.append(row_indices[row_keep][:k])
+    return np.array(kept_distances), np.array(kept_indices)
+
+
+def top_k(similarities, k):
+    """Returns the positions of the k highest similarities of every row,
+    sorted from high to low."""
+    k = min(k, similarities.shape[1])
+    if k < similarities.shape[1]:
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(similarities.shape[1]),
+                             (similarities.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(similarities, candidates, axis=1),
+                       axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def _updated_vectors(vectors, embeddings, rows):
+    """Returns normalized vectors for all embeddings, normalizing only the
+    given rows (changed or appended) again."""
+    updated = np.empty((len(embeddings), embeddings.shape[1]),
+                       dtype=np.float32)
+    updated[:len(vectors)] = vectors[:len(embeddings)]
+    updated[rows] = normalize(embeddings[rows])
+    return updated
+
+
+class CosineIndex:
+    """Exact cosine search over normalized float32 embeddings.
+
+    Argument:
+    vectors (array): L2-normalized float32 embeddings"""
+    name = 'cosine'
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, embeddings):
+        return cls(normalize(embeddings))
+
+    def save(self, path):
+        np.save(path, self.vectors)
+
+    @classmethod
+    def load(cls, path, vectors=None):
+        return cls(np.load(path, mmap_mode='r'))
+
+    def search(self, query_embeddings, k, exclude=None):
+        queries = normalize(query_embeddings).reshape(-1,
+                                                      self.vectors.shape[1])
+        similarities = queries @ self.vectors.T
+        if exclude is not None and len(exclude):
+            similarities[:, exclude] = -np.inf
+            k = min(k, self.vectors.shape[0] - len(set(exclude)))
+        indices = top_k(similarities, k)
+        distances = 1 - np.take_along_axis(similarities, indices, axis=1)
+        return distances, indices
+
+    def update(self, embeddings, rows):
+        self.vectors = _updated_vectors(self.vectors, embeddings, rows)
+
+    def memory_bytes(self):
+        return self.vectors.nbytes
+
+
+class BruteForceIndex:
+    """Exact cosine search with a sklearn NearestNeighbors model."""
+    name = 'brute'
+
+    def __init__(self, knn_model):
+        self.knn_model = knn_model
+
+    @classmethod
+    def build(cls, embeddings):
+        from sklearn.neighbors import NearestNeighbors
+        knn_model = NearestNeighbors(algorithm='brute', metric='cosine')
+        knn_model.fit(embeddings)
+        return cls(knn_model)
+
+    def save(self, path):
+        import joblib
+        joblib.dump(self.knn_model, path)
+
+    @classmethod
+    def load(cls, path, embeddings=None):
+        import joblib
+        return cls(joblib.load(path))
+
+    def search(self, query_embeddings, k, exclude=None):
+        n = k + (0 if exclude is None else len(exclude))
+        n = min(n, self.knn_model.n_samples_fit_)
+        distances, indices = self.knn_model.kneighbors(query_embeddings,
+                                                       n_neighbors=n)
+        return _remove_excluded(distances, indices, exclude, k)
+
+    def update(self, embeddings, rows):
+        # A brute force model only stores the embeddings
+        self.knn_model.fit(embeddings)
+
+    def memory_bytes(self):
+        return self.knn_model._fit_X.nbytes
+
+
+class IVFIndex:
+    """Approximate cosine search with an inverted file index.
+
+    Arguments:
+    vectors (array): L2-normalized float32 embeddings
+    centroids (array): L2-normalized cluster centroids
+    list_rows (array): Rows of the embeddings sorted by cluster
+    list_offsets (array): Start of every cluster in list_rows
+    n_probe (int): Number of clusters searched per query"""
+    name = 'ivf'
+
+    def __init__(self, vectors, centroids, list_rows, list_offsets,
+                 n_probe=8):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_rows = list_rows
+        self.list_offsets = list_offsets
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_probe=8, iterations=20,
+              seed=0):
+        """Clusters the embeddings with spherical k-means. By default the
+        number of clusters is the square root of the number of embeddings."""
+        vectors = normalize(embeddings)
+        n = len(vectors)
+        n_lists = min(n_lists or max(1, int(np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(n, n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            empty = ~np.any(sums, axis=1)
+            # Restart empty clusters at random embeddings
+            sums[empty] = vectors[rng.choice(n, int(empty.sum()))]
+            centroids = normalize(sums)
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        list_rows = np.argsort(assignments, kind='stable')
+        list_offsets = np.searchsorted(assignments[list_rows],
+                                       np.arange(n_lists + 1))
+        return cls(vectors, centroids, list_rows, list_offsets, n_probe)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_rows=self.list_rows,
+                 list_offsets=self.list_offsets, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path, vectors):
+        """Loads a stored index, vectors are the normalized embeddings."""
+        stored = np.load(path)
+        return cls(vectors, stored['centroids'],
+                   stored['list_rows'], stored['list_offsets'],
+                   int(stored['n_probe']))
+
+    def search(self, query_embeddings, k, exclude=None):
+        requested = k
+        k = min(k + (0 if exclude is None else len(exclude)),
+                len(self.vectors))
+        queries = normalize(query_embeddings).reshape(-1,
+                                                      self.vectors.shape[1])
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = top_k(queries @ self.centroids.T, n_probe)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.zeros((len(queries), k), dtype=np.int64)
+        for i, query in enumerate(queries):
+            rows = np.concatenate([
+                self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]]
+                for c in probes[i]])
+            if len(rows) < k:
+                # The probed clusters are too small, search everything
+                rows = self.list_rows
+            similarities = (self.vectors[rows] @ query)[np.newaxis]
+            best = top_k(similarities, k)[0]
+            distances[i, :len(best)] = 1 - similarities[0, best]
+            indices[i, :len(best)] = rows[best]
+        return _remove_excluded(distances, indices, exclude, requested)
+
+    def update(self, embeddings, rows):
+        """Assigns the given rows to their closest cluster, keeping the
+        clusters as they are. Rebuild the index when many rows changed."""
+        self.vectors = _updated_vectors(self.vectors, embeddings, rows)
+        assignments = np.empty(len(self.vectors), dtype=np.int64)
+        for c in range(len(self.centroids)):
+            assignments[self.list_rows[self.list_offsets[c]:
+                                       self.list_offsets[c + 1]]] = c
+        assignments[rows] = np.argmax(self.vectors[rows] @ self.centroids.T,
+                                      axis=1)
+        self.list_rows = np.argsort(assignments, kind='stable')
+        self.list_offsets = np.searchsorted(
+            assignments[self.list_rows], np.arange(len(self.centroids) + 1))
+
+    def memory_bytes(self):
+        return (self.vectors.nbytes + self.centroids.nbytes +
+                self.list_rows.nbytes + self.list_offsets.nbytes)
+
+
+class HNSWIndex:
+    """Approximate cosine search with a hnswlib graph.
+
+    Arguments:
+    graph (hnswlib.Index): Graph over the embeddings
+    ef (int): Size of the candidate list at search time"""
+    name = 'hnsw'
+
+    def __init__(self, graph, ef=64):
+        self.graph = graph
+        self.graph.set_ef(ef)
+
+    @classmethod
+    def build(cls, embeddings, M=16, ef_construction=200, ef=64, seed=0):
+        import hnswlib
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        graph = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+        graph.init_index(max_elements=len(embeddings), M=M,
+                         ef_construction=ef_construction, random_seed=seed)
+        graph.add_items(embeddings, np.arange(len(embeddings)))
+        return cls(graph, ef)
+
+    def save(self, path):
+        self.graph.save_index(path)
+
+    @classmethod
+    def load(cls, path, embeddings, ef=64):
+        import hnswlib
+        graph = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+        graph.load_index(path, max_elements=len(embeddings))
+        return cls(graph, ef)
+
+    def search(self, query_embeddings, k, exclude=None):
+        n = k + (0 if exclude is None else len(exclude))
+        # hnsw needs ef >= k to return k neighbours
+        self.graph.set_ef(max(self.graph.ef, n))
+        indices, distances = self.graph.knn_query(
+            np.asarray(query_embeddings, dtype=np.float32), k=n)
+        return _remove_excluded(distances, indices.astype(np.int64),
+                                exclude, k)
+
+    def update(self, embeddings, rows):
+        if len(embeddings) > self.graph.get_max_elements():
+            self.graph.resize_index(len(embeddings))
+        # Rows that are already in the graph are replaced
+        self.graph.add_items(np.asarray(embeddings[rows], dtype=np.float32),
+                             np.asarray(rows))
+
+    def memory_bytes(self):
+        # Vectors plus about 2 * M links per element on the lowest layer
+        return self.graph.element_count * (4 * self.graph.dim +
+                                           8 * self.graph.M)
+
+
+class Int8Index:
+    """Cosine search over int8 codes of the normalized embeddings, with
+    re-ranking of the best candidates in full precision.
+
+    Arguments:
+    vectors (array): L2-normalized float32 embeddings, used for re-ranking
+    codes (array): int8 code of every dimension of every embedding
+    scales (array): Scale of every dimension, a code times its scale is the
+    quantized value
+    rerank (int): Number of candidates re-ranked per requested neighbour"""
+    name = 'int8'
+    # Number of codes converted to float32 at once during a search
+    CHUNK_SIZE = 65536
+
+    def __init__(self, vectors, codes, scales, rerank=10):
+        self.vectors = vectors
+        self.codes = codes
+        self.scales = scales
+        self.rerank = rerank
+
+    @staticmethod
+    def quantize(vectors, scales):
+        return np.clip(np.rint(vectors / scales), -127,
+                       127).astype(np.int8)
+
+    @classmethod
+    def build(cls, embeddings, rerank=10):
+        vectors = normalize(embeddings)
+        scales = np.abs(vectors).max(axis=0) / 127
+        scales[scales == 0] = 1
+        return cls(vectors, cls.quantize(vectors, scales),
+                   scales.astype(np.float32), rerank)
+
+    def save(self, path):
+        np.savez(path, codes=self.codes, scales=self.scales,
+                 rerank=self.rerank)
+
+    @classmethod
+    def load(cls, path, vectors):
+        """Loads a stored index, vectors are the normalized embeddings."""
+        stored = np.load(path)
+        return cls(vectors, stored['codes'], stored['scales'],
+                   int(stored['rerank']))
+
+    def search(self, query_embeddings, k, exclude=None):
+        requested = k
+        k = min(k + (0 if exclude is None else len(exclude)),
+                len(self.codes))
+        queries = normalize(query_embeddings).reshape(-1,
+                                                      self.codes.shape[1])
+        # The dot product with the quantized vectors, a chunk of codes at a
+        # time so the float32 copy stays small
+        scaled_queries = (queries * self.scales).T
+        similarities = np.empty((len(queries), len(self.codes)),
+                                dtype=np.float32)
+        for start in range(0, len(self.codes), self.CHUNK_SIZE):
+            chunk = self.codes[start:start + self.CHUNK_SIZE]
+            similarities[:, start:start + len(chunk)] = (
+                chunk.astype(np.float32) @ scaled_queries).T
+        if exclude is not None and len(exclude):
+            similarities[:, exclude] = -np.inf
+        candidates = top_k(similarities, min(k * self.rerank,
+                                             len(self.codes)))
+
+        distances = np.zeros((len(queries), k), dtype=np.float32)
+        indices = np.zeros((len(queries), k), dtype=np.int64)
+        for i, query in enumerate(queries):
+            # Reading the rows in order is faster on a memory map
+            rows = np.sort(candidates[i])
+            exact = (self.vectors[rows] @ query)[np.newaxis]
+            best = top_k(exact, k)[0]
+            distances[i] = 1 - exact[0, best]
+            indices[i] = rows[best]
+        return _remove_excluded(distances, indices, exclude, requested)
+
+    def update(self, embeddings, rows):
+        self.vectors = _updated_vectors(self.vectors, embeddings, rows)
+        codes = np.zeros((len(self.vectors), self.codes.shape[1]),
+                         dtype=np.int8)
+        codes[:len(self.codes)] = self.codes[:len(codes)]
+        # Values outside the range of the scales are clipped
+        codes[rows] = self.quantize(self.vectors[rows], self.scales)
+        self.codes = codes
+
+    def memory_bytes(self):
+        # The full precision vectors stay on disk, only the rows of the
+        # candidates are read
+        return self.codes.nbytes + self.scales.nbytes
+
+
+BACKENDS = {index.name: index for index in
+            [CosineIndex, BruteForceIndex, IVFIndex, HNSWIndex, Int8Index]}
+INDEX_FILES = {
+    'cosine': '{entity_type}_embeddings_normalized.npy',
+    'brute': '{entity_type}_knn_model.pkl',
+    'ivf': '{entity_type}_ivf_index.npz',
+    'hnsw': '{entity_type}_hnsw_index.bin',
+    'int8': '{entity_type}_int8_index.npz',
+}
+
+
+def index_path(entity_type, backend, directory=None):
+    """Returns the path of the stored index of an entity type."""
+    return os.path.join(directory or EMBEDDINGS_DIR,
+                        INDEX_FILES[backend].format(entity_type=entity_type))
+
+
+def save_index(index, path):
+    """Saves an index to a temporary file first and then replaces the
+    stored index. Readers that memory-mapped the old file keep it, and
+    versions that share the old file through a hard link are not changed.
+    """
+    root, extension = os.path.splitext(path)
+    # Same extension, as numpy adds it when it is missing
+    temporary_path = root + '.tmp' + extension
+    index.save(temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_index(entity_type, backend, embeddings=None, directory=None):
+    """Loads the stored index of an entity type.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    backend (string): 'cosine', 'brute', 'ivf', 'hnsw' or 'int8'
+    embeddings (array): Embeddings the index was built from, only needed
+    for hnsw
+    directory (string): Directory of the index, EMBEDDINGS_DIR if not given
+
+    Returns:
+    Index of the given backend"""
+    if backend == 'cosine':
+        return CosineIndex(load_normalized(entity_type, directory))
+    if backend in ('ivf', 'int8'):
+        return BACKENDS[backend].load(
+            index_path(entity_type, backend, directory),
+            load_normalized(entity_type, directory))
+    return BACKENDS[backend].load(index_path(entity_type, backend,
+                                             directory), embeddings)
+
+
+def recall_report(index, reference, embeddings, k=10, n_queries=500,
+                  seed=0, n_latency=100):
+    """Compares an index to a reference index (normally brute force) on
+    random embeddings used as queries.
+
+    Arguments:
+    index: Index to evaluate
+    reference: Index giving the true neighbours
+    embeddings (array): Embeddings to draw queries from
+    k (int): Number of neighbours
+    n_queries (int): Number of queries
+    seed (int): Seed of the query sample
+    n_latency (int): Number of queries that are also searched one by one,
+    like the recommender does, to measure the latency
+
+    Returns:
+    dict: recall@k, the mean search time per query in a batch and the
+    median and 95th percentile latency of a single query in milliseconds,
+    and the memory footprint in MB of both indexes"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), min(n_queries, len(embeddings)),
+                      replace=False)
+    queries = np.asarray(embeddings[rows])
+
+    start = time.perf_counter()
+    _, true_indices = reference.search(queries, k)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    index_time = time.perf_counter() - start
+
+    latencies = []
+    for query in queries[:n_latency]:
+        start = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        latencies.append(1000 * (time.perf_counter() - start))
+
+    hits = sum(len(set(true_row) & set(row))
+               for true_row, row in zip(true_indices, indices))
+    return {
+        'backend': index.name,
+        'k': k,
+        'queries': len(rows),
+        'recall_at_k': hits / (k * len(rows)),
+        'ms_per_query': 1000 * index_time / len(rows),
+        'reference_ms_per_query': 1000 * reference_time / len(rows),
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'memory_mb': index.memory_bytes() / 2 ** 20,
+        'reference_memory_mb': reference.memory_bytes() / 2 ** 20,
+    }
+
+
+if __name__ == '__main__':
+    import model_registry
+
+    args = create_arg_parser()
+    directory = args.directory or model_registry.artifact_dir()
+    embeddings = np.load(os.path.join(
+        directory, f'{args.entity_type}_embeddings.npy'))
+
+    start = time.perf_counter()
+    if args.backend == 'cosine':
+        index = CosineIndex.build(embeddings)
+    elif args.backend == 'ivf':
+        index = IVFIndex.build(embeddings, n_lists=args.n_lists,
+                               n_probe=args.n_probe)
+    elif args.backend == 'hnsw':
+        index = HNSWIndex.build(embeddings, M=args.M, ef=args.ef)
+    elif args.backend == 'int8':
+        index = Int8Index.build(embeddings, rerank=args.rerank)
+    else:
+        index = BruteForceIndex.build(embeddings)
+    print(f'Built {args.backend} index in '
+          f'{time.perf_counter() - start:.1f} s')
+    save_index(index, index_path(args.entity_type, args.backend, directory))
+    if args.backend == 'int8':
+        # Re-rank from the memory-mapped vectors, like the recommender
+        index = load_index(args.entity_type, 'int8', directory=directory)
+
+    reference = load_index(args.entity_type, 'brute', embeddings,
+                           directory)
+    report = recall_report(index, reference, embeddings, k=args.k,
+                           n_queries=args.queries)
+    for key, value in report.items():
+        print(f'{key}: {value}')
@@ -0,0 +1,184 @@
+"""
+This module contains a local index of the songs of every artist and album,
+aligned with the entities arrays, so find_similar_song can pick a song for
+every similar album or artist without a sparql query.
+
+For every entity type, the songs are stored in CSR layout next to the
+embeddings of the artifact version in use (see model_registry):
+<entity_type>_song_offsets.npy    the songs of entity row i are
+                                  song_rows[offsets[i]:offsets[i + 1]]
+<entity_type>_song_rows.npy       song numbers, grouped by entity row
+The songs themselves ('artist name - song title') are stored once, as one
+UTF-8 buffer with the offset of every song:
+song_texts.npy, song_text_offsets.npy
+All arrays are memory-mapped, so looking up a song reads a few bytes.
+
+Songs are sampled with a seed: the same seed always gives the same song for
+an entity, so recommendations are reproducible.
+
+The index is built offline from the metadata store (see metadata_store.py)
+and the entities arrays. Its rows belong to the entities of one artifact
+version, so build_embeddings.py rebuilds it in every new version it
+publishes. To build it for the version in use, use:
+python song_index.py
+"""
+
+import os
+import threading
+import numpy as np
+import metadata_store
+import model_registry
+
+# Default seed of the song sampling
+SEED = 0
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def index_paths(entity_type, directory=None):
+    """Returns the paths of the song index of an entity type.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    directory (string): Directory of the artifacts, the version in use if
+    not given
+
+    Returns:
+    dict: Array name as key and path as value"""
+    directory = directory or model_registry.artifact_dir()
+    return {
+        'offsets': os.path.join(directory, f'{entity_type}_song_offsets.npy'),
+        'rows': os.path.join(directory, f'{entity_type}_song_rows.npy'),
+        'texts': os.path.join(directory, 'song_texts.npy'),
+        'text_offsets': os.path.join(directory, 'song_text_offsets.npy'),
+    }
+
+
+def _save(path, array):
+    """Saves an array, writing to a temporary file first so readers never
+    see a partial file."""
+    with open(path + '.tmp', 'wb') as array_file:
+        np.save(array_file, array)
+    os.replace(path + '.tmp', path)
+
+
+def _csr(groups, n_rows):
+    """Returns the offsets and song numbers of songs grouped by entity row.
+
+    Arguments:
+    groups (list): (entity row, song number) pairs
+    n_rows (int): Number of rows of the entities array"""
+    groups = np.array(groups, dtype=np.int64).reshape(-1, 2)
+    order = np.lexsort((groups[:, 1], groups[:, 0]))
+    groups = groups[order]
+    counts = np.bincount(groups[:, 0], minlength=n_rows)
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, groups[:, 1].astype(np.int32)
+
+
+def build_song_index(directory=None):
+    """Builds the song indexes of the artists and albums from the songs in
+    the metadata store, aligned with the entities arrays of an artifact
+    version. Entity types without an entities array are skipped.
+
+    Argument:
+    directory (string): Directory of the artifacts, the version in use if
+    not given
+
+    Returns:
+    dict: Entity type as key and number of entities with songs as value"""
+    directory = directory or model_registry.artifact_dir()
+    songs = metadata_store.songs()
+    texts = [text.encode('utf-8') for _, text, _, _ in songs]
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+    paths = index_paths('artist', directory)
+    _save(paths['texts'], np.frombuffer(b''.join(texts), dtype=np.uint8))
+    _save(paths['text_offsets'], text_offsets)
+
+    counts = {}
+    for entity_type, column in [('album', 2), ('artist', 3)]:
+        paths = index_paths(entity_type, directory)
+        entities_path = model_registry.artifact_paths(
+            entity_type, directory)['entities']
+        if not os.path.exists(entities_path):
+            continue
+        entities = np.load(entities_path, mmap_mode='r')
+        uri_rows = {str(uri): row for row, uri in enumerate(entities)}
+        groups = [(uri_rows[song[column]], number)
+                  for number, song in enumerate(songs)
+                  if song[column] in uri_rows]
+        offsets, rows = _csr(groups, len(entities))
+        _save(paths['offsets'], offsets)
+        _save(paths['rows'], rows)
+        counts[entity_type] = int(np.count_nonzero(np.diff(offsets)))
+    return counts
+
+
+def get_index(entity_type):
+    """Returns the memory-mapped song index of an entity type, loading it
+    again when the files on disk or the artifact version have changed.
+    Returns None if the index has not been built."""
+    paths = index_paths(entity_type)
+    try:
+        mtimes = tuple(os.stat(path).st_mtime_ns for path in paths.values())
+    except FileNotFoundError:
+        return None
+    mtimes = (paths['rows'],) + mtimes
+    index = _indexes.get(entity_type)
+    if index is None or index['mtimes'] != mtimes:
+        with _lock:
+            index = {name: np.load(path, mmap_mode='r')
+                     for name, path in paths.items()}
+            index['mtimes'] = mtimes
+            _indexes[entity_type] = index
+    return index
+
+
+def sample_songs(entity_type, rows, seed=None):
+    """Picks a song for every entity row from the song index.
+
+    Arguments:
+    entity_type (string): 'artist' or 'album'
+    rows (list): Rows in the entities array, None is allowed
+    seed (int): Seed of the sampling, SEED if not given
+
+    Returns:
+    list: 'artist name - song title' for every row, None for rows without
+    songs
+    Returns None if the index has not been built"""
+    index = get_index(entity_type)
+    if index is None:
+        return None
+    seed = SEED if seed is None else seed
+    offsets, song_rows = index['offsets'], index['rows']
+    texts, text_offsets = index['texts'], index['text_offsets']
+    songs = []
+    for row in rows:
+        if row is None or row + 1 >= len(offsets):
+            songs.append(None)
+            continue
+        start, end = int(offsets[row]), int(offsets[row + 1])
+        if start == end:
+            songs.append(None)
+            continue
+        # The same seed and row always give the same song
+        choice = np.random.default_rng([seed, row]).integers(start, end)
+        number = int(song_rows[choice])
+        songs.append(bytes(texts[text_offsets[number]:
+                                 text_offsets[number + 1]]).decode('utf-8'))
+    return songs
+
+
+def clear():
+    """Forgets the loaded song indexes."""
+    with _lock:
+        _indexes.clear()
+
+
+if __name__ == '__main__':
+    counts = build_song_index()
+    print('Stored songs for {} albums and {} artists'.format(
+        counts.get('album', 0), counts.get('artist', 0)))
@@ -0,0 +1,208 @@
+"""
+This module caches the results of sparql queries, so repeated queries (the
+same similarity query, the labels of popular URIs) are answered without a
+round-trip to the endpoint.
+
+Results are kept in memory in a least recently used cache with a bounded
+number of entries, and every entry expires after a time to live. Empty
+results expire sooner (EMPTY_TTL), so an empty or failed reply of the
+endpoint does not hide an entity for a whole day. An optional on-disk tier
+in SQLite keeps the results over restarts, it is turned on with the
+-cache_file flag of recommender.py. The hits, misses and evictions are
+published on GET /metrics of server.py. Queries are keyed on
+their text with the whitespace normalized.
+
+Queries ending in ORDER BY RAND() LIMIT n can not be cached as they are,
+since every call should return a different sample. For these queries a
+candidate pool is cached instead and the sample is drawn locally from it.
+The pool is itself a random sample (the same query with LIMIT
+RANDOM_POOL_SIZE), so queries with more matches than that are not limited
+to the first matches of the endpoint. Until the pool expires, all samples
+of a query come from the same RANDOM_POOL_SIZE candidates.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+ENABLED = True
+# Maximum number of results kept in memory
+MAX_ENTRIES = 2048
+# Seconds before a cached result expires
+TTL = 24 * 60 * 60
+# Seconds before a cached empty result expires
+EMPTY_TTL = 5 * 60
+# SQLite file of the on-disk tier, None to keep the cache in memory only
+DISK_PATH = None
+# Number of candidates cached for queries with a random order
+RANDOM_POOL_SIZE = 200
+
+_RANDOM_ORDER = re.compile(r'\s*ORDER\s+BY\s+RAND\(\)\s+LIMIT\s+(\d+)\s*$',
+                           re.IGNORECASE)
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_disk = None
+_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def configure(enabled=None, max_entries=None, ttl=None, disk_path=None,
+              empty_ttl=None):
+    """Changes the settings of the cache. Settings that are not given keep
+    their current value. Use disk_path='' to disable the on-disk tier."""
+    global ENABLED, MAX_ENTRIES, TTL, EMPTY_TTL, DISK_PATH, _disk
+    with _lock:
+        if enabled is not None:
+            ENABLED = enabled
+        if max_entries is not None:
+            MAX_ENTRIES = max_entries
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+                _stats['evictions'] += 1
+        if ttl is not None:
+            TTL = ttl
+        if empty_ttl is not None:
+            EMPTY_TTL = empty_ttl
+        if disk_path is not None:
+            DISK_PATH = disk_path or None
+            if _disk is not None:
+                _disk.close()
+            _disk = None
+
+
+def normalize(query):
+    """Returns the query with all whitespace collapsed to single spaces."""
+    return ' '.join(query.split())
+
+
+def random_pool_query(query):
+    """Splits a query with a random order into the query for its candidate
+    pool and the number of results to sample.
+
+    Argument:
+    query (string): Sparql query
+
+    Returns:
+    tuple: (pool query, number of results)
+    Returns None if the query does not end in ORDER BY RAND() LIMIT n"""
+    match = _RANDOM_ORDER.search(query)
+    if match:
+        pool_query = '{} ORDER BY RAND() LIMIT {}'.format(
+            query[:match.start()], RANDOM_POOL_SIZE)
+        return pool_query, int(match.group(1))
+
+
+def _disk_connection():
+    """Returns the connection to the on-disk tier, None if it is disabled.
+    Must be called with the lock held."""
+    global _disk
+    if DISK_PATH is None:
+        return None
+    if _disk is None:
+        directory = os.path.dirname(DISK_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _disk = sqlite3.connect(DISK_PATH, check_same_thread=False)
+        _disk.execute('CREATE TABLE IF NOT EXISTS cache '
+                      '(query TEXT PRIMARY KEY, expires REAL, results TEXT)')
+    return _disk
+
+
+def get(query):
+    """Returns the cached results of a normalized query.
+    Returns None if the query is not cached or has expired."""
+    if not ENABLED:
+        return None
+    now = time.time()
+    with _lock:
+        entry = _entries.get(query)
+        if entry is not None:
+            expires, results = entry
+            if expires > now:
+                _entries.move_to_end(query)
+                _stats['hits'] += 1
+                return results
+            del _entries[query]
+        disk = _disk_connection()
+        if disk is not None:
+            row = disk.execute('SELECT expires, results FROM cache '
+                               'WHERE query = ?', (query,)).fetchone()
+            if row is not None and row[0] > now:
+                results = json.loads(row[1])
+                _store_in_memory(query, row[0], results)
+                _stats['disk_hits'] += 1
+                return results
+        _stats['misses'] += 1
+
+
+def _store_in_memory(query, expires, results):
+    """Adds an entry to the memory tier, evicting the least recently used
+    entries when it is full. Must be called with the lock held."""
+    _entries[query] = (expires, results)
+    _entries.move_to_end(query)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats['evictions'] += 1
+
+
+def put(query, results, ttl=None):
+    """Stores the results of a normalized query in the cache.
+
+    Arguments:
+    query (string): Normalized sparql query
+    results (list): Results returned by the endpoint
+    ttl (float): Seconds before the entry expires, defaults to TTL, or
+    EMPTY_TTL for empty results"""
+    if not ENABLED:
+        return
+    if ttl is None:
+        ttl = TTL if results else EMPTY_TTL
+    expires = time.time() + ttl
+    with _lock:
+        _store_in_memory(query, expires, results)
+        disk = _disk_connection()
+        if disk is not None:
+            disk.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                         (query, expires, json.dumps(results)))
+            disk.commit()
+
+
+def stats():
+    """Returns a dictionary with the number of hits (memory and disk),
+    misses and evictions and the number of entries in memory."""
+    with _lock:
+        counters = dict(_stats)
+        counters['entries'] = len(_entries)
+    return counters
+
+
+def render_metrics(prefix='recommender'):
+    """Returns the counters of stats() in the Prometheus text format."""
+    counters = stats()
+    lines = []
+    for counter in ['hits', 'disk_hits', 'misses', 'evictions']:
+        metric = '{}_sparql_cache_{}_total'.format(prefix, counter)
+        lines.append('# TYPE {} counter'.format(metric))
+        lines.append('{} {}'.format(metric, counters[counter]))
+    metric = '{}_sparql_cache_entries'.format(prefix)
+    lines.append('# TYPE {} gauge'.format(metric))
+    lines.append('{} {}'.format(metric, counters['entries']))
+    return '\n'.join(lines) + '\n'
+
+
+def clear(disk=False):
+    """Removes all entries from memory, and from disk if disk=True, and
+    resets the counters."""
+    with _lock:
+        _entries.clear()
+        for key in _stats:
+            _stats[key] = 0
+        if disk:
+            connection = _disk_connection()
+            if connection is not None:
+                connection.execute('DELETE FROM cache')
+                connection.commit()
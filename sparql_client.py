@@ -0,0 +1,231 @@
+"""
+This module sends sparql queries to the WASABI sparql endpoint.
+
+All queries share one pooled HTTP session, so connections to the endpoint are
+reused. Every request has a timeout and failed requests are retried with an
+exponential backoff. Independent queries can be sent concurrently with
+query_many, and the labels of many URIs can be fetched with a single query
+using a VALUES block.
+
+Results are cached by sparql_cache, so repeated queries do not reach the
+endpoint. The endpoint, timeout, retries and concurrency can be changed with
+configure. requests is imported when the session is created, so importing
+this module does not slow down the start of the chatbot.
+
+Within a trace (see tracing.py), every request to the endpoint is a
+'sparql' span and is counted in the sparql_requests, sparql_bytes_received
+and sparql_cache_hits counters.
+"""
+
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import sparql_cache
+import tracing
+
+ENDPOINT_URL = 'http://wasabi.inria.fr/sparql'
+# Seconds to wait for a connection and for a response
+TIMEOUT = 30.0
+# Number of retries of a failed request and the backoff between them
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+# Maximum number of open connections and concurrent queries
+POOL_SIZE = 8
+# Maximum number of URIs in one VALUES block
+BATCH_SIZE = 100
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(endpoint_url=None, timeout=None, retries=None,
+              backoff_factor=None, pool_size=None):
+    """Changes the settings of the client. Settings that are not given keep
+    their current value. The pooled session is recreated on the next query.
+    """
+    global ENDPOINT_URL, TIMEOUT, RETRIES, BACKOFF_FACTOR, POOL_SIZE
+    global _session
+    with _session_lock:
+        if endpoint_url is not None:
+            ENDPOINT_URL = endpoint_url
+        if timeout is not None:
+            TIMEOUT = timeout
+        if retries is not None:
+            RETRIES = retries
+        if backoff_factor is not None:
+            BACKOFF_FACTOR = backoff_factor
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """Returns the pooled session, creating it on first use."""
+    global _session
+    session = _session
+    if session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                retry = Retry(total=RETRIES,
+                              backoff_factor=BACKOFF_FACTOR,
+                              status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=['GET'])
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=POOL_SIZE,
+                                      max_retries=retry)
+                _session = requests.Session()
+                _session.mount('http://', adapter)
+                _session.mount('https://', adapter)
+            session = _session
+    return session
+
+
+@tracing.traced('sparql')
+def _send(sparql_query, timeout=None):
+    """Sends a sparql query to the endpoint, bypassing the cache."""
+    response = get_session().get(ENDPOINT_URL,
+                                 params={'query': sparql_query,
+                                         'format': 'json'},
+                                 timeout=timeout or TIMEOUT)
+    tracing.count('sparql_requests')
+    tracing.count('sparql_bytes_received', len(response.content))
+    response.raise_for_status()
+    return response.json()['results']['bindings']
+
+
+def _cached_send(sparql_query, timeout=None):
+    """Returns the results of a query from the cache, sending it to the
+    endpoint on a cache miss."""
+    key = sparql_cache.normalize(sparql_query)
+    results = sparql_cache.get(key)
+    if results is None:
+        results = _send(sparql_query, timeout)
+        sparql_cache.put(key, results)
+    else:
+        tracing.count('sparql_cache_hits')
+    return results
+
+
+def query(sparql_query, timeout=None):
+    """Sends a sparql query to the endpoint and returns the results.
+    Results are served from the cache when possible. For queries ending in
+    ORDER BY RAND() LIMIT n, n results are sampled from the cached candidate
+    pool.
+
+    Arguments:
+    sparql_query (string): Sparql query
+    timeout (float): Seconds to wait for the endpoint, defaults to TIMEOUT
+
+    Returns:
+    list of dict: A list of dictionaries with the results in JSON format.
+    A dictionary contains variables returned by the sparql endpoint as keys
+    and the results as values.
+    """
+    if not sparql_cache.ENABLED:
+        return _send(sparql_query, timeout)
+    pool = sparql_cache.random_pool_query(sparql_query)
+    if pool is None:
+        return _cached_send(sparql_query, timeout)
+    pool_query, number = pool
+    candidates = _cached_send(pool_query, timeout)
+    return random.sample(candidates, min(number, len(candidates)))
+
+
+def query_many(sparql_queries, max_workers=None):
+    """Sends several sparql queries concurrently.
+
+    Arguments:
+    sparql_queries (list): List of sparql queries
+    max_workers (int): Maximum number of concurrent queries, defaults to
+    POOL_SIZE
+
+    Returns:
+    list: The results of every query, in the same order as the queries"""
+    sparql_queries = list(sparql_queries)
+    if len(sparql_queries) <= 1:
+        return [query(sparql_query) for sparql_query in sparql_queries]
+    workers = min(max_workers or POOL_SIZE, len(sparql_queries))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Every query gets its own copy of the context of the trace
+        futures = [executor.submit(tracing.wrap(query), sparql_query)
+                   for sparql_query in sparql_queries]
+        return [future.result() for future in futures]
+
+
+def values_clause(variable, uris):
+    """Returns a VALUES block binding a variable to a list of URIs,
+    e.g. VALUES ?uri { <http://...> <http://...> }"""
+    return 'VALUES ?{} {{ {} }}'.format(
+        variable, ' '.join('<{}>'.format(uri) for uri in uris))
+
+
+def _batches(items, size):
+    """Splits a list into lists of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def fetch_labels(uris):
+    """Returns the rdfs:label of several URIs, using one query per batch of
+    BATCH_SIZE URIs.
+
+    Argument:
+    uris (list): List of URIs
+
+    Returns:
+    dict: URI as key and label as value, URIs without a label are left out"""
+    uris = [str(uri) for uri in uris]
+    sparql_queries = ["""
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+        SELECT ?uri ?name
+        WHERE {{
+        {values}
+        ?uri rdfs:label ?name .
+        }}""".format(values=values_clause('uri', batch))
+        for batch in _batches(uris, BATCH_SIZE)]
+    labels = {}
+    for results in query_many(sparql_queries):
+        for result in results:
+            labels.setdefault(result['uri']['value'],
+                              result['name']['value'])
+    return labels
+
+
+def fetch_album_descriptions(uris):
+    """Returns the title and performer name of several albums, using one
+    query per batch of BATCH_SIZE URIs.
+
+    Argument:
+    uris (list): List of album URIs
+
+    Returns:
+    dict: URI as key and 'artist name - album title' as value, albums that
+    are not found are left out"""
+    uris = [str(uri) for uri in uris]
+    sparql_queries = ["""
+        PREFIX dcterms:  <http://purl.org/dc/terms/>
+        PREFIX wsb: <http://ns.inria.fr/wasabi/ontology/>
+        PREFIX mo: <http://purl.org/ontology/mo/>
+        PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+        SELECT ?uri ?title ?artist
+        WHERE {{
+        {values}
+        ?uri a wsb:Album;
+            dcterms:title ?title ;
+            mo:performer ?performer .
+        ?performer rdfs:label ?artist .
+        }}""".format(values=values_clause('uri', batch))
+        for batch in _batches(uris, BATCH_SIZE)]
+    descriptions = {}
+    for results in query_many(sparql_queries):
+        for result in results:
+            descriptions.setdefault(result['uri']['value'],
+                                    result['artist']['value'] + ' - ' +
+                                    result['title']['value'])
+    return descriptions
@@ -0,0 +1,178 @@
+"""
+This script measures how long the chatbot takes to start, to catch changes
+that make recommender.py slow to start again (e.g. a heavy import at module
+level).
+
+Every measurement runs in a fresh Python process:
+- import time: 'python -X importtime -c "import recommender"', with the
+  slowest imported modules;
+- heavy modules: dependencies such as pandas or spaCy that are imported by
+  'import recommender' while they should only be imported on first use;
+- time to first prompt: until 'python recommender.py' asks for a query;
+- time to first answer: until the answer to a query is printed. This needs
+  the artifacts in embeddings/ and the sparql endpoint.
+
+The median of several runs is compared to the thresholds. The script exits
+with status 1 when a threshold is exceeded or a heavy module is imported.
+
+To run the benchmark, use:
+python startup_benchmark.py [-runs 5] [-max_prompt 1.0] [-max_answer 30]
+[-query 'Can you recommend three artists like Ed Sheeran?'] [-no_answer]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(DIRECTORY, 'recommender.py')
+PROMPT = b'How can I help?'
+# Modules that should not be imported before the chatbot needs them
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'spacy', 'sklearn', 'joblib',
+                 'rdflib', 'hnswlib']
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-runs", "--runs", type=int, default=5,
+                        help="Number of runs per measurement")
+    parser.add_argument("-query", "--query", type=str,
+                        default='Can you recommend three artists like '
+                                'Ed Sheeran?',
+                        help="Query for the time to first answer")
+    parser.add_argument("-max_import", "--max_import", type=float,
+                        default=0.5,
+                        help="Maximum seconds to import recommender")
+    parser.add_argument("-max_prompt", "--max_prompt", type=float,
+                        default=1.0,
+                        help="Maximum seconds until the first prompt")
+    parser.add_argument("-max_answer", "--max_answer", type=float,
+                        default=30.0,
+                        help="Maximum seconds until the first answer")
+    parser.add_argument("-no_answer", "--no_answer", action="store_true",
+                        help="Skip the time to first answer")
+    parser.add_argument("-top", "--top", type=int, default=10,
+                        help="Number of slowest imports to show")
+
+    args = parser.parse_args()
+    return args
+
+
+def _environment():
+    """Returns the environment of the measured processes, in which the
+    recommender modules can be imported from any working directory."""
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [DIRECTORY, environment.get('PYTHONPATH')]))
+    return environment
+
+
+def import_times(module='recommender'):
+    """Imports a module in a fresh process with -X importtime.
+
+    Argument:
+    module (string): Name of the module to import
+
+    Returns:
+    list: (cumulative seconds, module name) of every imported module,
+    the last one is the module itself"""
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        capture_output=True, text=True, check=True, env=_environment())
+    times = []
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        times.append((int(parts[1]) / 1e6, parts[2].strip()))
+    return times
+
+
+def heavy_imports(module='recommender'):
+    """Returns the heavy modules that are imported by importing a module."""
+    code = ('import sys, {}\n'
+            'print(" ".join(name for name in {!r} if name in sys.modules))'
+            ).format(module, HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-c', code],
+                             capture_output=True, text=True, check=True,
+                             env=_environment())
+    return process.stdout.split()
+
+
+def time_to_prompt_and_answer(query=None):
+    """Starts the chatbot in a fresh process and measures the time until
+    the first prompt and, if a query is given, until its answer.
+
+    Argument:
+    query (string): Query to answer, None to stop at the prompt
+
+    Returns:
+    tuple: Seconds until the prompt and until the answer (None without a
+    query)"""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-u', SCRIPT],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               env=_environment())
+    try:
+        output = b''
+        while PROMPT not in output:
+            chunk = os.read(process.stdout.fileno(), 1024)
+            if not chunk:
+                raise RuntimeError('The chatbot stopped before the prompt')
+            output += chunk
+        prompt_time = time.perf_counter() - start
+        if query is None:
+            return prompt_time, None
+        process.communicate((query + '\n').encode('utf-8'))
+        if process.returncode != 0:
+            raise RuntimeError('The chatbot failed to answer {!r}'
+                               .format(query))
+        return prompt_time, time.perf_counter() - start
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def check(name, seconds, threshold):
+    """Prints a measurement and returns False if it exceeds its threshold.
+    """
+    passed = seconds <= threshold
+    print('{:<22}{:8.3f} s  (max {:.3f} s)  {}'.format(
+        name, seconds, threshold, 'ok' if passed else 'REGRESSION'))
+    return passed
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    passed = True
+
+    runs = [import_times() for _ in range(args.runs)]
+    print('Slowest imports (cumulative):')
+    for seconds, name in sorted(runs[0], reverse=True)[:args.top]:
+        print('  {:8.3f} s  {}'.format(seconds, name))
+    passed &= check('import recommender',
+                    statistics.median(times[-1][0] for times in runs),
+                    args.max_import)
+
+    heavy = heavy_imports()
+    if heavy:
+        print('Heavy modules imported at start-up:', ', '.join(heavy))
+        passed = False
+
+    query = None if args.no_answer else args.query
+    timings = [time_to_prompt_and_answer(query) for _ in range(args.runs)]
+    passed &= check('time to first prompt',
+                    statistics.median(prompt for prompt, _ in timings),
+                    args.max_prompt)
+    if query is not None:
+        passed &= check('time to first answer',
+                        statistics.median(answer for _, answer in timings),
+                        args.max_answer)
+
+    sys.exit(0 if passed else 1)
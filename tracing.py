@@ -0,0 +1,354 @@
+"""
+This module traces the stages of the recommendation pipeline, so the cost
+of a slow query can be attributed to e.g. the genre matching, get_location,
+the nearest neighbour search or the sparql queries.
+
+A trace is started for every query with trace(). Within a trace, the time
+of a stage is measured with span() or the traced decorator, and count()
+adds to a counter, such as the number of sparql requests and the bytes
+received from the endpoint. When the trace ends, it is passed to the sinks:
+log         LogSink, one JSON line per query through logging
+prometheus  PrometheusSink, totals and histograms per stage and counter in
+            the Prometheus text format (GET /metrics of server.py)
+otel        OpenTelemetrySink, spans through the OpenTelemetry API, if it
+            is installed
+
+Tracing is off until sinks are configured, e.g. with the -trace flag of
+recommender.py. When it is off, a traced function only checks whether
+there is a current trace, so the instrumentation can stay in place.
+
+The current trace is kept in a context variable, so it follows the query
+into asyncio tasks. Thread pools do not copy the context, functions that
+run in a worker thread should be wrapped with wrap().
+"""
+
+import contextvars
+import json
+import threading
+import time
+from functools import wraps
+
+ENABLED = False
+# Upper bounds in seconds of the histogram buckets of PrometheusSink
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+_sinks = []
+_current = contextvars.ContextVar('trace', default=None)
+_parent = contextvars.ContextVar('span', default=None)
+
+
+class Trace:
+    """Spans and counters of one query.
+
+    Arguments:
+    name (string): Name of the traced operation
+    attributes (dict): Extra information, e.g. the query"""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        # (name, start in seconds after the trace start, duration, index
+        # of the parent span or None)
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def stages(self):
+        """Returns the total seconds of every span name."""
+        stages = {}
+        for name, _, duration, _ in self.finished_spans():
+            stages[name] = stages.get(name, 0.0) + duration
+        return stages
+
+    def finished_spans(self):
+        """Returns the spans that have finished. Spans in worker threads
+        that were still running at a deadline are left out."""
+        return [span for span in self.spans if span is not None]
+
+    def as_dict(self):
+        return {'name': self.name,
+                'start_time': self.start_time,
+                'duration_ms': round(1000 * self.duration, 3),
+                'attributes': self.attributes,
+                'stages_ms': {name: round(1000 * seconds, 3)
+                              for name, seconds in self.stages().items()},
+                'counters': dict(self.counters)}
+
+
+class _Trace:
+    """Context manager of trace()."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.trace = None
+        self.token = None
+
+    def __enter__(self):
+        current = _current.get()
+        if not ENABLED or current is not None:
+            # Nested traces belong to the outer trace
+            return current
+        self.trace = Trace(self.name, self.attributes)
+        self.token = _current.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        if self.trace is None:
+            return
+        self.trace.duration = time.perf_counter() - self.trace.start
+        _current.reset(self.token)
+        for sink in list(_sinks):
+            try:
+                sink.emit(self.trace)
+            except Exception:
+                # A broken sink should never break a query
+                import logging
+                logging.getLogger(__name__).exception(
+                    'Sink %r failed', sink)
+
+
+class _Span:
+    """Context manager of span()."""
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.parent = _parent.get()
+        with self.trace._lock:
+            self.index = len(self.trace.spans)
+            # Reserve the position of the span, so child spans can refer
+            # to it before it is finished
+            self.trace.spans.append(None)
+        self.token = _parent.set(self.index)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        _parent.reset(self.token)
+        with self.trace._lock:
+            self.trace.spans[self.index] = (
+                self.name, self.start - self.trace.start, duration,
+                self.parent)
+
+
+class _NoSpan:
+    """Context manager of span() without a current trace."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def configure(sinks):
+    """Sets the sinks that finished traces are passed to. Tracing is
+    turned off when there are no sinks.
+
+    Argument:
+    sinks (list): Sinks, objects with an emit(trace) method"""
+    global ENABLED
+    _sinks[:] = sinks
+    ENABLED = bool(_sinks)
+
+
+def create_sink(name):
+    """Creates a sink by name: 'log', 'prometheus' or 'otel'."""
+    return {'log': LogSink, 'prometheus': PrometheusSink,
+            'otel': OpenTelemetrySink}[name]()
+
+
+def sinks():
+    """Returns the configured sinks."""
+    return list(_sinks)
+
+
+def trace(name, **attributes):
+    """Starts a trace, to be used as a context manager. Inside another
+    trace, the outer trace is used.
+
+    Arguments:
+    name (string): Name of the traced operation
+    attributes: Extra information, e.g. query='...'
+
+    Returns:
+    Context manager giving the Trace, or None if tracing is off"""
+    return _Trace(name, attributes)
+
+
+def current_trace():
+    """Returns the current trace, or None."""
+    return _current.get()
+
+
+def span(name):
+    """Measures a stage of the current trace, to be used as a context
+    manager. Does nothing outside a trace."""
+    current = _current.get()
+    if current is None:
+        return _NO_SPAN
+    return _Span(current, name)
+
+
+def traced(name):
+    """Decorator measuring every call of a function as a span."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            current = _current.get()
+            if current is None:
+                return function(*args, **kwargs)
+            with _Span(current, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(counter, value=1):
+    """Adds a value to a counter of the current trace."""
+    current = _current.get()
+    if current is not None:
+        current.add(counter, value)
+
+
+def wrap(function):
+    """Returns a function that runs in a copy of the current context, so
+    its spans and counters are added to the current trace when it runs in
+    a worker thread."""
+    if _current.get() is None:
+        return function
+    context = contextvars.copy_context()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.run(function, *args, **kwargs)
+    return wrapper
+
+
+class LogSink:
+    """Writes every trace as one JSON line through logging.
+
+    Arguments:
+    logger_name (string): Name of the logger
+    level (int): Level of the log lines, logging.INFO if not given"""
+
+    def __init__(self, logger_name='recommender.trace', level=None):
+        import logging
+        self.logger = logging.getLogger(logger_name)
+        self.level = logging.INFO if level is None else level
+
+    def emit(self, trace):
+        self.logger.log(self.level, json.dumps(trace.as_dict()))
+
+
+class PrometheusSink:
+    """Keeps totals of all traces and renders them in the Prometheus text
+    exposition format:
+    recommender_queries_total              number of traces
+    recommender_stage_seconds              histogram of every span name,
+                                           with stage="query" for the
+                                           whole trace
+    recommender_<counter>_total            total of every counter
+
+    Argument:
+    prefix (string): Prefix of the metric names"""
+
+    def __init__(self, prefix='recommender'):
+        self.prefix = prefix
+        self.queries = 0
+        # Stage as key and [bucket counts, sum, count] as value
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, stage, seconds):
+        histogram = self.histograms.setdefault(
+            stage, [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def emit(self, trace):
+        with self._lock:
+            self.queries += 1
+            self._observe('query', trace.duration)
+            for name, _, duration, _ in trace.finished_spans():
+                self._observe(name, duration)
+            for counter, value in trace.counters.items():
+                self.counters[counter] = (self.counters.get(counter, 0) +
+                                          value)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        name = self.prefix + '_stage_seconds'
+        with self._lock:
+            lines = ['# TYPE {}_queries_total counter'.format(self.prefix),
+                     '{}_queries_total {}'.format(self.prefix, self.queries),
+                     '# TYPE {} histogram'.format(name)]
+            for stage, (buckets, total, number) in sorted(
+                    self.histograms.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                        name, stage, bound, bucket))
+                lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(
+                    name, stage, number))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage,
+                                                              total))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage,
+                                                                number))
+            for counter, value in sorted(self.counters.items()):
+                metric = '{}_{}_total'.format(self.prefix, counter)
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+class OpenTelemetrySink:
+    """Sends every trace as OpenTelemetry spans, with the counters as
+    attributes of the root span. The exporter is set up by the application
+    with the OpenTelemetry SDK. Raises ImportError if the OpenTelemetry API
+    is not installed."""
+
+    def __init__(self, tracer_name='recommender'):
+        from opentelemetry import trace as otel_trace
+        self.otel_trace = otel_trace
+        self.tracer = otel_trace.get_tracer(tracer_name)
+
+    def emit(self, trace):
+        start_ns = int(trace.start_time * 1e9)
+        attributes = {key: str(value)
+                      for key, value in trace.attributes.items()}
+        attributes.update(trace.counters)
+        root = self.tracer.start_span(trace.name, start_time=start_ns,
+                                      attributes=attributes)
+        spans = []
+        for span in trace.spans:
+            if span is None:
+                spans.append(None)
+                continue
+            name, start, duration, parent = span
+            parent_span = root if parent is None else spans[parent]
+            parent_span = parent_span or root
+            span_ns = start_ns + int(start * 1e9)
+            child = self.tracer.start_span(
+                name, start_time=span_ns,
+                context=self.otel_trace.set_span_in_context(parent_span))
+            child.end(end_time=span_ns + int(duration * 1e9))
+            spans.append(child)
+        root.end(end_time=start_ns + int(trace.duration * 1e9))